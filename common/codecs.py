@@ -0,0 +1,229 @@
+"""MessagePack compatible value encoding used by the binary packet format.
+
+Uses the ``msgpack`` extension when it is installed and falls back to the
+pure Python implementation below, which produces the same bytes.
+"""
+
+import struct
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - depends on the environment
+    msgpack = None
+
+
+class DecodeError(Exception):
+    pass
+
+
+_pack_float = struct.Struct("!d").pack
+_INT_FORMATS = (
+    (0xFF, 0xCC, struct.Struct("!B")),
+    (0xFFFF, 0xCD, struct.Struct("!H")),
+    (0xFFFFFFFF, 0xCE, struct.Struct("!I")),
+    (0xFFFFFFFFFFFFFFFF, 0xCF, struct.Struct("!Q")),
+)
+_SINT_FORMATS = (
+    (-0x80, 0xD0, struct.Struct("!b")),
+    (-0x8000, 0xD1, struct.Struct("!h")),
+    (-0x80000000, 0xD2, struct.Struct("!i")),
+    (-0x8000000000000000, 0xD3, struct.Struct("!q")),
+)
+MAX_DEPTH = 64
+"""Deepest nesting of arrays and maps the fallback decoder accepts."""
+_U8 = struct.Struct("!B")
+_U16 = struct.Struct("!H")
+_U32 = struct.Struct("!I")
+
+
+def _pack_length(out: bytearray, length: int, fix: int, fix_max: int, codes) -> None:
+    if length < fix_max and fix is not None:
+        out.append(fix | length)
+    elif length <= 0xFF and codes[0] is not None:
+        out.append(codes[0])
+        out += _U8.pack(length)
+    elif length <= 0xFFFF:
+        out.append(codes[1])
+        out += _U16.pack(length)
+    else:
+        out.append(codes[2])
+        out += _U32.pack(length)
+
+
+def _pack(out: bytearray, obj) -> None:
+    if obj is None:
+        out.append(0xC0)
+    elif obj is True:
+        out.append(0xC3)
+    elif obj is False:
+        out.append(0xC2)
+    elif isinstance(obj, int):
+        if 0 <= obj < 0x80:
+            out.append(obj)
+        elif -0x20 <= obj < 0:
+            out.append(obj & 0xFF)
+        elif obj > 0:
+            for limit, code, fmt in _INT_FORMATS:
+                if obj <= limit:
+                    out.append(code)
+                    out += fmt.pack(obj)
+                    return
+            raise OverflowError("Integer too large to encode.")
+        else:
+            for limit, code, fmt in _SINT_FORMATS:
+                if obj >= limit:
+                    out.append(code)
+                    out += fmt.pack(obj)
+                    return
+            raise OverflowError("Integer too small to encode.")
+    elif isinstance(obj, float):
+        out.append(0xCB)
+        out += _pack_float(obj)
+    elif isinstance(obj, str):
+        data = obj.encode()
+        _pack_length(out, len(data), 0xA0, 32, (0xD9, 0xDA, 0xDB))
+        out += data
+    elif isinstance(obj, (bytes, bytearray, memoryview)):
+        _pack_length(out, len(obj), None, 0, (0xC4, 0xC5, 0xC6))
+        out += obj
+    elif isinstance(obj, (list, tuple)):
+        _pack_length(out, len(obj), 0x90, 16, (None, 0xDC, 0xDD))
+        for item in obj:
+            _pack(out, item)
+    elif isinstance(obj, dict):
+        _pack_length(out, len(obj), 0x80, 16, (None, 0xDE, 0xDF))
+        for key, value in obj.items():
+            _pack(out, key)
+            _pack(out, value)
+    else:
+        raise TypeError(f"Cannot encode object of type {type(obj).__name__}.")
+
+
+_FIXED = {
+    0xCC: _U8,
+    0xCD: _U16,
+    0xCE: _U32,
+    0xCF: struct.Struct("!Q"),
+    0xD0: struct.Struct("!b"),
+    0xD1: struct.Struct("!h"),
+    0xD2: struct.Struct("!i"),
+    0xD3: struct.Struct("!q"),
+    0xCA: struct.Struct("!f"),
+    0xCB: struct.Struct("!d"),
+}
+_LENGTHS = {
+    0xD9: _U8,
+    0xDA: _U16,
+    0xDB: _U32,
+    0xC4: _U8,
+    0xC5: _U16,
+    0xC6: _U32,
+    0xDC: _U16,
+    0xDD: _U32,
+    0xDE: _U16,
+    0xDF: _U32,
+}
+
+
+def _unpack(data, offset: int, depth: int = 0):
+    code = data[offset]
+    offset += 1
+    if code < 0x80:
+        return code, offset
+    if code >= 0xE0:
+        return code - 0x100, offset
+    if 0xA0 <= code <= 0xBF:
+        end = offset + (code & 0x1F)
+        return str(data[offset:end], "utf-8"), end
+    if 0x90 <= code <= 0x9F:
+        return _unpack_array(data, offset, code & 0x0F, depth)
+    if 0x80 <= code <= 0x8F:
+        return _unpack_map(data, offset, code & 0x0F, depth)
+    if code == 0xC0:
+        return None, offset
+    if code == 0xC2:
+        return False, offset
+    if code == 0xC3:
+        return True, offset
+    fmt = _FIXED.get(code)
+    if fmt is not None:
+        return fmt.unpack_from(data, offset)[0], offset + fmt.size
+    fmt = _LENGTHS.get(code)
+    if fmt is None:
+        raise DecodeError(f"Unsupported type code 0x{code:02x}.")
+    (length,) = fmt.unpack_from(data, offset)
+    offset += fmt.size
+    if code in (0xD9, 0xDA, 0xDB):
+        end = offset + length
+        return str(data[offset:end], "utf-8"), end
+    if code in (0xC4, 0xC5, 0xC6):
+        end = offset + length
+        return bytes(data[offset:end]), end
+    if code in (0xDC, 0xDD):
+        return _unpack_array(data, offset, length, depth)
+    return _unpack_map(data, offset, length, depth)
+
+
+def _unpack_array(data, offset: int, length: int, depth: int):
+    if depth >= MAX_DEPTH:
+        raise DecodeError("Too deeply nested.")
+    items = []
+    for _ in range(length):
+        item, offset = _unpack(data, offset, depth + 1)
+        items.append(item)
+    return items, offset
+
+
+def _unpack_map(data, offset: int, length: int, depth: int):
+    if depth >= MAX_DEPTH:
+        raise DecodeError("Too deeply nested.")
+    items = {}
+    for _ in range(length):
+        key, offset = _unpack(data, offset, depth + 1)
+        items[key], offset = _unpack(data, offset, depth + 1)
+    return items, offset
+
+
+def packb(obj) -> bytes:
+    """
+    Encodes a value as MessagePack.
+
+    Args:
+        obj: None, bool, int, float, str, bytes, list, tuple or dict.
+
+    Returns:
+        bytes: The encoded value.
+    """
+    if msgpack is not None:
+        return msgpack.packb(obj, use_bin_type=True)
+    out = bytearray()
+    _pack(out, obj)
+    return bytes(out)
+
+
+def unpackb(data: bytes | memoryview):
+    """
+    Decodes a single MessagePack value.
+
+    Args:
+        data (bytes | memoryview): The encoded value.
+
+    Raises:
+        DecodeError: If the data is truncated, not valid MessagePack, or
+            nested deeper than MAX_DEPTH.
+
+    Returns:
+        The decoded value.
+    """
+    if msgpack is not None:
+        try:
+            return msgpack.unpackb(data, raw=False)
+        except (ValueError, TypeError) as e:
+            raise DecodeError(str(e)) from e
+    try:
+        obj, offset = _unpack(data, 0)
+    except (IndexError, struct.error, UnicodeDecodeError, TypeError) as e:
+        raise DecodeError(str(e)) from e
+    if offset != len(data):
+        raise DecodeError("Trailing data after value.")
+    return obj
@@ -0,0 +1,229 @@
+"""Negotiated deflate compression of what the server sends.
+
+A client offers ``"compression": ["deflate"]`` in its HelloPacket; if the
+server agrees it answers with ``"compression": "deflate"``, and every frame
+it sends after that answer starts with a flag byte:
+
+- ``FLAG_PLAIN``: the rest is one packet payload, sent as is because it is
+  smaller than the server's threshold.
+- ``FLAG_STREAM``: the rest is raw deflate data from the connection's own
+  compressor. The compressor keeps its context between frames, so repeated
+  envelopes and words cost almost nothing after the first time.
+- ``FLAG_GROUP`` / ``FLAG_GROUP_RESET``: a 32 bit group id, then raw deflate
+  data from a compressor shared by a group of recipients (e.g. everyone
+  getting broadcasts in one codec), so a broadcast is compressed once per
+  group instead of once per recipient. A reset frame starts a new context:
+  the client drops what it had for that group first.
+
+Both sides keep the contexts of the ``max_groups`` groups a connection got
+frames from most recently and forget older ones; the server's hello answer
+says how many (``"groups"``). The server only sends a connection a group
+frame that isn't a reset while it remembers the group too, so the two stay
+in step.
+
+Compressed frames decompress to one or more complete frames, each holding a
+packet payload. Every deflate block ends in a sync flush; its fixed
+``00 00 ff ff`` tail is left out on the wire and added back by the client.
+Clients never compress what they send.
+"""
+
+import struct
+import zlib
+from collections import OrderedDict
+from typing import List
+
+from .packets import FRAME_HEADER, FrameError, PacketBuffer, frame
+
+DEFLATE = "deflate"
+"""Name of the only compression method, as offered in a HelloPacket."""
+FLAG_PLAIN = 0
+FLAG_STREAM = 1
+FLAG_GROUP = 2
+FLAG_GROUP_RESET = 3
+GROUP_ID = struct.Struct("!I")
+SYNC_TAIL = b"\x00\x00\xff\xff"
+MAX_GROUPS = 1024
+"""Group contexts kept per connection when the server's hello doesn't say."""
+
+
+def deflate(compressor, data: bytes) -> bytes:
+    """
+    Compresses data and sync flushes, keeping the compressor's context.
+
+    Args:
+        compressor: A raw deflate ``zlib.compressobj``.
+        data (bytes): The data to compress.
+
+    Returns:
+        bytes: The compressed data without the sync flush tail.
+    """
+    return (compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH))[:-4]
+
+
+class Deflater(object):
+    """
+    Compresses the frames written to one connection.
+
+    The connection's compressor is only created once something reaches the
+    threshold, so connections that only ever get small packets cost no
+    zlib state.
+    """
+
+    __slots__ = (
+        "min_size",
+        "level",
+        "window_bits",
+        "mem_level",
+        "max_groups",
+        "compressor",
+        "groups",
+    )
+
+    def __init__(
+        self,
+        min_size: int = 128,
+        level: int = 6,
+        window_bits: int = 12,
+        mem_level: int = 5,
+        max_groups: int = MAX_GROUPS,
+    ):
+        """
+        Initializes a new Deflater instance.
+
+        Args:
+            min_size (int): Smallest write, in framed bytes, that is compressed.
+            level (int): zlib compression level.
+            window_bits (int): Base two logarithm of the context size, 9 to 15.
+            mem_level (int): zlib memory level, 1 to 9. The compressor takes
+                about ``2 ** (window_bits + 2) + 2 ** (mem_level + 9)`` bytes.
+            max_groups (int): Most groups remembered, as announced to the client.
+        """
+        self.min_size = min_size
+        self.level = level
+        self.window_bits = window_bits
+        self.mem_level = mem_level
+        self.max_groups = max_groups
+        self.compressor = None
+        self.groups: OrderedDict = OrderedDict()
+        """Group id to the sequence number of the next group frame this
+        connection can decode, least recently written first."""
+
+    def new_compressor(self):
+        return zlib.compressobj(
+            self.level, zlib.DEFLATED, -self.window_bits, self.mem_level
+        )
+
+    def synced(self, group: int, seq: int) -> None:
+        """
+        Records that a group's frame was written to this connection.
+
+        Args:
+            group (int): The group id.
+            seq (int): Sequence number of the group's next frame.
+        """
+        groups = self.groups
+        groups[group] = seq
+        groups.move_to_end(group)
+        if len(groups) > self.max_groups:
+            groups.popitem(last=False)
+
+    def encode(self, data: bytes) -> bytes:
+        """
+        Turns framed packets into the frames sent on a compressed connection.
+
+        Args:
+            data (bytes): One or more framed packet payloads.
+
+        Returns:
+            bytes: One compressed frame, or the same frames flagged as plain
+            if ``data`` is below the threshold.
+        """
+        if len(data) < self.min_size:
+            return plain(data)
+        if self.compressor is None:
+            self.compressor = self.new_compressor()
+        return frame(bytes((FLAG_STREAM,)) + deflate(self.compressor, data))
+
+
+def plain(data: bytes) -> bytes:
+    """
+    Flags framed packets as uncompressed.
+
+    Args:
+        data (bytes): One or more framed packet payloads.
+
+    Returns:
+        bytes: The frames, each payload prefixed with FLAG_PLAIN.
+    """
+    flag = bytes((FLAG_PLAIN,))
+    header = FRAME_HEADER.size
+    (length,) = FRAME_HEADER.unpack_from(data)
+    if header + length == len(data):
+        return frame(flag + data[header:])
+    out = []
+    offset = 0
+    while offset < len(data):
+        (length,) = FRAME_HEADER.unpack_from(data, offset)
+        start = offset + header
+        offset = start + length
+        out.append(frame(flag + data[start:offset]))
+    return b"".join(out)
+
+
+class Inflater(object):
+    """Reverses a Deflater and the server's group compressors on the client side."""
+
+    def __init__(self, max_groups: int = MAX_GROUPS):
+        """
+        Initializes a new Inflater instance.
+
+        Args:
+            max_groups (int): Most group decompressors kept, as the server's
+                hello answer says.
+        """
+        self.stream = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.max_groups = max_groups
+        self.groups: OrderedDict = OrderedDict()
+        """Group id to its decompressor, least recently used first."""
+
+    def payloads(self, payload: bytes | memoryview) -> List[memoryview]:
+        """
+        Returns the packet payloads a received frame holds.
+
+        Args:
+            payload (bytes | memoryview): The payload of a frame sent after
+                compression was agreed on.
+
+        Raises:
+            FrameError: If the frame is malformed or references an unknown group.
+
+        Returns:
+            List[memoryview]: The packet payloads, in stream order.
+        """
+        if not payload:
+            raise FrameError("Empty compressed frame.")
+        flag = payload[0]
+        if flag == FLAG_PLAIN:
+            return [memoryview(payload)[1:]]
+        if flag == FLAG_STREAM:
+            decompressor = self.stream
+            body = payload[1:]
+        elif flag in (FLAG_GROUP, FLAG_GROUP_RESET):
+            (group,) = GROUP_ID.unpack_from(payload, 1)
+            groups = self.groups
+            if flag == FLAG_GROUP_RESET:
+                groups[group] = zlib.decompressobj(-zlib.MAX_WBITS)
+            decompressor = groups.get(group)
+            if decompressor is None:
+                raise FrameError(f"Frame for unknown compression group {group}.")
+            groups.move_to_end(group)
+            if len(groups) > self.max_groups:
+                groups.popitem(last=False)
+            body = payload[1 + GROUP_ID.size :]
+        else:
+            raise FrameError(f"Unknown compression flag {flag}.")
+        try:
+            data = decompressor.decompress(bytes(body) + SYNC_TAIL)
+        except zlib.error as e:
+            raise FrameError(f"Corrupt compressed frame: {e}") from None
+        return PacketBuffer().feed(data)
@@ -1,11 +1,177 @@
 import json
-from typing import Union
+import re
+import struct
+from typing import Iterable, List, Union
+
+from .codecs import DecodeError, packb, unpackb
 
 
 class VerificationError(Exception):
     pass
 
 
+class FrameError(Exception):
+    pass
+
+
+FRAME_HEADER = struct.Struct("!I")
+"""Big-endian unsigned 32 bit length that prefixes every packet on the wire."""
+MAX_FRAME_SIZE = 1024 * 1024
+"""Largest payload a PacketBuffer will accept before giving up on the stream."""
+BINARY_MARKER = 0xB1
+"""First byte of every binary payload. JSON payloads always start with ``{``."""
+BINARY_HEADER = struct.Struct("!BH")
+"""Binary payload header: BINARY_MARKER followed by the packet's type id."""
+
+# A "type" key at either end of a JSON object. Quotes inside strings are
+# always escaped, so neither pattern can match the contents of a value.
+_JSON_TYPE_HEAD = re.compile(rb'\{\s*"type"\s*:\s*"(\w+)"\s*[,}]')
+_JSON_TYPE_TAIL = re.compile(rb'[{,]\s*"type"\s*:\s*"(\w+)"\s*\}\s*$')
+_JSON_TYPE_TAIL_SCAN = 128
+
+
+def frame(payload: bytes) -> bytes:
+    """
+    Prefixes a payload with its length so it can be written to a stream.
+
+    Args:
+        payload (bytes): The encoded packet.
+
+    Returns:
+        bytes: The framed packet.
+    """
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+def frame_many(payloads: Iterable[bytes]) -> bytes:
+    """
+    Frames several payloads into a single buffer for one ``transport.write``.
+
+    Args:
+        payloads (Iterable[bytes]): The encoded packets.
+
+    Returns:
+        bytes: The framed packets, back to back.
+    """
+    pack = FRAME_HEADER.pack
+    parts = []
+    for payload in payloads:
+        parts.append(pack(len(payload)))
+        parts.append(payload)
+    return b"".join(parts)
+
+
+class PacketBuffer(object):
+    """Incremental decoder for a length-prefixed packet stream.
+
+    Keep one instance per connection and feed it every read; it returns all
+    complete payloads and holds on to any trailing partial frame.
+
+    Args:
+        max_frame_size (int): Largest payload accepted before raising FrameError.
+
+    .. highlight:: python
+    .. code-block:: python
+
+        buffer = PacketBuffer()
+        for packet in buffer.packets(data):
+            handle(packet)
+
+    """
+
+    __slots__ = ("max_frame_size", "_buffer")
+
+    def __init__(self, max_frame_size: int = MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self._buffer = b""
+        """Trailing partial frame; idle connections share the empty bytes object."""
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def pending(self) -> bytes:
+        """Returns the partial frame held back for the next read."""
+        return bytes(self._buffer)
+
+    def feed(self, data: bytes) -> List[memoryview]:
+        """
+        Adds data to the buffer and returns every complete payload.
+
+        Payloads are read-only views into the bytes of the read they arrived
+        in; only a partial frame carried over from a previous read costs a copy.
+
+        Args:
+            data (bytes): Bytes read from the stream.
+
+        Raises:
+            FrameError: If a frame announces a payload above max_frame_size.
+
+        Returns:
+            List[memoryview]: The complete payloads, in stream order.
+        """
+        if self._buffer:
+            data = self._buffer + data
+            self._buffer = b""
+        view = memoryview(data)
+        size = len(data)
+        header = FRAME_HEADER.size
+        unpack = FRAME_HEADER.unpack_from
+        payloads = []
+        offset = 0
+        while size - offset >= header:
+            (length,) = unpack(data, offset)
+            if length > self.max_frame_size:
+                raise FrameError(
+                    f"Frame of {length} bytes exceeds limit of {self.max_frame_size}."
+                )
+            end = offset + header + length
+            if end > size:
+                break
+            payloads.append(view[offset + header : end])
+            offset = end
+        if offset < size:
+            self._buffer = bytes(view[offset:])
+        return payloads
+
+    def views(self, data: bytes) -> List["BasePacket"]:
+        """
+        Adds data to the buffer and returns a lazy view of every complete packet.
+
+        Only the packet type is read up front; see BasePacket.view.
+
+        Args:
+            data (bytes): Bytes read from the stream.
+
+        Returns:
+            List[BasePacket]: The packet views, in stream order.
+        """
+        packets = []
+        for payload in self.feed(data):
+            packet = BasePacket.view(payload)
+            if packet is not None:
+                packets.append(packet)
+        return packets
+
+    def packets(self, data: bytes) -> List["BasePacket"]:
+        """
+        Adds data to the buffer and decodes every complete packet.
+
+        Payloads that fail to decode are skipped.
+
+        Args:
+            data (bytes): Bytes read from the stream.
+
+        Returns:
+            List[BasePacket]: The decoded packets, in stream order.
+        """
+        packets = []
+        for payload in self.feed(data):
+            packet = BasePacket.decode(payload)
+            if packet is not None:
+                packets.append(packet)
+        return packets
+
+
 class BasePacket(object):
     """Base of all Packet types.
 
@@ -31,26 +197,86 @@ class BasePacket(object):
     """
 
     subclasses = {}
+    type_ids = []
+    """Subclasses indexed by their binary type id, in definition order."""
     extra_prep = []
+    raw = None
+    """The payload a lazy view was created from, or None for built packets."""
+    _data = None
+    _parsed = None
+    """Copy of the fields parsed from ``raw``, to tell whether they changed."""
 
     def __init_subclass__(cls, *args, **kwargs):
         super().__init_subclass__(*args, **kwargs)
+        cls.type_id = len(cls.type_ids)
         cls.subclasses[cls.__name__] = cls
+        cls.type_ids.append(cls)
 
     def __init__(self, data):
         self.data = data
 
-    def prep(self):
-        print(self.data)
+    @property
+    def data(self):
+        if self._data is None and self.raw is not None:
+            self._data = self._load(self.raw)
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+
+    @property
+    def loaded(self) -> bool:
+        """Whether ``data`` has been parsed or set, i.e. ``raw`` may be stale."""
+        return self._data is not None
+
+    def _prepare(self):
         self.data["type"] = self.get_type()
         for i in self.extra_prep:
             i()
-        if self.verify():
-
-            return json.dumps(self.data).encode()
-        else:
+        if not self.verify():
             raise VerificationError(f"'{self.__class__.__name__}' Failed verification.")
 
+    def prep(self):
+        self._prepare()
+        return json.dumps(self.data).encode()
+
+    def prep_binary(self) -> bytes:
+        """
+        Encodes the packet in the compact binary format.
+
+        The type travels as a 16 bit id in the header and the remaining fields
+        as a MessagePack map.
+
+        Returns:
+            bytes: The encoded packet.
+        """
+        self._prepare()
+        body = {k: v for k, v in self.data.items() if k != "type"}
+        return BINARY_HEADER.pack(BINARY_MARKER, self.type_id) + packb(body)
+
+    def pack(self) -> bytes:
+        """
+        Encodes and frames the packet, ready for ``transport.write``.
+
+        Returns:
+            bytes: The framed packet.
+        """
+        return frame(self.prep())
+
+    @staticmethod
+    def pack_many(packets: Iterable["BasePacket"]) -> bytes:
+        """
+        Encodes and frames several packets into one buffer.
+
+        Args:
+            packets (Iterable[BasePacket]): The packets to send.
+
+        Returns:
+            bytes: The framed packets, back to back.
+        """
+        return frame_many(packet.prep() for packet in packets)
+
     def verify(self):
         raise NotImplementedError("Must be implemented by subclass")
 
@@ -63,18 +289,117 @@ class BasePacket(object):
 
     @classmethod
     def decode(cls, data: bytes) -> Union["BasePacket", "MessagePacket", None]:
+        """
+        Decodes a JSON or binary payload, detecting the format from its first byte.
 
+        Args:
+            data (bytes): The encoded packet, without its frame header.
+
+        Returns:
+            BasePacket | None: The packet, or None if it could not be decoded.
+        """
         try:
-            data = json.loads(data.decode())
+            if data[0] == BINARY_MARKER:
+                _, type_id = BINARY_HEADER.unpack_from(data)
+                packet_cls = cls.type_ids[type_id]
+                data = unpackb(data[BINARY_HEADER.size :])
+                data["type"] = packet_cls.__name__
+                return packet_cls(data)
+            data = json.loads(bytes(data))
             return cls.subclasses[data.get("type")](data)
-        except (KeyError, AssertionError, json.JSONDecodeError):
+        except (
+            KeyError,
+            IndexError,
+            TypeError,
+            AttributeError,
+            AssertionError,
+            ValueError,
+            struct.error,
+            DecodeError,
+        ):
+            return None
+
+    @classmethod
+    def view(cls, data: bytes | memoryview) -> Union["BasePacket", None]:
+        """
+        Creates a packet from a payload without parsing its body.
+
+        Only the type is read: from the header of binary payloads, or from
+        a leading or trailing ``"type"`` key of JSON payloads. The body is
+        parsed the first time ``data`` is read; one that doesn't decode to
+        that type reads as an empty dict, which fails ``verify``. See
+        ``forwardable`` for relaying ``raw`` as is. Payloads whose type can't
+        be found this way are decoded in full.
+
+        Args:
+            data (bytes | memoryview): The encoded packet, without its frame header.
+
+        Returns:
+            BasePacket | None: The packet, or None if it could not be decoded.
+        """
+        packet_cls = cls.peek_type(data)
+        if packet_cls is None:
+            return cls.decode(data)
+        packet = packet_cls.__new__(packet_cls)
+        packet.raw = data
+        return packet
+
+    @classmethod
+    def peek_type(cls, data: bytes | memoryview) -> Union[type, None]:
+        """
+        Reads a payload's packet class without parsing it.
+
+        Args:
+            data (bytes | memoryview): The encoded packet.
+
+        Returns:
+            type | None: The packet class, or None if it isn't known cheaply.
+        """
+        if not data:
             return None
+        if data[0] == BINARY_MARKER:
+            if len(data) < BINARY_HEADER.size:
+                return None
+            _, type_id = BINARY_HEADER.unpack_from(data)
+            if type_id < len(cls.type_ids):
+                return cls.type_ids[type_id]
+            return None
+        match = _JSON_TYPE_TAIL.search(
+            data, max(0, len(data) - _JSON_TYPE_TAIL_SCAN)
+        ) or _JSON_TYPE_HEAD.match(data)
+        if match is None:
+            return None
+        return cls.subclasses.get(match.group(1).decode())
+
+    def _load(self, data: bytes | memoryview) -> dict:
+        packet = BasePacket.decode(data)
+        if packet is None or packet.__class__ is not self.__class__:
+            # Undecodable, or its "type" key isn't the one peek_type read:
+            # an empty body, which fails verify() like any invalid packet.
+            return {}
+        self._parsed = dict(packet.data)
+        return packet.data
+
+    def forwardable(self) -> bytes | None:
+        """
+        Returns the payload of a received packet if it can be relayed as is.
+
+        The body is parsed and verified first; only a payload that decodes
+        to this packet type, passes ``verify`` and whose fields weren't
+        changed since they were parsed is returned. Anything else must be
+        encoded again from ``data``.
+
+        Returns:
+            bytes | memoryview | None: The payload, or None.
+        """
+        if self.raw is None or not self.verify() or self._data != self._parsed:
+            return None
+        return self.raw
 
     @classmethod
     def get_type(cls):
-        for subcls_name, _ in cls.subclasses.items():
-            if subcls_name == cls.__name__:
-                return subcls_name
+        if cls.__name__ in cls.subclasses:
+            return cls.__name__
         raise NotImplementedError("Must be implemented by subclass")
 
 
@@ -110,6 +435,317 @@ class KickPacket(BasePacket):
             return False
 
 
+class HelloPacket(BasePacket):
+    """Handshake packet. Clients offer ``codecs`` and the server answers with the chosen ``codec``.
+
+    Clients may also offer ``compression`` methods; the server answers with
+    the one it uses from then on, if any (see common.compression).
+    """
+
+    def __init__(self, data):
+        super().__init__(data)
+
+    def verify(self):
+        try:
+            assert isinstance(self.data, dict)
+            assert self.data.get("type") == self.get_type()
+            assert isinstance(self.data.get("codecs"), list) or isinstance(
+                self.data.get("codec"), str
+            )
+            return True
+        except AssertionError:
+            return False
+
+
+class ChannelJoinPacket(BasePacket):
+    """Extension of BasePacket that asks the server to add the user to a ``channel``."""
+
+    def __init__(self, data):
+        super().__init__(data)
+
+    def verify(self):
+        try:
+            assert isinstance(self.data, dict)
+            assert self.data.get("type") == self.get_type()
+            assert isinstance(self.data.get("channel"), str)
+            assert self.data.get("channel")
+            return True
+        except AssertionError:
+            return False
+
+
+class ChannelLeavePacket(BasePacket):
+    """Extension of BasePacket that asks the server to remove the user from a ``channel``."""
+
+    def __init__(self, data):
+        super().__init__(data)
+
+    def verify(self):
+        try:
+            assert isinstance(self.data, dict)
+            assert self.data.get("type") == self.get_type()
+            assert isinstance(self.data.get("channel"), str)
+            assert self.data.get("channel")
+            return True
+        except AssertionError:
+            return False
+
+
+class ChannelMessagePacket(BasePacket):
+    """Extension of BasePacket that carries a str message to the members of a ``channel``."""
+
+    def __init__(self, data):
+        super().__init__(data)
+
+    def verify(self):
+        try:
+            assert isinstance(self.data, dict)
+            assert self.data.get("type") == self.get_type()
+            assert isinstance(self.data.get("channel"), str)
+            assert self.data.get("channel")
+            assert self.data.get("content")
+            return True
+        except AssertionError:
+            return False
+
+
+class SearchPacket(BasePacket):
+    """Asks the server for past messages containing every word of ``query``.
+
+    Optional ``limit`` caps the results and ``before`` continues from the
+    ``next`` cursor of a previous SearchResultPacket.
+    """
+
+    def __init__(self, data):
+        super().__init__(data)
+
+    def verify(self):
+        try:
+            assert isinstance(self.data, dict)
+            assert self.data.get("type") == self.get_type()
+            assert isinstance(self.data.get("query"), str)
+            assert self.data.get("query")
+            assert isinstance(self.data.get("limit", 0), int)
+            assert isinstance(self.data.get("before", 0), (int, type(None)))
+            return True
+        except AssertionError:
+            return False
+
+
+class SearchResultPacket(BasePacket):
+    """Answers a SearchPacket with matching messages, newest first.
+
+    ``results`` holds ``{"seq": int, "content": str}`` items and ``next`` is
+    the cursor for the following page, or None on the last page.
+    """
+
+    def __init__(self, data):
+        super().__init__(data)
+
+    def verify(self):
+        try:
+            assert isinstance(self.data, dict)
+            assert self.data.get("type") == self.get_type()
+            assert isinstance(self.data.get("results"), list)
+            return True
+        except AssertionError:
+            return False
+
+
+class StatsPacket(BasePacket):
+    """Asks the server for its runtime metrics, and carries them back in ``stats``.
+
+    Only answered for admins: clients connecting from an admin host, or
+    sending the server's admin ``token``.
+    """
+
+    def __init__(self, data):
+        super().__init__(data)
+
+    def verify(self):
+        try:
+            assert isinstance(self.data, dict)
+            assert self.data.get("type") == self.get_type()
+            assert isinstance(self.data.get("token", ""), str)
+            assert isinstance(self.data.get("stats", {}), dict)
+            return True
+        except AssertionError:
+            return False
+
+
+class ProfilePacket(BasePacket):
+    """Asks the server to profile its reactor, and answers with the profile's ``path``.
+
+    Optional ``seconds`` and ``mode`` (``sample`` or ``pstats``) override the
+    server's defaults. Only answered for admins, like StatsPacket; the answer
+    comes once the profile is written, or with an ``error``.
+    """
+
+    def __init__(self, data):
+        super().__init__(data)
+
+    def verify(self):
+        try:
+            assert isinstance(self.data, dict)
+            assert self.data.get("type") == self.get_type()
+            assert isinstance(self.data.get("token", ""), str)
+            assert isinstance(self.data.get("seconds", 0), (int, float))
+            assert isinstance(self.data.get("mode", ""), str)
+            return True
+        except AssertionError:
+            return False
+
+
+class SessionPacket(BasePacket):
+    """Issues and resumes sessions.
+
+    Once a user joined, the server sends its session ``token``, its ``id`` and
+    the ``seq`` of the latest chat message. Chat messages carry their ``seq``.
+    A reconnecting client sends the ``token`` and the ``seq`` of the last
+    message it handled as its first packet after the HelloPacket, and gets
+    its id and channels back along with the messages it missed; the answer
+    says whether it was ``resumed`` and how many messages were ``missed``.
+    A SessionPacket without a token just asks to join right away.
+    """
+
+    def __init__(self, data):
+        super().__init__(data)
+
+    def verify(self):
+        try:
+            assert isinstance(self.data, dict)
+            assert self.data.get("type") == self.get_type()
+            assert isinstance(self.data.get("token", ""), str)
+            assert isinstance(self.data.get("seq", 0), int)
+            return True
+        except AssertionError:
+            return False
+
+
+class AckPacket(BasePacket):
+    """Tells the server the ``seq`` of the last chat message the client handled."""
+
+    def __init__(self, data):
+        super().__init__(data)
+
+    def verify(self):
+        try:
+            assert isinstance(self.data, dict)
+            assert self.data.get("type") == self.get_type()
+            assert isinstance(self.data.get("seq"), int)
+            return True
+        except AssertionError:
+            return False
+
+
+class PingPacket(BasePacket):
+    """Asks the other side to answer with a PongPacket.
+
+    The server pings connections it hasn't heard from for a while and drops
+    those that stay silent. Anything in ``data`` besides the type, such as a
+    ``time``, is echoed back in the PongPacket.
+    """
+
+    def __init__(self, data=None):
+        super().__init__(data if data is not None else {})
+
+    def verify(self):
+        try:
+            assert isinstance(self.data, dict)
+            assert self.data.get("type") == self.get_type()
+            return True
+        except AssertionError:
+            return False
+
+
+class PongPacket(BasePacket):
+    """Answers a PingPacket, echoing its data."""
+
+    def __init__(self, data=None):
+        super().__init__(data if data is not None else {})
+
+    def verify(self):
+        try:
+            assert isinstance(self.data, dict)
+            assert self.data.get("type") == self.get_type()
+            return True
+        except AssertionError:
+            return False
+
+
+class Codec(object):
+    """Encodes packets in one wire format.
+
+    Decoding needs no codec: BasePacket.decode detects the format of each payload,
+    so peers using different codecs can share a server.
+    """
+
+    name = None
+
+    def encode(self, packet: BasePacket) -> bytes:
+        raise NotImplementedError("Must be implemented by subclass")
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.name}>"
+
+
+class JsonCodec(Codec):
+    """The default codec, understood by every client."""
+
+    name = "json"
+
+    def encode(self, packet: BasePacket) -> bytes:
+        return packet.prep()
+
+
+class BinaryCodec(Codec):
+    """Struct header with a type id followed by a MessagePack body."""
+
+    name = "binary"
+
+    def encode(self, packet: BasePacket) -> bytes:
+        return packet.prep_binary()
+
+
+CODECS = {codec.name: codec for codec in (BinaryCodec(), JsonCodec())}
+"""Known codecs, in default order of preference."""
+DEFAULT_CODEC = CODECS["json"]
+
+
+def payload_codec(data: bytes | memoryview) -> Codec:
+    """
+    Returns the codec an encoded payload was written with.
+
+    Args:
+        data (bytes | memoryview): The encoded packet.
+
+    Returns:
+        Codec: The binary codec if the payload starts with BINARY_MARKER, otherwise JSON.
+    """
+    if data and data[0] == BINARY_MARKER:
+        return CODECS["binary"]
+    return CODECS["json"]
+
+
+def negotiate_codec(offered: Iterable[str], allowed: Iterable[str] = None) -> Codec:
+    """
+    Picks the codec for a connection during the handshake.
+
+    Args:
+        offered (Iterable[str]): Codec names the peer supports.
+        allowed (Iterable[str]): Codec names we accept, in order of preference.
+            Defaults to every known codec.
+
+    Returns:
+        Codec: The first allowed codec the peer offered, otherwise DEFAULT_CODEC.
+    """
+    offered = set(offered)
+    for name in allowed if allowed is not None else CODECS:
+        if name in offered and name in CODECS:
+            return CODECS[name]
+    return DEFAULT_CODEC
+
+
 if __name__ == "__main__":
     from rich.console import Console
     from rich.table import Table
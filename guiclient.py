@@ -4,37 +4,102 @@ from tkinter import simpledialog
 from twisted.internet import protocol, reactor
 from twisted.internet.protocol import connectionDone
 from twisted.python.failure import Failure
-from common.packets import BasePacket, MessagePacket
+from common.compression import DEFLATE, MAX_GROUPS, Inflater
+from common.packets import (
+    CODECS,
+    DEFAULT_CODEC,
+    BasePacket,
+    FrameError,
+    HelloPacket,
+    MessagePacket,
+    PacketBuffer,
+    PongPacket,
+    SearchPacket,
+    SessionPacket,
+    frame,
+)
+
+RECONNECT_DELAY = 1.0
+"""Seconds before reconnecting to resume the session after the connection is lost."""
 
 
 class ChatClient(protocol.Protocol):
-    def __init__(self, app) -> None:
+    def __init__(self, app, factory) -> None:
         self.app = app
-        reactor.callInThread(self.write_msg)
+        self.factory = factory
+        self.buffer = PacketBuffer()
+        self.codec = DEFAULT_CODEC
+        self.inflater = None
 
     def dataReceived(self, data):
-        packet = BasePacket.decode(data)
-        if packet is None:
-            return
+        try:
+            for payload in self.buffer.feed(data):
+                # The inflater is set by the HelloPacket answer, so check per frame.
+                if self.inflater is None:
+                    payloads = (payload,)
+                else:
+                    payloads = self.inflater.payloads(payload)
+                for payload in payloads:
+                    packet = BasePacket.decode(payload)
+                    if packet is not None:
+                        self.handle_packet(packet)
+        except FrameError:
+            self.transport.loseConnection()
+
+    def handle_packet(self, packet: BasePacket):
+        if packet.type == "HelloPacket":
+            self.codec = CODECS.get(packet.data.get("codec"), DEFAULT_CODEC)
+            if packet.data.get("compression") == DEFLATE:
+                groups = packet.data.get("groups")
+                self.inflater = Inflater(groups if isinstance(groups, int) else MAX_GROUPS)
+        if packet.type == "SessionPacket":
+            self.factory.session = packet.data
+            if packet.data.get("resumed"):
+                missed = packet.data["missed"]
+                if not packet.data["complete"]:
+                    self.app.display_message("||| Some messages were missed |||")
+                self.app.display_message(f"||| Resumed, {missed} missed messages |||")
+        if "seq" in packet.data and self.factory.session is not None:
+            self.factory.session["seq"] = packet.data["seq"]
+        if packet.type == "PingPacket":
+            data = dict(packet.data)
+            data.pop("type", None)
+            self.transport.write(frame(self.codec.encode(PongPacket(data))))
         if packet.type == "MessagePacket":
             self.app.display_message(packet.data["content"])
+        if packet.type == "SearchResultPacket":
+            for result in reversed(packet.data["results"]):
+                self.app.display_message(f"[#{result['seq']}] {result['content']}")
+            if not packet.data["results"]:
+                self.app.display_message("No messages found.")
         if packet.type == "KickPacket":
             self.app.display_message(packet.data["reason"])
+            self.factory.session = None
+            self.factory.kicked = True
             self.transport.loseConnection()
 
     def connectionMade(self):
         self.app.display_message("||| Connected |||")
+        self.transport.write(
+            HelloPacket({"codecs": list(CODECS), "compression": [DEFLATE]}).pack()
+        )
+        # Resume the previous session, or join right away without one.
+        session = self.factory.session
+        if session is not None:
+            resume = {"token": session["token"], "seq": session["seq"]}
+        else:
+            resume = {}
+        self.transport.write(SessionPacket(resume).pack())
 
     def connectionLost(self, reason: Failure = ...) -> None:
         self.app.display_message("||| Disconnected |||")
 
     def send(self, msg):
-        msg = MessagePacket({"content": msg})
-        self.transport.write(msg.prep())
-
-    def write_msg(self):
-        while True:
-            self.send(input(""))
+        if msg.startswith("/search "):
+            msg = SearchPacket({"query": msg[len("/search ") :]})
+        else:
+            msg = MessagePacket({"content": msg})
+        self.transport.write(frame(self.codec.encode(msg)))
 
 
 class ChatClientFactory(protocol.ClientFactory):
@@ -42,13 +107,26 @@ class ChatClientFactory(protocol.ClientFactory):
         super().__init__()
         self.app = app
         self.client_protocol = None  # Initialize client_protocol attribute
+        self.session = None  # Token and last seq sent by the server, to resume
+        self.kicked = False
+        reactor.callInThread(self.write_msg)
 
     protocol = ChatClient
 
     def buildProtocol(self, addr) -> ChatClient | None:
-        self.client_protocol = ChatClient(self.app)  # Store the ChatClient instance
+        self.client_protocol = ChatClient(self.app, self)  # Store the ChatClient instance
         return self.client_protocol
 
+    def clientConnectionLost(self, connector, reason):
+        if self.session is not None and not self.kicked:
+            reactor.callLater(RECONNECT_DELAY, connector.connect)
+
+    def write_msg(self):
+        while True:
+            message = input("")
+            if self.client_protocol is not None:
+                reactor.callFromThread(self.client_protocol.send, message)
+
 
 class ChatApp(tk.Tk):
     def __init__(self):
@@ -0,0 +1,450 @@
+"""Pub/sub backplane joining several server nodes into one chat.
+
+Broadcasts, channel messages, kicks and presence go through
+``ServerFactory.backplane``. A lone
+server uses LocalBackplane, which does nothing. Worker processes
+(``main.py --workers N``) and clustered servers use BrokerBackplane: every
+node connects to a small Broker (``main.py --broker ENDPOINT``), which relays
+messages between nodes and keeps the user directory that late joiners are
+synced from. Messages are framed MessagePack and are batched into a single
+write per reactor tick in both directions.
+
+A node's first message is a hello with its name and the cluster's shared
+secret (``[Cluster] secret``); the broker drops peers whose secret doesn't
+match, and relays nothing to or from a peer before its hello.
+
+Broadcasts travel as the framed packet already written to local users, and
+receiving nodes relay those bytes through lazy packet views, so nodes don't
+parse relayed chat at all. Relayed packets are emitted as ``Remote.<type>``
+with the packet and the name of the node it came from.
+"""
+
+import hmac
+import logging
+from typing import Dict, Set, Tuple
+
+from twisted.application.internet import ClientService
+from twisted.internet.endpoints import clientFromString
+from twisted.internet.protocol import Factory, Protocol
+from twisted.internet.protocol import ServerFactory as ServFactory
+
+from common.codecs import DecodeError, packb, unpackb
+from common.packets import FRAME_HEADER, BasePacket, FrameError, PacketBuffer, frame
+
+logger = logging.getLogger("Server")
+
+
+class Backplane:
+    """
+    Interface between a node's UserRegistry and the rest of the cluster.
+
+    The base class is the single node case: nothing is published and no
+    remote users exist.
+    """
+
+    node = "local"
+    clustered = False
+    """Whether other nodes exist that broadcasts must be published to."""
+
+    def start(self, reactor) -> None:
+        """Connects to the cluster, if there is one."""
+
+    def stop(self) -> None:
+        """Disconnects from the cluster."""
+
+    def broadcast(self, wire: bytes) -> None:
+        """
+        Hands a framed packet to the other nodes for their local users.
+
+        Args:
+            wire (bytes): The framed packet, as written to local users.
+        """
+
+    def channel(self, name: str, wire: bytes) -> None:
+        """
+        Hands a framed packet to the other nodes for their members of a channel.
+
+        Args:
+            name (str): Name of the channel.
+            wire (bytes): The framed packet, as written to local members.
+        """
+
+    def kick(self, id_: int, reason: str) -> bool:
+        """
+        Kicks a user connected to another node.
+
+        Args:
+            id_ (str): The user ID.
+            reason (str): Reason for the kick.
+
+        Returns:
+            bool: Whether the user is known to another node.
+        """
+        return False
+
+    def joined(self, user) -> None:
+        """Announces a user registered on this node."""
+
+    def left(self, user) -> None:
+        """Announces a user removed from this node."""
+
+    def has_username(self, username: str) -> bool:
+        """Whether a user on another node has this username."""
+        return False
+
+    def locate(self, id_: int) -> str | None:
+        """Returns the node a remote user is connected to, if known."""
+        return None
+
+    @property
+    def remote_count(self) -> int:
+        """Number of users connected to other nodes."""
+        return 0
+
+
+class LocalBackplane(Backplane):
+    """In-process stand-in used when the server runs as a single node."""
+
+
+class BusProtocol(Protocol):
+    """Framed MessagePack messages between a node and the broker, batched per tick."""
+
+    def connectionMade(self) -> None:
+        self.buffer = PacketBuffer()
+        self.pending = []
+        self.flushing = None
+        self.factory.connected(self)
+
+    def dataReceived(self, data: bytes) -> None:
+        try:
+            payloads = self.buffer.feed(data)
+        except FrameError as e:
+            logger.warning(f"Backplane: {e}")
+            self.transport.loseConnection()
+            return
+        for payload in payloads:
+            try:
+                message = unpackb(payload)
+            except DecodeError:
+                continue
+            if isinstance(message, dict):
+                self.factory.received(self, message, payload)
+
+    def connectionLost(self, reason) -> None:
+        if self.flushing is not None and self.flushing.active():
+            self.flushing.cancel()
+        self.factory.disconnected(self)
+
+    def send(self, message: dict) -> None:
+        self.send_frame(frame(packb(message)))
+
+    def send_frame(self, data: bytes) -> None:
+        """Queues a framed message for the write at the end of this tick."""
+        self.pending.append(data)
+        if self.flushing is None:
+            from twisted.internet import reactor
+
+            self.flushing = reactor.callLater(0, self.flush)
+
+    def flush(self) -> None:
+        self.flushing = None
+        pending, self.pending = self.pending, []
+        if pending:
+            self.transport.write(b"".join(pending))
+
+
+class Broker(ServFactory):
+    """
+    Relays messages between nodes and keeps the cluster's user directory.
+
+    Broadcasts and presence go to every other node. Kicks go only to the node
+    the user is connected to. Nodes connecting later receive a snapshot of
+    everyone's presence.
+    """
+
+    protocol = BusProtocol
+
+    def __init__(self, secret: str = "") -> None:
+        """
+        Initializes a new Broker instance.
+
+        Args:
+            secret (str): Secret nodes must send in their hello. Empty accepts
+                any node, for brokers only reachable by trusted processes.
+        """
+        self.secret = secret
+        self.peers: Dict[BusProtocol, str | None] = {}
+        """Node name of every connected peer, None until its hello."""
+        self.nodes: Dict[str, BusProtocol] = {}
+        self.directory: Dict[str, Dict[str, str | None]] = {}
+        """Users of each node, ``{node: {id: username}}``."""
+        self.owners: Dict[str, str] = {}
+        """Node of each user ID."""
+
+    def connected(self, peer: BusProtocol) -> None:
+        self.peers[peer] = None
+
+    def disconnected(self, peer: BusProtocol) -> None:
+        node = self.peers.pop(peer, None)
+        if node is None or self.nodes.get(node) is not peer:
+            return
+        del self.nodes[node]
+        for id_ in self.directory.pop(node, {}):
+            if self.owners.get(id_) == node:
+                del self.owners[id_]
+        self.relay(None, frame(packb({"op": "presence", "node": node, "reset": True})))
+
+    def received(self, peer: BusProtocol, message: dict, payload) -> None:
+        op = message.get("op")
+        if self.peers.get(peer) is None:
+            if op == "hello":
+                self._hello(peer, message)
+            else:
+                logger.warning("Backplane: dropping a peer that sent no hello.")
+                peer.transport.loseConnection()
+            return
+        if op == "hello":
+            return
+        if op == "presence":
+            message = self._update_directory(peer, message)
+            if message is not None:
+                self.relay(peer, frame(packb(message)))
+            return
+        if op == "kick":
+            target = self.nodes.get(self.owners.get(message.get("id")))
+            if target is not None:
+                target.send_frame(frame(payload))
+            return
+        self.relay(peer, frame(payload))
+
+    def _hello(self, peer: BusProtocol, message: dict) -> None:
+        node = message.get("node")
+        secret = message.get("secret", "")
+        if (
+            not isinstance(node, str)
+            or not isinstance(secret, str)
+            or not hmac.compare_digest(secret.encode(), self.secret.encode())
+        ):
+            logger.warning("Backplane: refused a node with a bad hello or secret.")
+            peer.transport.loseConnection()
+            return
+        self.peers[peer] = node
+        self.nodes[node] = peer
+        for other, users in self.directory.items():
+            peer.send(
+                {
+                    "op": "presence",
+                    "node": other,
+                    "reset": True,
+                    "join": list(users.items()),
+                }
+            )
+
+    def relay(self, sender: BusProtocol | None, data: bytes) -> None:
+        for peer in self.nodes.values():
+            if peer is not sender:
+                peer.send_frame(data)
+
+    def _update_directory(self, peer: BusProtocol, message: dict) -> dict | None:
+        """
+        Applies a node's presence change to the directory.
+
+        The change applies to the node the peer said hello as, whatever its
+        ``node`` field says.
+
+        Args:
+            peer (BusProtocol): The node's connection.
+            message (dict): The presence message.
+
+        Returns:
+            dict | None: The change as relayed to the other nodes, or None if
+            it was malformed.
+        """
+        node = self.peers[peer]
+        join = message.get("join", [])
+        leave = message.get("leave", [])
+        if not (
+            isinstance(join, list)
+            and isinstance(leave, list)
+            and all(
+                isinstance(entry, list)
+                and len(entry) == 2
+                and isinstance(entry[0], (int, str))
+                and isinstance(entry[1], (str, type(None)))
+                for entry in join
+            )
+            and all(isinstance(id_, (int, str)) for id_ in leave)
+        ):
+            logger.warning(f"Backplane: ignoring malformed presence from {node}.")
+            return None
+        reset = bool(message.get("reset"))
+        users = self.directory.setdefault(node, {})
+        if reset:
+            for id_ in users:
+                if self.owners.get(id_) == node:
+                    del self.owners[id_]
+            users.clear()
+        for id_, username in join:
+            users[id_] = username
+            self.owners[id_] = node
+        for id_ in leave:
+            users.pop(id_, None)
+            if self.owners.get(id_) == node:
+                del self.owners[id_]
+        return {"op": "presence", "node": node, "reset": reset, "join": join, "leave": leave}
+
+
+class BrokerBackplane(Factory, Backplane):
+    """
+    Backplane that connects to a Broker over any Twisted client endpoint.
+
+    Keeps a replica of the directory of users on other nodes so the
+    username precheck, ``online_count`` and kicks never wait on the network.
+    """
+
+    protocol = BusProtocol
+    clustered = True
+
+    def __init__(self, server, endpoint: str, node: str, secret: str = "") -> None:
+        """
+        Initializes a new BrokerBackplane instance.
+
+        Args:
+            server (ServerFactory): This node's server.
+            endpoint (str): Twisted client endpoint of the broker, e.g.
+                ``tcp:host=10.0.0.5:port=4050`` or ``unix:path=/tmp/bus.sock``.
+            node (str): Name of this node, unique in the cluster.
+            secret (str): The cluster's shared secret, sent in the hello.
+        """
+        from app.factory import ServerFactory as Server
+
+        self.server: Server = server
+        self.endpoint = endpoint
+        self.node = node
+        self.secret = secret
+        self.peer: BusProtocol | None = None
+        self.service: ClientService | None = None
+
+        self.remote_users: Dict[int, Tuple[str, str | None]] = {}
+        """Users on other nodes, ``{id: (node, username)}``."""
+        self.remote_names: Dict[str, int] = {}
+        """User ID of each username on other nodes."""
+        self._ids_by_node: Dict[str, Set[int]] = {}
+
+    def start(self, reactor) -> None:
+        self.service = ClientService(clientFromString(reactor, self.endpoint), self)
+        self.service.startService()
+
+    def stop(self) -> None:
+        if self.service is not None:
+            return self.service.stopService()
+
+    def connected(self, peer: BusProtocol) -> None:
+        self.peer = peer
+        peer.send({"op": "hello", "node": self.node, "secret": self.secret})
+        peer.send(
+            {
+                "op": "presence",
+                "node": self.node,
+                "reset": True,
+                "join": [
+                    (user.info.id, user.info.username) for user in self.server.users
+                ],
+            }
+        )
+
+    def disconnected(self, peer: BusProtocol) -> None:
+        if self.peer is peer:
+            self.peer = None
+            logger.warning(f"Backplane: lost connection to broker {self.endpoint}")
+
+    def received(self, peer: BusProtocol, message: dict, payload) -> None:
+        op = message.get("op")
+        if op == "broadcast":
+            packet = BasePacket.view(message["frame"][FRAME_HEADER.size :])
+            if packet is not None:
+                self.server.users.fanout(packet, self.server.users, "*")
+                self.server.events.emit(f"Remote.{packet.type}", packet, message.get("node"))
+        elif op == "channel":
+            name = message.get("name")
+            packet = BasePacket.view(message["frame"][FRAME_HEADER.size :])
+            if packet is not None and isinstance(name, str):
+                channel = self.server.channels.get(name)
+                if channel is not None:
+                    self.server.users.fanout(packet, channel.members.values(), f"#{name}")
+                self.server.events.emit(f"Remote.{packet.type}", packet, message.get("node"))
+        elif op == "presence":
+            self._apply_presence(message)
+        elif op == "kick":
+            self.server.users.kick_user(message["id"], message.get("reason"))
+
+    def publish(self, message: dict) -> None:
+        """
+        Sends a message to the broker. Dropped while disconnected; the full
+        presence snapshot sent on reconnect makes up for lost presence changes.
+
+        Args:
+            message (dict): The backplane message.
+        """
+        if self.peer is not None:
+            self.peer.send(message)
+
+    def broadcast(self, wire: bytes) -> None:
+        self.publish({"op": "broadcast", "node": self.node, "frame": wire})
+
+    def channel(self, name: str, wire: bytes) -> None:
+        self.publish({"op": "channel", "node": self.node, "name": name, "frame": wire})
+
+    def kick(self, id_: int, reason: str) -> bool:
+        if id_ not in self.remote_users:
+            return False
+        self.publish({"op": "kick", "id": id_, "reason": reason})
+        return True
+
+    def joined(self, user) -> None:
+        self.publish(
+            {
+                "op": "presence",
+                "node": self.node,
+                "join": [(user.info.id, user.info.username)],
+            }
+        )
+
+    def left(self, user) -> None:
+        self.publish(
+            {"op": "presence", "node": self.node, "leave": [user.info.id]}
+        )
+
+    def has_username(self, username: str) -> bool:
+        return username in self.remote_names
+
+    def locate(self, id_: int) -> str | None:
+        entry = self.remote_users.get(id_)
+        return entry[0] if entry is not None else None
+
+    @property
+    def remote_count(self) -> int:
+        return len(self.remote_users)
+
+    def _forget(self, id_: int) -> None:
+        node, username = self.remote_users.pop(id_)
+        if username is not None and self.remote_names.get(username) == id_:
+            del self.remote_names[username]
+        self._ids_by_node[node].discard(id_)
+
+    def _apply_presence(self, message: dict) -> None:
+        node = message["node"]
+        ids = self._ids_by_node.setdefault(node, set())
+        if message.get("reset"):
+            for id_ in tuple(ids):
+                self._forget(id_)
+        for id_, username in message.get("join", ()):
+            if id_ in self.remote_users:
+                self._forget(id_)
+            self.remote_users[id_] = (node, username)
+            ids.add(id_)
+            if username is not None:
+                self.remote_names[username] = id_
+        for id_ in message.get("leave", ()):
+            if id_ in self.remote_users:
+                self._forget(id_)
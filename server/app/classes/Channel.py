@@ -0,0 +1,32 @@
+from typing import Dict
+
+
+class Channel:
+    """
+    A named room and the users currently in it.
+    """
+
+    __slots__ = ("name", "members")
+
+    def __init__(self, name: str) -> None:
+        """
+        Initializes a new Channel instance.
+
+        Args:
+            name (str): Name of the channel.
+        """
+        self.name = name
+        self.members: Dict[str, "UserProtocol"] = {}
+        """Members keyed by ``info.id``."""
+
+    def __contains__(self, user) -> bool:
+        return self.members.get(user.info.id) is user
+
+    def __len__(self) -> int:
+        return len(self.members)
+
+    def __iter__(self):
+        return iter(self.members.values())
+
+    def __repr__(self) -> str:
+        return f"<Channel {self.name} ({len(self.members)} members)>"
@@ -0,0 +1,170 @@
+from app.classes.Channel import Channel
+from app.classes.UserProtocol import NO_CHANNELS, UserProtocol
+from common.packets import (
+    DEFAULT_CODEC,
+    ChannelJoinPacket,
+    ChannelLeavePacket,
+    ChannelMessagePacket,
+    frame,
+)
+from common.registry import BaseRegistry
+
+
+class ChannelRegistry(BaseRegistry[Channel]):
+
+    def __init__(self, server, max_per_user: int = 0, max_name_length: int = 0) -> None:
+        """
+        Initializes a new ChannelRegistry instance.
+
+        Manages the open channels. A channel exists while it has members, and
+        each user keeps the names of the channels it sits in, so joins, leaves
+        and disconnect cleanup are O(1) per channel.
+
+        Args:
+            server (Server): Reference to the server instance.
+            max_per_user (int): Most channels one user may sit in. 0 is unlimited.
+            max_name_length (int): Longest channel name accepted. 0 is unlimited.
+        """
+        from app.factory import ServerFactory as Server
+
+        super().__init__()
+        self.server: Server = server
+        self.max_per_user = max_per_user
+        self.max_name_length = max_name_length
+
+    def join(self, user: UserProtocol, name: str) -> Channel:
+        """
+        Adds a user to a channel, opening the channel if needed.
+
+        Args:
+            user (UserProtocol): The user joining.
+            name (str): Name of the channel.
+
+        Returns:
+            Channel: The channel joined.
+        """
+        channel = self.get(name)
+        if channel is None:
+            channel = Channel(name)
+            self.register(name, channel)
+        channel.members[user.info.id] = user
+        if user.channels is NO_CHANNELS:
+            user.channels = set()
+        user.channels.add(name)
+        return channel
+
+    def leave(self, user: UserProtocol, name: str) -> None:
+        """
+        Removes a user from a channel, closing the channel once it is empty.
+
+        Args:
+            user (UserProtocol): The user leaving.
+            name (str): Name of the channel.
+        """
+        if name in user.channels:
+            user.channels.discard(name)
+        channel = self.get(name)
+        if channel is None or channel.members.get(user.info.id) is not user:
+            return
+        del channel.members[user.info.id]
+        if not channel.members:
+            self.remove(name)
+
+    def leave_all(self, user: UserProtocol) -> None:
+        """
+        Removes a user from every channel it is in.
+
+        Args:
+            user (UserProtocol): The user leaving.
+        """
+        for name in tuple(user.channels):
+            self.leave(user, name)
+
+    def rejoin(self, user: UserProtocol) -> None:
+        """
+        Puts an adopted user back into the channels it was in. Handles
+        ``Connection.Adopted``.
+
+        Args:
+            user (UserProtocol): The adopted user, with the names of its channels.
+        """
+        for name in tuple(user.channels):
+            self.join(user, name)
+
+    def send(self, name: str, data) -> None:
+        """
+        Sends data to the members of a channel, encoding it once per codec.
+
+        In a cluster the packet is also published for the channel's members
+        on other nodes.
+
+        Args:
+            name (str): Name of the channel.
+            data (str | bytes | dict | BasePacket): The data to send.
+        """
+        channel = self.get(name)
+        members = channel.members.values() if channel is not None else ()
+        result = self.server.users.fanout(data, members, f"#{name}")
+        backplane = self.server.backplane
+        if result is not None and backplane.clustered:
+            packet, wires = result
+            wire = wires.get(DEFAULT_CODEC) or next(iter(wires.values()), None)
+            if wire is None:
+                wire = frame(DEFAULT_CODEC.encode(packet))
+            backplane.channel(name, wire)
+
+    def refusal(self, user: UserProtocol, name: str) -> str | None:
+        """
+        Checks a join against the channel limits.
+
+        Args:
+            user (UserProtocol): The user joining.
+            name (str): Name of the channel.
+
+        Returns:
+            str | None: Why the join is refused, or None if it is allowed.
+        """
+        if self.max_name_length and len(name) > self.max_name_length:
+            return f"Channel names are at most {self.max_name_length} characters."
+        if not name.isprintable() or any(char.isspace() for char in name):
+            return "Channel names may not contain spaces or control characters."
+        if (
+            self.max_per_user
+            and name not in user.channels
+            and len(user.channels) >= self.max_per_user
+        ):
+            return f"Users may join at most {self.max_per_user} channels."
+        return None
+
+    def on_join(self, packet: ChannelJoinPacket, user: UserProtocol) -> None:
+        """
+        Handles ``Recv.ChannelJoinPacket``, confirming the join to the user, or
+        answering with an ``error`` if it breaks a channel limit.
+        """
+        if not self.server.users.registered(user) or not packet.verify():
+            return
+        name = packet.data["channel"]
+        error = self.refusal(user, name)
+        if error is not None:
+            user.send(ChannelJoinPacket({"channel": name, "error": error}))
+            return
+        self.join(user, name)
+        user.send(ChannelJoinPacket({"channel": name}))
+
+    def on_leave(self, packet: ChannelLeavePacket, user: UserProtocol) -> None:
+        """Handles ``Recv.ChannelLeavePacket``, confirming the leave to the user."""
+        if not packet.verify():
+            return
+        self.leave(user, packet.data["channel"])
+        user.send(ChannelLeavePacket({"channel": packet.data["channel"]}))
+
+    def on_message(self, packet: ChannelMessagePacket, user: UserProtocol) -> None:
+        """Handles ``Recv.ChannelMessagePacket`` from a member of the channel."""
+        if (
+            not self.server.users.registered(user)
+            or not packet.verify()
+            or packet.data["channel"] not in user.channels
+        ):
+            return
+        packet.data["sender"] = str(user.info.username or user.info.id)
+        self.send(packet.data["channel"], packet)
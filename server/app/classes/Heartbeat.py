@@ -0,0 +1,189 @@
+import logging
+import math
+import time
+from twisted.internet.task import LoopingCall
+from common.packets import PingPacket, PongPacket
+from app.classes.TimingWheel import TimingWheel
+from app.classes.enums import UserState
+
+logger = logging.getLogger("Server")
+
+
+class Heartbeat:
+    """
+    Pings quiet connections, drops dead ones and marks idle users AFK.
+
+    A connection that sent nothing for ``ping_interval`` seconds is sent a
+    PingPacket every ``ping_interval`` seconds, which clients answer with a
+    PongPacket; one that sent nothing for ``idle_timeout`` seconds is
+    aborted, since a half-open connection would otherwise stay registered
+    and keep receiving broadcasts. A joined user that sent no chat message
+    for ``afk_timeout`` seconds is marked ``UserState.AFK`` until it does.
+    A timeout of 0 disables that check.
+
+    Reads only stamp ``UserProtocol.last_seen`` with ``now``, the time of
+    the last tick. Each connection has a single timer on a TimingWheel,
+    set for its next deadline and checked against the stamps when it is due,
+    and one LoopingCall advances the wheel every ``tick``.
+    """
+
+    def __init__(
+        self,
+        server,
+        tick: float = 1.0,
+        slots: int = 512,
+        ping_interval: float = 30.0,
+        idle_timeout: float = 90.0,
+        afk_timeout: float = 300.0,
+    ) -> None:
+        """
+        Initializes a new Heartbeat instance.
+
+        Args:
+            server (ServerFactory): The server whose connections are watched.
+            tick (float): Seconds between advances of the wheel, and so the
+                precision of every timeout.
+            slots (int): Slots of the wheel.
+            ping_interval (float): Seconds of silence before a connection is pinged.
+            idle_timeout (float): Seconds of silence before a connection is dropped.
+            afk_timeout (float): Seconds without a chat message before a user is AFK.
+        """
+        from app.factory import ServerFactory as Server
+
+        self.server: Server = server
+        self.ping_interval = ping_interval or math.inf
+        self.idle_timeout = idle_timeout or math.inf
+        self.afk_timeout = afk_timeout or math.inf
+        self.wheel = TimingWheel(tick, slots)
+        self.now = time.monotonic()
+        """Monotonic time of the last tick."""
+        self._loop = LoopingCall.withCount(self._tick)
+
+        self.pings = 0
+        self.timeouts = 0
+        self.afk = 0
+        self.back = 0
+
+    def attach(self, events) -> None:
+        """
+        Starts watching the server's connections.
+
+        Args:
+            events (EventHandler): The server's event handler.
+        """
+        events.on("Connection.Made", self.watch)
+        events.on("Connection.Adopted", self.watch)
+        events.on("Connection.Lost", self.forget)
+        events.on("Recv.PingPacket", self.on_ping)
+        events.on("Recv.MessagePacket", self.active)
+        events.on("Recv.ChannelMessagePacket", self.active)
+
+    def start(self) -> None:
+        """Starts advancing the wheel."""
+        if not self._loop.running:
+            self._loop.start(self.wheel.tick, now=False)
+
+    def stop(self) -> None:
+        """Stops advancing the wheel."""
+        if self._loop.running:
+            self._loop.stop()
+
+    def watch(self, user) -> None:
+        """
+        Starts the timer of a new connection. Handles ``Connection.Made``.
+
+        Args:
+            user (UserProtocol): The connection.
+        """
+        user.last_seen = user.last_active = self.now
+        due = min(self.ping_interval, self.idle_timeout, self.afk_timeout)
+        if due != math.inf:
+            self.wheel.schedule(user, due)
+
+    def forget(self, user) -> None:
+        """Cancels the timer of a lost connection. Handles ``Connection.Lost``."""
+        self.wheel.cancel(user)
+
+    def on_ping(self, packet: PingPacket, user) -> None:
+        """Answers a client's ping. Handles ``Recv.PingPacket``."""
+        if not packet.verify():
+            return
+        data = dict(packet.data)
+        data.pop("type", None)
+        user.send(PongPacket(data))
+
+    def active(self, packet, user) -> None:
+        """
+        Marks a user that sent a chat message as active, and back if it was AFK.
+
+        Args:
+            packet (BasePacket): The chat message.
+            user (UserProtocol): The user who sent it.
+        """
+        user.last_active = self.now
+        if user.state is UserState.AFK:
+            user.state = UserState.ONLINE
+            self.back += 1
+            if user not in self.wheel.where:
+                # Only the AFK check was left to time.
+                self.wheel.schedule(user, self.afk_timeout)
+            self.server.events.emit("User.Back", user)
+
+    def _tick(self, count: int) -> None:
+        self.now = time.monotonic()
+        wheel = self.wheel
+        # count is above 1 when the reactor was too busy to call us in time.
+        for _ in range(count):
+            for user in wheel.advance():
+                self.check(user)
+
+    def check(self, user) -> None:
+        """
+        Pings, drops or marks a connection AFK, then sets its next timer.
+
+        Args:
+            user (UserProtocol): The connection whose timer is due.
+        """
+        if user.outbound.closed:
+            return
+        now = self.now
+        quiet = now - user.last_seen
+        if quiet >= self.idle_timeout:
+            self.timeouts += 1
+            logger.info(f"[{user.info.id}] Nothing received for {quiet:.0f}s, dropping.")
+            user.outbound.close()
+            user.transport.abortConnection()
+            return
+        if quiet >= self.ping_interval:
+            self.pings += 1
+            user.send(PingPacket({"time": now}))
+            due = min(self.ping_interval, self.idle_timeout - quiet)
+        else:
+            due = min(self.ping_interval, self.idle_timeout) - quiet
+        if user.state is UserState.ONLINE and user.info.id in self.server.users:
+            idle = now - user.last_active
+            if idle >= self.afk_timeout:
+                user.state = UserState.AFK
+                self.afk += 1
+                self.server.events.emit("User.AFK", user)
+            else:
+                due = min(due, self.afk_timeout - idle)
+        if due != math.inf:
+            self.wheel.schedule(user, due)
+
+    def stats(self) -> dict:
+        """
+        Returns the heartbeat's counters.
+
+        Returns:
+            dict: Connections watched, pings sent, connections dropped, users
+            gone AFK and back, and the users AFK now.
+        """
+        return {
+            "watched": len(self.wheel),
+            "pings": self.pings,
+            "timeouts": self.timeouts,
+            "afk": self.afk,
+            "back": self.back,
+            "afk_now": sum(1 for user in self.server.users if user.state is UserState.AFK),
+        }
@@ -0,0 +1,338 @@
+import logging
+from collections import deque
+from zope.interface import implementer
+from twisted.internet.interfaces import IPushProducer
+from common.compression import Deflater
+from common.packets import KickPacket, MessagePacket, frame
+from app.classes.enums import OverflowPolicy
+from app.classes.WriteCoalescer import WriteCoalescer
+
+logger = logging.getLogger("Server")
+
+FLUSH_BATCH_BYTES = 64 * 1024
+"""Queued bytes compressed together when a compressed connection drains."""
+EMPTY = ()
+"""Stands in for the frames and the batch of a queue with none, so idle
+connections don't each hold an empty deque and list."""
+
+
+@implementer(IPushProducer)
+class OutboundQueue:
+    """
+    Bounded send buffer for one connection.
+
+    Registered with the transport as a streaming producer, so Twisted pauses
+    it once the socket stops draining. While paused, framed packets wait here
+    instead of piling up inside the transport, and the overflow policy decides
+    what happens once either limit is exceeded.
+
+    With a WriteCoalescer, what is written while the transport is not paused
+    is batched and handed to the transport once per reactor tick; urgent
+    writes flush the batch right away.
+    """
+
+    __slots__ = (
+        "user",
+        "max_bytes",
+        "max_packets",
+        "policy",
+        "coalescer",
+        "frames",
+        "bytes",
+        "paused",
+        "closed",
+        "batch",
+        "batch_bytes",
+        "batch_plain",
+        "deflater",
+        "peak_bytes",
+        "peak_packets",
+        "dropped",
+        "overflows",
+    )
+
+    def __init__(
+        self,
+        user,
+        max_bytes: int,
+        max_packets: int,
+        policy: OverflowPolicy = OverflowPolicy.DROP_OLDEST,
+        coalescer: WriteCoalescer = None,
+    ) -> None:
+        """
+        Initializes a new OutboundQueue instance.
+
+        Args:
+            user (UserProtocol): The connection this queue writes to.
+            max_bytes (int): Largest number of queued bytes.
+            max_packets (int): Largest number of queued frames.
+            policy (OverflowPolicy): What to do when a limit is exceeded.
+            coalescer (WriteCoalescer): Batches writes per reactor tick, if given.
+        """
+        self.user = user
+        self.max_bytes = max_bytes
+        self.max_packets = max_packets
+        self.policy = policy
+        self.coalescer = coalescer
+
+        self.frames: deque | tuple = EMPTY
+        """Queued ``(data, droppable)`` pairs, oldest first."""
+        self.bytes = 0
+        self.paused = False
+        self.closed = False
+        self.batch: list[bytes] | tuple = EMPTY
+        """Frames waiting for the coalescer's flush, oldest first."""
+        self.batch_bytes = 0
+        self.batch_plain = 0
+        """Index from which the batch holds frames not compressed yet."""
+        self.deflater: Deflater | None = None
+        """Set once the user agreed to compression. Queued frames are only
+        compressed on their way out, so dropping them never breaks the stream."""
+
+        self.peak_bytes = 0
+        self.peak_packets = 0
+        self.dropped = 0
+        self.overflows = 0
+
+    def attach(self, transport) -> None:
+        """
+        Registers the queue as the transport's streaming producer.
+
+        Args:
+            transport (ITransport): The connection's transport.
+        """
+        transport.registerProducer(self, True)
+
+    def write(self, data: bytes, droppable: bool = False, urgent: bool = False) -> None:
+        """
+        Writes framed bytes, queueing them while the transport is paused.
+
+        Args:
+            data (bytes): The framed packet(s).
+            droppable (bool): Whether the overflow policy may discard this frame.
+            urgent (bool): Write now instead of with this tick's batch.
+        """
+        if self.closed:
+            return
+        if not self.paused and not self.frames:
+            if self.coalescer is not None:
+                self._add(data, urgent)
+                return
+            if self.deflater is not None:
+                data = self.deflater.encode(data)
+            self.user.transport.write(data)
+            return
+
+        frames = self.frames
+        if frames is EMPTY:
+            frames = self.frames = deque()
+        frames.append((data, droppable))
+        self.bytes += len(data)
+        if self.bytes > self.peak_bytes:
+            self.peak_bytes = self.bytes
+        if len(frames) > self.peak_packets:
+            self.peak_packets = len(frames)
+        if self.bytes > self.max_bytes or len(frames) > self.max_packets:
+            self.overflow()
+
+    def write_shared(self, encoded: bytes, data: bytes, droppable: bool = False) -> bool:
+        """
+        Writes a frame compressed for a whole group, if nothing is queued.
+
+        Args:
+            encoded (bytes): The group's compressed frame.
+            data (bytes): The framed packet it holds, queued instead if the
+                transport is paused.
+            droppable (bool): Whether the overflow policy may discard it.
+
+        Returns:
+            bool: Whether ``encoded`` was written.
+        """
+        if not self.closed and not self.paused and not self.frames:
+            if self.coalescer is None:
+                self.user.transport.write(encoded)
+                return True
+            batch = self.batch
+            if self.batch_plain < len(batch):
+                # Compress what came before in order, then add the group's frame.
+                batch[self.batch_plain :] = [
+                    self.deflater.encode(b"".join(batch[self.batch_plain :]))
+                ]
+            self.batch_plain = len(batch) + 1
+            self._add(encoded, False)
+            return True
+        self.write(data, droppable)
+        return False
+
+    def _add(self, data: bytes, urgent: bool) -> None:
+        batch = self.batch
+        coalescer = self.coalescer
+        if not batch:
+            batch = self.batch = []
+            coalescer.pending.append(self)
+            if coalescer.call is None:
+                coalescer.schedule()
+        batch.append(data)
+        self.batch_bytes += len(data)
+        if urgent or self.batch_bytes >= coalescer.max_batch:
+            self.flush_batch()
+
+    def flush_batch(self) -> None:
+        """Hands the batch to the transport in one write."""
+        batch = self.batch
+        if not batch:
+            return
+        plain = self.batch_plain
+        self.batch = EMPTY
+        self.batch_bytes = 0
+        self.batch_plain = 0
+        self.coalescer.batches += 1
+        self.coalescer.packets += len(batch)
+        if self.deflater is not None and plain < len(batch):
+            batch[plain:] = [self.deflater.encode(b"".join(batch[plain:]))]
+        self.user.transport.write(batch[0] if len(batch) == 1 else b"".join(batch))
+
+    def flush(self) -> None:
+        """Writes queued frames until the queue is empty or paused again."""
+        # A batch started before the pause is older than anything queued.
+        self.flush_batch()
+        frames = self.frames
+        transport = self.user.transport
+        deflater = self.deflater
+        while frames and not self.paused:
+            data, _ = frames.popleft()
+            self.bytes -= len(data)
+            if deflater is not None:
+                # Compress a run of frames at once; they share one header and flush.
+                batch = [data]
+                size = len(data)
+                while frames and size < FLUSH_BATCH_BYTES:
+                    data, _ = frames.popleft()
+                    self.bytes -= len(data)
+                    batch.append(data)
+                    size += len(data)
+                data = deflater.encode(b"".join(batch))
+            transport.write(data)
+        if not frames:
+            # Let go of the deque once a burst has drained.
+            self.frames = EMPTY
+
+    def close(self) -> None:
+        """
+        Hands every queued frame to the transport and unregisters the queue.
+
+        Call before ``loseConnection``; Twisted keeps a connection with a
+        registered producer open.
+        """
+        if self.closed:
+            return
+        self.flush_batch()
+        transport = self.user.transport
+        if self.frames and self.deflater is not None:
+            transport.write(self.deflater.encode(b"".join(data for data, _ in self.frames)))
+        elif self.frames:
+            transport.writeSequence([data for data, _ in self.frames])
+        self.frames = EMPTY
+        self.bytes = 0
+        self.closed = True
+        transport.unregisterProducer()
+
+    def overflow(self) -> None:
+        """Applies the overflow policy to a queue that is over its limits."""
+        self.overflows += 1
+        if self.policy is OverflowPolicy.DROP_OLDEST:
+            self._drop_oldest()
+        elif self.policy is OverflowPolicy.COALESCE:
+            self._coalesce()
+
+        if self.bytes > self.max_bytes or len(self.frames) > self.max_packets:
+            self._disconnect()
+
+    def _drop_oldest(self) -> None:
+        kept = deque()
+        frames = self.frames
+        while frames and (
+            self.bytes > self.max_bytes or len(frames) + len(kept) > self.max_packets
+        ):
+            data, droppable = frames.popleft()
+            if droppable:
+                self.bytes -= len(data)
+                self.dropped += 1
+            else:
+                kept.append((data, droppable))
+        kept.extend(frames)
+        self.frames = kept
+
+    def _coalesce(self) -> None:
+        kept = deque()
+        skipped = 0
+        notice_at = None
+        for data, droppable in self.frames:
+            if droppable:
+                if notice_at is None:
+                    notice_at = len(kept)
+                self.bytes -= len(data)
+                skipped += 1
+            else:
+                kept.append((data, droppable))
+        if skipped:
+            self.dropped += skipped
+            notice = frame(
+                self.user.codec.encode(
+                    MessagePacket({"content": f"[{skipped} messages skipped]"})
+                )
+            )
+            kept.insert(notice_at, (notice, False))
+            self.bytes += len(notice)
+        self.frames = kept
+
+    def _disconnect(self) -> None:
+        logger.warning(
+            f"[{self.user.info.id}] Outbound queue full "
+            f"({len(self.frames)} packets, {self.bytes} bytes), disconnecting."
+        )
+        self.frames = EMPTY
+        self.bytes = 0
+        if self.user.server.metrics is not None:
+            self.user.server.metrics.slow_consumers += 1
+        # The batch is older than the kick.
+        self.flush_batch()
+        transport = self.user.transport
+        data = frame(self.user.codec.encode(KickPacket({"reason": "Too slow."})))
+        transport.write(data if self.deflater is None else self.deflater.encode(data))
+        self.close()
+        transport.loseConnection()
+
+    def stats(self) -> dict:
+        """
+        Returns the queue's depth and counters.
+
+        Returns:
+            dict: Current and peak depth in bytes and packets, drops and overflows.
+        """
+        return {
+            "depth_bytes": self.bytes,
+            "depth_packets": len(self.frames),
+            "peak_bytes": self.peak_bytes,
+            "peak_packets": self.peak_packets,
+            "dropped": self.dropped,
+            "overflows": self.overflows,
+            "paused": self.paused,
+        }
+
+    # IPushProducer
+
+    def pauseProducing(self) -> None:
+        self.paused = True
+
+    def resumeProducing(self) -> None:
+        self.paused = False
+        self.flush()
+
+    def stopProducing(self) -> None:
+        self.frames = EMPTY
+        self.bytes = 0
+        self.batch = EMPTY
+        self.batch_bytes = 0
+        self.batch_plain = 0
+        self.closed = True
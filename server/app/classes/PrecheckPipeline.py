@@ -0,0 +1,330 @@
+import logging
+import time
+from collections import OrderedDict
+from collections.abc import Coroutine
+from typing import Callable, Dict, Hashable, List
+from twisted.internet import defer, reactor
+from twisted.python.failure import Failure
+from app.classes.PrecheckResponse import PrecheckResponse
+from app.reactors import ensure_deferred
+from common.packets import Codec, KickPacket, frame
+
+logger = logging.getLogger("Server")
+
+SUCCESS = PrecheckResponse(True)
+
+
+class _Check:
+    """One registered precheck and its latency metrics."""
+
+    __slots__ = (
+        "name",
+        "func",
+        "timeout",
+        "cache_key",
+        "cache_ttl",
+        "calls",
+        "failures",
+        "timeouts",
+        "errors",
+        "cache_hits",
+        "seconds",
+        "max_seconds",
+    )
+
+    def __init__(self, name, func, timeout, cache_key, cache_ttl) -> None:
+        self.name = name
+        self.func = func
+        self.timeout = timeout
+        self.cache_key = cache_key
+        self.cache_ttl = cache_ttl
+        self.calls = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.cache_hits = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+
+    def stats(self) -> dict:
+        run = self.calls - self.cache_hits
+        return {
+            "calls": self.calls,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+            "errors": self.errors,
+            "cache_hits": self.cache_hits,
+            "mean_ms": self.seconds / run * 1000 if run else 0.0,
+            "max_ms": self.max_seconds * 1000,
+        }
+
+
+class PrecheckPipeline:
+    """
+    Runs the checks a user must pass to join, all at once.
+
+    A check is called with the joining UserProtocol and returns a
+    PrecheckResponse (or None for success), raises one, or returns a Deferred
+    or coroutine resolving to one. The first failure decides the join and
+    cancels the checks still running; a check that takes longer than its
+    timeout, or all of them together longer than ``total_timeout``, fail the
+    join unless ``fail_open`` is set.
+
+    Checks whose answer only depends on a cache key (e.g. a ban lookup by IP
+    address) can have their responses cached for ``cache_ttl`` seconds.
+    """
+
+    def __init__(
+        self,
+        timeout: float = 2.0,
+        total_timeout: float = 5.0,
+        fail_open: bool = False,
+        cache_size: int = 4096,
+    ) -> None:
+        """
+        Initializes a new PrecheckPipeline instance.
+
+        Args:
+            timeout (float): Default seconds a single check may take.
+            total_timeout (float): Seconds all checks of one join may take.
+            fail_open (bool): Let users join when checks time out or raise.
+            cache_size (int): Most cached responses kept.
+        """
+        self.timeout = timeout
+        self.total_timeout = total_timeout
+        self.fail_open = fail_open
+        self.cache_size = cache_size
+
+        self.checks: List[_Check] = []
+        self.cache: OrderedDict = OrderedDict()
+        """``(check name, key)`` to ``(expiry, PrecheckResponse)``, oldest first."""
+        self._kick_frames: Dict[tuple, bytes] = {}
+
+        self.joins = 0
+        self.rejected = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+
+    def add(
+        self,
+        check: Callable,
+        name: str = None,
+        timeout: float = None,
+        cache_key: Callable[..., Hashable] = None,
+        cache_ttl: float = 60.0,
+    ) -> None:
+        """
+        Registers a check.
+
+        Args:
+            check (Callable): Called with the joining UserProtocol.
+            name (str): Name used in metrics and the cache. Defaults to the
+                function's name.
+            timeout (float): Seconds the check may take. Defaults to the
+                pipeline's timeout.
+            cache_key (Callable): Maps a user to the key its response is cached
+                under. Checks without one are never cached.
+            cache_ttl (float): Seconds a cached response stays valid.
+        """
+        self.checks.append(
+            _Check(
+                name or getattr(check, "__name__", repr(check)),
+                check,
+                self.timeout if timeout is None else timeout,
+                cache_key,
+                cache_ttl,
+            )
+        )
+
+    def remove(self, name: str) -> None:
+        """Unregisters a check by name."""
+        self.checks = [check for check in self.checks if check.name != name]
+
+    def run(self, user) -> PrecheckResponse | defer.Deferred:
+        """
+        Runs every check for a joining user.
+
+        Checks that answer right away are handled without Deferreds, so a join
+        whose checks are all synchronous costs little more than the calls.
+
+        Args:
+            user (UserProtocol): The joining user.
+
+        Returns:
+            PrecheckResponse | Deferred: The deciding response if no check had
+            to wait, otherwise a Deferred firing with it. Cancelling the
+            Deferred cancels the checks.
+        """
+        started = time.perf_counter()
+        waiting: List[defer.Deferred] = []
+        for check in self.checks:
+            response = self._run_check(check, user)
+            if isinstance(response, defer.Deferred):
+                waiting.append(response)
+            elif not response.success:
+                for d in waiting:
+                    d.cancel()
+                return self._record(started, response)
+        if not waiting:
+            return self._record(started, SUCCESS)
+        return self._wait(waiting, started, user)
+
+    def _wait(self, waiting: List[defer.Deferred], started: float, user) -> defer.Deferred:
+        """Combines the checks that didn't answer right away."""
+        state = {"remaining": len(waiting), "timer": None, "done": False}
+
+        def stop():
+            state["done"] = True
+            if state["timer"] is not None and state["timer"].active():
+                state["timer"].cancel()
+            for d in waiting:
+                if not d.called:
+                    d.cancel()
+
+        def finish(response: PrecheckResponse):
+            if state["done"]:
+                return
+            stop()
+            result.callback(self._record(started, response))
+
+        def done(response: PrecheckResponse):
+            if not response.success:
+                finish(response)
+                return
+            state["remaining"] -= 1
+            if not state["remaining"]:
+                finish(response)
+
+        result = defer.Deferred(lambda _: stop())
+        for d in waiting:
+            d.addCallback(done)
+        if not result.called:
+            state["timer"] = reactor.callLater(
+                self.total_timeout,
+                finish,
+                PrecheckResponse(self.fail_open, "Join checks timed out."),
+            )
+        result.addErrback(self._unexpected, user)
+        return result
+
+    def _record(self, started: float, response: PrecheckResponse) -> PrecheckResponse:
+        elapsed = time.perf_counter() - started
+        self.joins += 1
+        self.seconds += elapsed
+        if elapsed > self.max_seconds:
+            self.max_seconds = elapsed
+        if not response.success:
+            self.rejected += 1
+        return response
+
+    def _run_check(self, check: _Check, user) -> PrecheckResponse | defer.Deferred:
+        """Calls one check, returning its response or a Deferred of it."""
+        started = time.perf_counter()
+        check.calls += 1
+
+        key = None
+        if check.cache_key is not None:
+            key = (check.name, check.cache_key(user))
+            cached = self.cache.get(key)
+            if cached is not None and cached[0] > time.monotonic():
+                check.cache_hits += 1
+                return cached[1]
+
+        try:
+            result = check.func(user)
+        except PrecheckResponse as e:
+            result = e
+        except Exception:
+            return self._timed(check, started, self._failed(Failure(), check, key))
+        if isinstance(result, Coroutine):
+            result = ensure_deferred(result)
+        if isinstance(result, defer.Deferred):
+            if not result.called:
+                result.addTimeout(check.timeout, reactor)
+            result.addCallbacks(
+                self._answered, self._failed, (check, key), None, (check, key)
+            )
+            result.addCallback(lambda response: self._timed(check, started, response))
+            return result
+        return self._timed(check, started, self._answered(result, check, key))
+
+    def _answered(self, response, check: _Check, key) -> PrecheckResponse:
+        if response is None:
+            response = SUCCESS
+        if not response.success:
+            check.failures += 1
+        if key is not None:
+            self._remember(key, check.cache_ttl, response)
+        return response
+
+    def _failed(self, failure, check: _Check, key) -> PrecheckResponse:
+        if failure.check(PrecheckResponse):
+            return self._answered(failure.value, check, key)
+        if failure.check(defer.CancelledError):
+            # Cancelled because another check already decided the join.
+            return SUCCESS
+        if failure.check(defer.TimeoutError):
+            check.timeouts += 1
+            return PrecheckResponse(self.fail_open, "Join check timed out.")
+        check.errors += 1
+        logger.error(f"Precheck {check.name} failed: {failure.getErrorMessage()}")
+        return PrecheckResponse(self.fail_open, "Join check failed.")
+
+    @staticmethod
+    def _timed(check: _Check, started: float, response) -> PrecheckResponse:
+        elapsed = time.perf_counter() - started
+        check.seconds += elapsed
+        if elapsed > check.max_seconds:
+            check.max_seconds = elapsed
+        return response
+
+    def _remember(self, key, ttl: float, response: PrecheckResponse) -> None:
+        self.cache[key] = (time.monotonic() + ttl, response)
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def _unexpected(self, failure, user):
+        if failure.check(defer.CancelledError):
+            return PrecheckResponse(False, "Join cancelled.")
+        logger.error(f"[{user.info.id}] Prechecks failed: {failure.getErrorMessage()}")
+        return PrecheckResponse(self.fail_open, "Join check failed.")
+
+    def kick_frame(self, reason: str, codec: Codec) -> bytes:
+        """
+        Returns the framed KickPacket for a failed precheck.
+
+        Frames are serialized once per reason and codec.
+
+        Args:
+            reason (str): The precheck's reason.
+            codec (Codec): The user's codec.
+
+        Returns:
+            bytes: The framed packet.
+        """
+        key = (reason, codec.name)
+        data = self._kick_frames.get(key)
+        if data is None:
+            if len(self._kick_frames) >= self.cache_size:
+                self._kick_frames.clear()
+            data = self._kick_frames[key] = frame(
+                codec.encode(KickPacket({"reason": reason or "Join refused."}))
+            )
+        return data
+
+    def stats(self) -> dict:
+        """
+        Returns join and per-check latency metrics.
+
+        Returns:
+            dict: Join counts and latency, and each check's metrics by name.
+        """
+        return {
+            "joins": self.joins,
+            "rejected": self.rejected,
+            "mean_ms": self.seconds / self.joins * 1000 if self.joins else 0.0,
+            "max_ms": self.max_seconds * 1000,
+            "cached": len(self.cache),
+            "checks": {check.name: check.stats() for check in self.checks},
+        }
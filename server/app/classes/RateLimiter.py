@@ -0,0 +1,256 @@
+import logging
+import time
+from typing import Dict
+from twisted.internet import reactor
+from app.classes.TokenBucket import TokenBucket
+
+logger = logging.getLogger("Server")
+
+
+class _Peer:
+    """Buckets shared by every connection from one IP address."""
+
+    __slots__ = ("packets", "bytes", "connections")
+
+    def __init__(self, packets, bytes_) -> None:
+        self.packets = packets
+        self.bytes = bytes_
+        self.connections = 0
+
+
+class ConnectionLimits:
+    """Rate limiting state of one connection."""
+
+    __slots__ = ("packets", "bytes", "peer", "host", "strikes", "last_strike", "resume")
+
+    def __init__(self, packets, bytes_, peer: _Peer, host) -> None:
+        self.packets: TokenBucket | None = packets
+        self.bytes: TokenBucket | None = bytes_
+        self.peer = peer
+        self.host = host
+        self.strikes = 0
+        self.last_strike = 0.0
+        self.resume = None
+        """DelayedCall that resumes reading, while reading is paused."""
+
+
+class RateLimiter:
+    """
+    Token bucket limits on what clients send, checked in ``dataReceived``.
+
+    Every connection, every IP address and the whole server have a bucket
+    for packets and one for bytes; a rate of 0 disables that bucket. Bytes
+    are charged as they are read, before any framing, and packets once they
+    are framed, before anything decodes them.
+
+    Going over a connection or IP limit during a read is a strike. Packets
+    over the limit are dropped; from ``delay_after`` strikes within
+    ``strike_window`` seconds reading from the connection is also paused
+    until its buckets refill, and at ``kick_after`` strikes the user is
+    kicked. Bytes can't be dropped
+    without breaking the framing, so going over a byte limit always pauses
+    reading. Going over a global limit drops or pauses without a strike.
+    """
+
+    def __init__(
+        self,
+        server,
+        packets: float = 0,
+        bytes_: float = 0,
+        ip_packets: float = 0,
+        ip_bytes: float = 0,
+        global_packets: float = 0,
+        global_bytes: float = 0,
+        burst: float = 2.0,
+        strike_window: float = 5.0,
+        delay_after: int = 3,
+        kick_after: int = 10,
+    ) -> None:
+        """
+        Initializes a new RateLimiter instance.
+
+        Args:
+            server (ServerFactory): The server, used to kick users.
+            packets (float): Packets per second per connection.
+            bytes_ (float): Bytes per second per connection.
+            ip_packets (float): Packets per second per IP address.
+            ip_bytes (float): Bytes per second per IP address.
+            global_packets (float): Packets per second for the whole server.
+            global_bytes (float): Bytes per second for the whole server.
+            burst (float): Seconds worth of tokens a bucket holds.
+            strike_window (float): Seconds without a strike after which strikes reset.
+            delay_after (int): Strikes after which reading is paused.
+            kick_after (int): Strikes after which the user is kicked.
+        """
+        from app.factory import ServerFactory as Server
+
+        self.server: Server = server
+        self.rates = (packets, bytes_)
+        self.ip_rates = (ip_packets, ip_bytes)
+        self.burst = burst
+        self.strike_window = strike_window
+        self.delay_after = delay_after
+        self.kick_after = kick_after
+
+        now = time.monotonic()
+        self.global_packets = self._bucket(global_packets, now)
+        self.global_bytes = self._bucket(global_bytes, now)
+        self.peers: Dict[str, _Peer] = {}
+
+        self.dropped = 0
+        self.paused = 0
+        self.kicked = 0
+
+    def _bucket(self, rate: float, now: float) -> TokenBucket | None:
+        if rate <= 0:
+            return None
+        return TokenBucket(rate, max(rate * self.burst, 1), now)
+
+    def attach(self, user) -> ConnectionLimits:
+        """
+        Creates the limits of a new connection.
+
+        Args:
+            user (UserProtocol): The connected user.
+
+        Returns:
+            ConnectionLimits: The connection's buckets.
+        """
+        now = time.monotonic()
+        host = getattr(user.transport.getPeer(), "host", None)
+        peer = self.peers.get(host)
+        if peer is None:
+            peer = self.peers[host] = _Peer(
+                self._bucket(self.ip_rates[0], now), self._bucket(self.ip_rates[1], now)
+            )
+        peer.connections += 1
+        return ConnectionLimits(
+            self._bucket(self.rates[0], now), self._bucket(self.rates[1], now), peer, host
+        )
+
+    def detach(self, user) -> None:
+        """
+        Releases a closed connection's limits. Handles ``Connection.Lost``.
+
+        Args:
+            user (UserProtocol): The disconnected user.
+        """
+        limits = user.limits
+        if limits is None:
+            return
+        user.limits = None
+        if limits.resume is not None and limits.resume.active():
+            limits.resume.cancel()
+        limits.peer.connections -= 1
+        if not limits.peer.connections and self.peers.get(limits.host) is limits.peer:
+            del self.peers[limits.host]
+
+    def receive(self, user, size: int, now: float) -> None:
+        """
+        Charges bytes read from a connection, pausing it if that goes over a limit.
+
+        Args:
+            user (UserProtocol): The user the bytes came from.
+            size (int): Number of bytes read.
+            now (float): The current monotonic time.
+        """
+        limits = user.limits
+        wait = 0.0
+        for bucket in (limits.bytes, limits.peer.bytes):
+            if bucket is not None:
+                wait = max(wait, bucket.charge(size, now))
+        if wait:
+            self.strike(user, now)
+        if self.global_bytes is not None:
+            wait = max(wait, self.global_bytes.charge(size, now))
+        if wait:
+            self.pause(user, wait)
+
+    def admit(self, user, now: float) -> bool:
+        """
+        Takes a packet token for a connection.
+
+        Args:
+            user (UserProtocol): The user the packet came from.
+            now (float): The current monotonic time.
+
+        Returns:
+            bool: Whether the packet may be handled; otherwise it is dropped.
+        """
+        limits = user.limits
+        for bucket in (limits.packets, limits.peer.packets):
+            if bucket is not None and not bucket.take(1, now):
+                self.dropped += 1
+                if self.strike(user, now) >= self.delay_after:
+                    self.pause(user, (1 - bucket.tokens) / bucket.rate)
+                return False
+        bucket = self.global_packets
+        if bucket is not None and not bucket.take(1, now):
+            self.dropped += 1
+            self.pause(user, (1 - bucket.tokens) / bucket.rate)
+            return False
+        return True
+
+    def strike(self, user, now: float) -> int:
+        """
+        Records a limit violation, kicking the user once it has too many.
+
+        Args:
+            user (UserProtocol): The offending user.
+            now (float): The current monotonic time.
+
+        Returns:
+            int: The user's strikes within the current window.
+        """
+        limits = user.limits
+        if now == limits.last_strike:
+            # Everything over the limit in one read counts as one strike.
+            return limits.strikes
+        if now - limits.last_strike > self.strike_window:
+            limits.strikes = 0
+        limits.strikes += 1
+        limits.last_strike = now
+        if limits.strikes >= self.kick_after:
+            self.kicked += 1
+            logger.warning(f"[{user.info.id}] Kicked for exceeding rate limits.")
+            self.server.users.kick_user(user, "Rate limit exceeded.")
+        return limits.strikes
+
+    def pause(self, user, seconds: float) -> None:
+        """
+        Stops reading from a connection for a while.
+
+        Args:
+            user (UserProtocol): The user to stop reading from.
+            seconds (float): How long to pause; an ongoing pause is only extended.
+        """
+        limits = user.limits
+        transport = user.transport
+        if limits is None or not transport.connected or transport.disconnecting:
+            return
+        if limits.resume is not None and limits.resume.active():
+            if limits.resume.getTime() < reactor.seconds() + seconds:
+                limits.resume.reset(seconds)
+            return
+        self.paused += 1
+        user.pause_reading()
+        limits.resume = reactor.callLater(seconds, self._resume, user)
+
+    def _resume(self, user) -> None:
+        if user.limits is not None:
+            user.limits.resume = None
+        user.resume_reading()
+
+    def stats(self) -> dict:
+        """
+        Returns the limiter's counters.
+
+        Returns:
+            dict: Dropped packets, pauses, kicks and tracked IP addresses.
+        """
+        return {
+            "dropped": self.dropped,
+            "paused": self.paused,
+            "kicked": self.kicked,
+            "peers": len(self.peers),
+        }
@@ -0,0 +1,93 @@
+from math import ceil
+from typing import Dict, Hashable, List
+
+
+class TimingWheel:
+    """
+    A hashed timing wheel: timers kept in a ring of ``size`` slots, one per tick.
+
+    A timer ``delay`` seconds away goes into the slot that many ticks past
+    the cursor, with the number of whole turns of the wheel it still has to
+    wait. ``advance`` moves the cursor one slot and returns the timers due
+    there, so scheduling, cancelling and expiring a timer cost O(1) however
+    many there are, and the wheel needs one periodic call in all instead of
+    one DelayedCall per timer. Timers fire up to one tick late.
+    """
+
+    def __init__(self, tick: float = 1.0, size: int = 512) -> None:
+        """
+        Initializes a new TimingWheel instance.
+
+        Args:
+            tick (float): Seconds per slot.
+            size (int): Slots in the ring; delays up to ``tick * size`` fit in one turn.
+        """
+        self.tick = tick
+        self.size = size
+        self.slots: List[Dict[Hashable, int]] = [{} for _ in range(size)]
+        """Timers in each slot, with the turns left before they are due."""
+        self.where: Dict[Hashable, int] = {}
+        """Slot of every scheduled timer."""
+        self.cursor = 0
+        self.ticks = 0
+        """Times the wheel advanced."""
+
+    def schedule(self, key: Hashable, delay: float) -> None:
+        """
+        Schedules a timer, replacing the one ``key`` had.
+
+        Args:
+            key (Hashable): What ``advance`` returns once the timer is due.
+            delay (float): Seconds from now; at least one tick.
+        """
+        self.cancel(key)
+        ticks = max(1, ceil(delay / self.tick))
+        index = (self.cursor + ticks) % self.size
+        self.slots[index][key] = (ticks - 1) // self.size
+        self.where[key] = index
+
+    def cancel(self, key: Hashable) -> bool:
+        """
+        Cancels a timer.
+
+        Args:
+            key (Hashable): The timer's key.
+
+        Returns:
+            bool: Whether it was scheduled.
+        """
+        index = self.where.pop(key, None)
+        if index is None:
+            return False
+        del self.slots[index][key]
+        return True
+
+    def advance(self) -> List[Hashable]:
+        """
+        Moves the wheel one tick on.
+
+        Returns:
+            List[Hashable]: The keys of the timers now due, no longer scheduled.
+        """
+        self.cursor = (self.cursor + 1) % self.size
+        self.ticks += 1
+        slot = self.slots[self.cursor]
+        if not slot:
+            return []
+        due = []
+        for key, turns in slot.items():
+            if turns:
+                slot[key] = turns - 1
+            else:
+                due.append(key)
+        where = self.where
+        for key in due:
+            del slot[key]
+            del where[key]
+        return due
+
+    def __len__(self) -> int:
+        return len(self.where)
+
+    def __repr__(self) -> str:
+        return f"<TimingWheel {len(self.where)} timers, {self.size}x{self.tick}s>"
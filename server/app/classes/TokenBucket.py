@@ -0,0 +1,63 @@
+class TokenBucket:
+    """
+    Refills at ``rate`` tokens per second up to ``capacity``.
+
+    Refilling is computed from the time of the last call, so a bucket is
+    just its token count and a timestamp.
+    """
+
+    __slots__ = ("rate", "capacity", "tokens", "stamp")
+
+    def __init__(self, rate: float, capacity: float, now: float) -> None:
+        """
+        Initializes a new, full TokenBucket.
+
+        Args:
+            rate (float): Tokens added per second.
+            capacity (float): Largest number of tokens held, i.e. the burst size.
+            now (float): The current monotonic time.
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = now
+
+    def refill(self, now: float) -> None:
+        tokens = self.tokens + (now - self.stamp) * self.rate
+        self.tokens = tokens if tokens < self.capacity else self.capacity
+        self.stamp = now
+
+    def take(self, amount: float, now: float) -> bool:
+        """
+        Takes tokens if enough are left.
+
+        Args:
+            amount (float): Tokens needed.
+            now (float): The current monotonic time.
+
+        Returns:
+            bool: Whether the tokens were taken.
+        """
+        self.refill(now)
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+    def charge(self, amount: float, now: float) -> float:
+        """
+        Takes tokens even if that leaves the bucket in debt.
+
+        Args:
+            amount (float): Tokens used.
+            now (float): The current monotonic time.
+
+        Returns:
+            float: Seconds until the bucket is out of debt, 0 if it isn't.
+        """
+        self.refill(now)
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def __repr__(self) -> str:
+        return f"<TokenBucket {self.tokens:.1f}/{self.capacity} +{self.rate}/s>"
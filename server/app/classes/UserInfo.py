@@ -1,14 +1,14 @@
 from dataclasses import dataclass
 
 
-@dataclass
+@dataclass(slots=True)
 class UserInfo:
     """
     Holds information about a user.
     """
 
-    id: str | bytes
-    """Unique identifier for the user."""
+    id: int
+    """Unique identifier for the user; see UserRegistry.new_id."""
     username: str
     """Username of the user."""
     auth: None = None
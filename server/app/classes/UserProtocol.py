@@ -1,18 +1,57 @@
 import json
 import logging
 import time
-from uuid import uuid4
+from base64 import b64decode, b64encode
 from twisted.internet.protocol import Protocol
 from twisted.internet import reactor
-from common.events import EventHandler
-from common.packets import BasePacket, MessagePacket
+from common.compression import DEFLATE, MAX_GROUPS, Deflater
+from common.events import EventHandler, SubscriptionGroup
+from common.packets import (
+    CODECS,
+    DEFAULT_CODEC,
+    BasePacket,
+    FrameError,
+    HelloPacket,
+    MessagePacket,
+    PacketBuffer,
+    frame,
+    frame_many,
+    negotiate_codec,
+)
 from app.classes.UserInfo import UserInfo
+from app.classes.OutboundQueue import OutboundQueue
 from app.classes.enums import UserState, UserJoinState
 
 logger = logging.getLogger("Server")
 
 
+NO_CHANNELS: frozenset = frozenset()
+
+
 class UserProtocol(Protocol):
+    # One instance per connection: slots keep each one to a fixed size. What
+    # every connection shares (config, events) lives on the server, and
+    # anything most connections never use (subscriptions, queued frames,
+    # channels) is only allocated once it is.
+    __slots__ = (
+        "server",
+        "transport",
+        "connected",
+        "info",
+        "buffer",
+        "codec",
+        "channels",
+        "outbound",
+        "limits",
+        "state",
+        "last_seen",
+        "last_active",
+        "join_timer",
+        "held",
+        "pauses",
+        "adopted",
+        "_subscriptions",
+    )
 
     def __init__(self, server) -> None:
         """
@@ -24,61 +63,343 @@ class UserProtocol(Protocol):
         from app.factory import ServerFactory as Server
 
         self.server: Server = server
+        self.transport = None
+        self.connected = 0
+
+        self.info = UserInfo(server.users.new_id(), None)
+        self.buffer = PacketBuffer()
+        self.codec = DEFAULT_CODEC
+        self.channels: set[str] | frozenset[str] = NO_CHANNELS
+        """Names of the channels joined. A set of its own from the first join."""
+        self.outbound = OutboundQueue(
+            self,
+            server.outbound_max_bytes,
+            server.outbound_max_packets,
+            server.outbound_policy,
+            server.coalescer,
+        )
+        self.limits = None
+        """Rate limiting state, set on connect if the server limits clients."""
+        self.state = UserState.ONLINE
+        self.last_seen = 0.0
+        """When data was last received, as ``Heartbeat.now``."""
+        self.last_active = 0.0
+        """When the user last sent a chat message, as ``Heartbeat.now``."""
+        self.join_timer = None
+        """Starts the join if no packet comes first; see UserRegistry.addUser."""
+        self.held: list[BasePacket] | None = None
+        """Packets read while the join prechecks ran, emitted once they pass."""
+        self.pauses = 0
+        """Reasons reading is paused for; see pause_reading."""
+        self.adopted: dict | None = None
+        """Handed off state whose output is still to be written; see app.handoff."""
+        self._subscriptions: SubscriptionGroup | None = None
+
+    def pause_reading(self) -> None:
+        """
+        Stops reading from the connection until every pause has been resumed.
+
+        The join prechecks and the rate limiter pause reading independently;
+        each call must be matched by one ``resume_reading``.
+        """
+        self.pauses += 1
+        if self.pauses == 1:
+            self.transport.pauseProducing()
 
-        self.motd = server.config.get("General", "motd")
-        self.info = UserInfo(uuid4(), None)
-        self.events = server.events
-        self.server.events.on("Connection.Made", self.server.users.addUser)
-        if self.server.debug:
-            self.server.events.on("*", self.debug)
+    def resume_reading(self) -> None:
+        """Ends one ``pause_reading``, and resumes reading once none remain."""
+        if not self.pauses:
+            return
+        self.pauses -= 1
+        if not self.pauses and self.transport.connected and not self.transport.disconnecting:
+            self.transport.resumeProducing()
 
-    def debug(self, *args, **kwargs):
+    @property
+    def motd(self) -> str:
+        """The server's message of the day."""
+        return self.server.motd
 
-        logger.debug(f"[{self.info.id}] {args} {kwargs}")
+    @property
+    def events(self) -> EventHandler:
+        """The server's event handler."""
+        return self.server.events
+
+    @property
+    def subscriptions(self) -> SubscriptionGroup:
+        """Subscriptions released when this connection is lost, created on first use."""
+        if self._subscriptions is None:
+            self._subscriptions = self.server.events.scope()
+        return self._subscriptions
 
     def dataReceived(self, data: bytes) -> None:
         """
-        Receives data from the connected user and broadcasts it to all users.
+        Receives data from the connected user and emits every complete packet.
+
+        Reads may hold several packets or only part of one, so data is fed
+        through the connection's PacketBuffer first. Every packet is emitted as
+        ``Recv.<type>`` with the packet and this user. Packets are lazy views:
+        their body is only parsed once a handler reads ``data``.
+
+        The server's RateLimiter is charged for the bytes and for every
+        packet before it is emitted; packets over the limit are dropped.
+        Packets are counted in the server's Metrics, which also time the
+        writes handling them. The read is stamped for the server's Heartbeat.
 
         Args:
             data (bytes): The data received from the user.
         """
-        packet = BasePacket.decode(data)
+        heartbeat = self.server.heartbeat
+        if heartbeat is not None:
+            self.last_seen = heartbeat.now
+        limiter = self.server.limiter
+        now = 0.0
+        if self.limits is not None:
+            now = time.monotonic()
+            limiter.receive(self, len(data), now)
 
-        if packet:
-            self.server.events.emit(f"Recv.{packet.type}", packet)
+        try:
+            packets = self.buffer.views(data)
+        except FrameError as e:
+            logger.warning(f"[{self.info.id}] {e}")
+            self.loseConnection()
+            return
+
+        metrics = self.server.metrics
+        if metrics is None:
+            self.emit_packets(packets, limiter, now)
+            return
+        metrics.read(len(data))
+        counts = metrics.packets_in
+        for packet in packets:
+            counts[packet.type] = counts.get(packet.type, 0) + 1
+        try:
+            self.emit_packets(packets, limiter, now)
+        finally:
+            metrics.received_at = 0
+
+    def emit_packets(self, packets: list[BasePacket], limiter, now: float) -> None:
+        """
+        Emits ``Recv.<type>`` for the packets of one read that pass the rate limits.
+
+        A user whose join waits for its first packet joins before that packet
+        is emitted. If the join prechecks don't answer right away, the rest of
+        the read is held until they do.
+
+        Args:
+            packets (list[BasePacket]): The packets read.
+            limiter (RateLimiter): The server's limiter, or None to skip the limits.
+            now (float): ``time.monotonic()`` of the read.
+        """
+        for index, packet in enumerate(packets):
+            if self.outbound.closed:
+                return
+            if limiter is not None and self.limits is not None:
+                if not limiter.admit(self, now):
+                    continue
+            if packet.type == "HelloPacket":
+                self.handshake(packet)
+            elif self.join_timer is not None:
+                if not self.server.users.join(self, packet):
+                    self.held = packets[index:]
+                    return
+                if self.outbound.closed:
+                    return
+            self.server.events.emit(f"Recv.{packet.type}", packet, self)
+
+    def handshake(self, packet: HelloPacket) -> None:
+        """
+        Negotiates the codec and compression used for packets sent to this user.
+
+        The reply is sent with the previous codec and uncompressed; everything
+        after it uses the negotiated ones. Users that never send a HelloPacket
+        stay on uncompressed JSON. Compression is only turned on while nothing
+        is queued for the user, so no frame written before the reply can be
+        sent compressed.
+
+        Args:
+            packet (HelloPacket): The user's hello, listing the codecs it
+                supports and optionally the compression methods.
+        """
+        offered = packet.data.get("codecs")
+        if not isinstance(offered, list):
+            return
+        codec = negotiate_codec(offered, self.server.codecs)
+        reply = {"codec": codec.name}
+        compression = packet.data.get("compression")
+        compress = (
+            self.server.compression is not None
+            and isinstance(compression, list)
+            and DEFLATE in compression
+            and self.outbound.deflater is None
+            and not self.outbound.frames
+        )
+        if compress:
+            reply["compression"] = DEFLATE
+            reply["groups"] = self.server.compression.max_groups
+        self.send(HelloPacket(reply))
+        self.codec = codec
+        if compress:
+            # Everything up to the reply goes out uncompressed.
+            self.outbound.flush_batch()
+            self.outbound.deflater = self.server.compression.deflater()
 
     def connectionMade(self) -> None:
         """
         Called when a new connection is established.
 
-        Registers the user with the server's UserRegistry.
+        Attaches the outbound queue to the transport and registers the user
+        with the server's UserRegistry. A connection handed off by the
+        previous process first gets what that process had not sent yet, and
+        emits ``Connection.Adopted`` instead of ``Connection.Made``.
+        """
+        self.outbound.attach(self.transport)
+        if self.server.limiter is not None:
+            self.limits = self.server.limiter.attach(self)
+        if self.adopted is None:
+            self.server.events.emit("Connection.Made", self)
+            return
+        state, self.adopted = self.adopted, None
+        if state["unsent"]:
+            self.transport.write(b64decode(state["unsent"]))
+        for data, droppable in state["queued"]:
+            self.outbound.write(b64decode(data), droppable)
+        self.server.events.emit("Connection.Adopted", self)
+
+    def handoff_state(self) -> dict:
         """
-        self.server.events.emit("Connection.Made", self)
+        Returns what a new process needs to take this connection over.
+
+        Includes the output not written to the socket yet: the bytes in the
+        transport's buffer, already encoded, and the frames held back by the
+        outbound queue. Write batches must have been flushed.
+
+        Returns:
+            dict: JSON-serializable state, for ``restore``.
+        """
+        transport = self.transport
+        # Twisted keeps unsent bytes in dataBuffer from offset on, and
+        # writes since the last doWrite in _tempDataBuffer.
+        unsent = transport.dataBuffer[transport.offset :] + b"".join(
+            transport._tempDataBuffer
+        )
+        return {
+            "id": self.info.id,
+            "username": self.info.username,
+            "codec": self.codec.name,
+            "compressed": self.outbound.deflater is not None,
+            "groups": self.outbound.deflater.max_groups if self.outbound.deflater else None,
+            "channels": sorted(self.channels),
+            "afk": self.state is UserState.AFK,
+            "input": b64encode(self.buffer.pending()).decode(),
+            "unsent": b64encode(unsent).decode(),
+            "queued": [
+                [b64encode(data).decode(), droppable]
+                for data, droppable in self.outbound.frames
+            ],
+        }
+
+    def restore(self, state: dict) -> None:
+        """
+        Takes over the state of a connection handed off by the previous process.
+
+        Called before the connection is made. A compressed connection gets
+        a new compressor: every frame the old one wrote ended on a sync
+        flush, so the client's decompressor carries on with the new stream.
+
+        Args:
+            state (dict): The connection's ``handoff_state``.
+        """
+        self.info = UserInfo(state["id"], state["username"])
+        self.codec = CODECS.get(state["codec"], DEFAULT_CODEC)
+        self.channels = set(state["channels"]) or NO_CHANNELS
+        if state.get("afk"):
+            self.state = UserState.AFK
+        self.buffer.feed(b64decode(state["input"]))
+        if state["compressed"]:
+            compression = self.server.compression
+            self.outbound.deflater = (
+                compression.deflater() if compression is not None else Deflater()
+            )
+            # Keep to what the client was told at handshake.
+            self.outbound.deflater.max_groups = state.get("groups") or MAX_GROUPS
+        self.adopted = state
+
+    def loseConnection(self) -> None:
+        """
+        Closes the connection after writing everything still queued for it.
+        """
+        self.outbound.close()
+        self.transport.loseConnection()
 
     def connectionLost(self, reason: str) -> None:
         """
         Called when the connection is lost.
 
-        Currently empty, but can be implemented to handle cleanup tasks.
+        Emits ``Connection.Lost`` and releases every subscription this
+        connection made.
 
         Args:
             reason (str): Reason for the connection loss.
         """
         self.server.events.emit("Connection.Lost", self)
+        if self._subscriptions is not None:
+            self._subscriptions.cancel()
 
     def send(self, data: bytes | BasePacket) -> None:
         """
         Sends data to the connected user over the network.
 
+        Packets are encoded with the connection's negotiated codec; bytes are
+        assumed to be encoded already. Kicks skip the write batch.
+
         Args:
-            data (bytes): The data to send.
+            data (bytes | BasePacket): The encoded packet or the packet itself.
         """
         if issubclass(data.__class__, BasePacket):
-            data = data.prep()
-        packet = BasePacket.decode(data)
-        self.server.events.emit(f"Send.{packet.type}", packet)
-        self.transport.write(data)
+            packet = data
+            data = self.codec.encode(packet)
+        else:
+            packet = BasePacket.view(data)
+        if packet is not None:
+            self.server.events.emit(f"Send.{packet.type}", packet)
+            if self.server.metrics is not None:
+                self.server.metrics.sent(packet.type)
+        self.write(
+            frame(data),
+            packet is not None and packet.type == "MessagePacket",
+            packet is not None and packet.type == "KickPacket",
+        )
+
+    def send_many(self, packets: list[BasePacket]) -> None:
+        """
+        Sends several packets to the connected user in a single write.
+
+        Args:
+            packets (list[BasePacket]): The packets to send.
+        """
+        data = frame_many(self.codec.encode(packet) for packet in packets)
+        metrics = self.server.metrics
+        for packet in packets:
+            self.server.events.emit(f"Send.{packet.type}", packet)
+            if metrics is not None:
+                metrics.sent(packet.type)
+        self.write(data)
+
+    def write(self, data: bytes, droppable: bool = False, urgent: bool = False) -> None:
+        """
+        Writes already framed bytes to the connected user through its outbound queue.
+
+        No events are emitted; used by fan-out paths that encode once and
+        share the same bytes between many users.
+
+        Args:
+            data (bytes): The framed packet(s).
+            droppable (bool): Whether a full queue may discard it (chat messages).
+            urgent (bool): Write now instead of with this tick's batch (kicks).
+        """
+        if self.server.metrics is not None:
+            self.server.metrics.bytes_out += len(data)
+        self.outbound.write(data, droppable, urgent)
 
     def __str__(self) -> str:
         return f"<UserProtocol {self.info.id}>"
@@ -1,34 +1,82 @@
-from typing import Callable, Dict, List
-from uuid import uuid4
+from typing import Callable, Dict, Iterable, List
+import itertools
+import secrets
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
 from twisted.internet.protocol import Protocol
 from app.classes.UserProtocol import UserProtocol
 from app.classes.UserInfo import UserInfo
 from app.classes.enums import UserState, UserJoinState
 from app.classes.PrecheckResponse import PrecheckResponse
-from common.packets import BasePacket, KickPacket, MessagePacket
+from app.classes.PrecheckPipeline import PrecheckPipeline
+from common.packets import (
+    DEFAULT_CODEC,
+    BasePacket,
+    KickPacket,
+    MessagePacket,
+    frame,
+    payload_codec,
+)
 import json
-from common.events import EventHandler
+from common.registry import BaseRegistry
+from app.sessions import RESUMABLE
 
 # from time import sleep
 
 
-class UserRegistry:
+class UserRegistry(BaseRegistry[UserProtocol]):
 
     def __init__(self, server) -> None:
         """
         Initializes a new UserRegistry instance.
 
-        Manages a list of connected users.
+        Manages the connected users, indexed by ``info.id`` and by username.
+        Users are removed on disconnect, so every registered user is online.
         """
         from app.factory import ServerFactory as Server
 
+        super().__init__()
         self.server: Server = server
 
-        self.users: List[UserProtocol] = []
-        self.prechecks = EventHandler()
+        self._by_username: Dict[str, UserProtocol] = {}
+        self._joining: Dict[int, Deferred] = {}
+        """Prechecks still running, keyed by user ID."""
+        self._ids = itertools.count((secrets.randbits(21) << 32) + 1)
+        config = server.config
+        self.prechecks = PrecheckPipeline(
+            timeout=config.getfloat("Prechecks", "timeout", fallback=2.0),
+            total_timeout=config.getfloat("Prechecks", "total_timeout", fallback=5.0),
+            fail_open=config.getboolean("Prechecks", "fail_open", fallback=False),
+            cache_size=config.getint("Prechecks", "cache_size", fallback=4096),
+        )
+        self.__init_default_prechecks()
+
+    def new_id(self) -> int:
+        """
+        Returns an ID for a new connection.
+
+        IDs are a random 21 bit prefix, drawn per process so nodes and
+        processes taking over don't hand out the same IDs, and a 32 bit
+        counter. They fit a JSON number exactly and a small int object.
+
+        Returns:
+            int: The ID.
+        """
+        return next(self._ids)
 
     def __init_default_prechecks(self):
-        self.prechecks.on("Precheck.Join", self.__builtin_precheck_check_username)
+        self.prechecks.add(self.__builtin_precheck_check_username, name="username")
+
+    @property
+    def users(self) -> List[UserProtocol]:
+        """
+        Returns a list of registered users.
+
+        Returns:
+            List[UserProtocol]: The registered users.
+        """
+
+        return list(self._registry.values())
 
     @property
     def online(self):
@@ -39,7 +87,7 @@ class UserRegistry:
             List[UserProtocol]: The online users.
         """
 
-        return [u for u in self.users if u.transport.connected]
+        return list(self._registry.values())
 
     @property
     def online_count(self):
@@ -50,7 +98,16 @@ class UserRegistry:
             int: The number of online users.
         """
 
-        return len(self.online)
+        return len(self._registry) + self.server.backplane.remote_count
+
+    def usernames(self) -> List[str]:
+        """
+        Returns the usernames of the users registered on this process.
+
+        Returns:
+            List[str]: The usernames.
+        """
+        return list(self._by_username)
 
     def __builtin_precheck_check_username(self, user: UserProtocol) -> PrecheckResponse:
         """
@@ -63,7 +120,9 @@ class UserRegistry:
             PrecheckResponse: Whether the username is available.
         """
 
-        if user.info.username in [u.info.username for u in self.users]:
+        if user.info.username in self._by_username or (
+            self.server.backplane.has_username(user.info.username)
+        ):
             raise PrecheckResponse(
                 False, f"Username {user.info.username} is already in use."
             )
@@ -71,60 +130,199 @@ class UserRegistry:
 
     def addUser(self, user: UserProtocol) -> None:
         """
-        Adds a user to the registry.
+        Adds a user to the registry once it passes the join prechecks.
+
+        With sessions, the join waits for the user's first packet after its
+        HelloPacket, which may resume a session instead, or for the sessions'
+        ``join_timeout``; see ``join``.
+
+        Args:
+            user (UserProtocol): The user to add.
+        """
+        sessions = self.server.sessions
+        if sessions is None:
+            self.join(user)
+        else:
+            user.join_timer = reactor.callLater(sessions.join_timeout, self.join, user)
+
+    def join(self, user: UserProtocol, packet: BasePacket = None) -> bool:
+        """
+        Resumes the user's session, or runs the join prechecks.
+
+        When every precheck answers right away the user is registered before
+        this returns. Otherwise reading from the user is paused until the
+        prechecks are done.
 
         Args:
             user (UserProtocol): The user to add.
+            packet (BasePacket): The user's first packet, if it sent one. A
+                SessionPacket with a valid token resumes that session.
+
+        Returns:
+            bool: Whether the join is decided, False while prechecks run.
+        """
+        timer, user.join_timer = user.join_timer, None
+        if timer is not None and timer.active():
+            timer.cancel()
+        sessions = self.server.sessions
+        if (
+            packet is not None
+            and packet.type == "SessionPacket"
+            and sessions is not None
+            and sessions.resume(user, packet)
+        ):
+            return True
+        d = self.prechecks.run(user)
+        if isinstance(d, PrecheckResponse):
+            self._complete_join(d, user)
+            return True
+        user.pause_reading()
+        self._joining[user.info.id] = d
+        d.addCallback(self._resume_join, user)
+        return False
+
+    def _resume_join(self, response: PrecheckResponse, user: UserProtocol) -> None:
+        if self._joining.pop(user.info.id, None) is None:
+            return  # Disconnected while the prechecks ran.
+        user.resume_reading()
+        self._complete_join(response, user)
+        held, user.held = user.held, None
+        if held and not user.outbound.closed:
+            user.emit_packets(held, None, 0.0)
+
+    def _complete_join(self, response: PrecheckResponse, user: UserProtocol) -> None:
         """
-        try:
-            self.prechecks.emit("Precheck.Join", user)
-            self.users.append(user)
-        except PrecheckResponse as e:
-            user.transport.write(KickPacket(e.reason).prep())
-            user.transport.loseConnection()
+        Registers a user that passed the prechecks, or kicks one that didn't.
 
-    def getUser(self, id_: str | UserProtocol) -> UserProtocol | None:
+        Emits ``User.Joined`` once the user is registered.
+        """
+        if not response.success:
+            user.write(self.prechecks.kick_frame(response.reason, user.codec), urgent=True)
+            user.loseConnection()
+            return
+        self.register(user.info.id, user)
+        if user.info.username is not None:
+            self._by_username[user.info.username] = user
+        self.server.backplane.joined(user)
+        self.server.events.emit("User.Joined", user)
+
+    def adopt(self, user: UserProtocol) -> None:
+        """
+        Registers a user handed off by the previous process, which already
+        passed the prechecks. Handles ``Connection.Adopted``; no
+        ``User.Joined`` is emitted, so nothing is replayed.
+
+        Args:
+            user (UserProtocol): The adopted user.
+        """
+        self.register(user.info.id, user)
+        if user.info.username is not None:
+            self._by_username[user.info.username] = user
+        self.server.backplane.joined(user)
+
+    def getUser(self, id_: int | UserProtocol) -> UserProtocol | None:
         """
         Retrieves a user by ID or UserProtocol object.
 
         Args:
-            id_ (str | UserProtocol): The user ID (string) or the UserProtocol object itself.
+            id_ (int | UserProtocol): The user ID or the UserProtocol object itself.
 
         Returns:
             UserProtocol: The UserProtocol object if found, otherwise None.
         """
         if isinstance(id_, UserProtocol):
             return id_
-        for user in self.users:
-            if user.info.id == id_:
-                return user
-        return None
+        return self._registry.get(id_)
 
-    def removeUser(self, id_: UserProtocol | str) -> None:
+    def registered(self, user: UserProtocol) -> bool:
         """
-        Removes a user from the registry.
+        Checks whether a connection has joined, i.e. passed the prechecks.
 
         Args:
-            id_ (UserProtocol | str): The user ID (string) or the UserProtocol object itself.
+            user (UserProtocol): The connection.
+
+        Returns:
+            bool: Whether it is the registered user with its ID.
+        """
+        return self._registry.get(user.info.id) is user
+
+    def getUserByName(self, username: str) -> UserProtocol | None:
+        """
+        Retrieves a user by username.
+
+        Args:
+            username (str): The username to look up.
+
+        Returns:
+            UserProtocol: The UserProtocol object if found, otherwise None.
+        """
+        return self._by_username.get(username)
+
+    def rename(self, id_: int | UserProtocol, username: str) -> None:
+        """
+        Changes a registered user's username, keeping the username index current.
+
+        Args:
+            id_ (int | UserProtocol): The user ID or the UserProtocol object itself.
+            username (str): The new username.
         """
         user = self.getUser(id_)
-        try:
-            if user:
-                self.users.remove(user)
-        except ValueError:
-            pass
+        if user is None:
+            return
+        if self._by_username.get(user.info.username) is user:
+            del self._by_username[user.info.username]
+        user.info.username = username
+        if user.info.id in self._registry:
+            if username is not None:
+                self._by_username[username] = user
+            self.server.backplane.joined(user)
+
+    def removeUser(self, id_: UserProtocol | int) -> None:
+        """
+        Removes a user from the registry.
 
-    def kick_user(self, id_: UserProtocol | str, reason: str = None) -> None:
+        Args:
+            id_ (UserProtocol | int): The user ID or the UserProtocol object itself.
+        """
+        user = self.getUser(id_)
+        if user is None:
+            return
+        if user.join_timer is not None:
+            user.join_timer.cancel()
+            user.join_timer = None
+            return
+        joining = self._joining.pop(user.info.id, None)
+        if joining is not None:
+            joining.cancel()
+            return
+        if self._registry.get(user.info.id) is not user:
+            return
+        del self._registry[user.info.id]
+        if self._by_username.get(user.info.username) is user:
+            del self._by_username[user.info.username]
+        self.server.backplane.left(user)
+        if self.server.sessions is not None:
+            self.server.sessions.detach(user)
+
+    def kick_user(self, id_: UserProtocol | int, reason: str = None) -> None:
         """
         Kicks a user from the server.
 
+        Users connected to another node are kicked through the backplane.
+
         Args:
-            id_ (UserProtocol | str): The user ID (string) or the UserProtocol object itself.
+            id_ (UserProtocol | int): The user ID or the UserProtocol object itself.
         """
+        if reason is None:
+            reason = "No reason specified."
         user = self.getUser(id_)
+        if user is None and isinstance(id_, int):
+            self.server.backplane.kick(id_, reason)
         if user:
-            if reason is None:
-                reason = "No reason specified."
+            if self.server.metrics is not None:
+                self.server.metrics.kicks += 1
+            if self.server.sessions is not None:
+                self.server.sessions.end(user)
             self.removeUser(user)
             user.send(
                 KickPacket(
@@ -134,7 +332,7 @@ class UserRegistry:
                 )
             )
 
-            user.transport.loseConnection()
+            user.loseConnection()
 
     def pack_packet(self, data: str | bytes | dict | BasePacket) -> bytes:
         """
@@ -158,19 +356,119 @@ class UserRegistry:
                 data = data.prep()
         return data
 
-    def broadcast(self, data: str | bytes | dict) -> None:
+    def broadcast(self, data: str | bytes | dict | BasePacket) -> None:
         """
         Broadcasts data to all connected users.
 
+        The packet is encoded and framed once and the same bytes object is
+        written to every transport. ``Send.*`` is emitted once per broadcast.
+        The framed packet is also handed to the other nodes through the
+        server's backplane.
+
         Args:
-            data (str | bytes | dict): The data to broadcast.
+            data (str | bytes | dict | BasePacket): The data to broadcast.
         """
-        data = self.pack_packet(data)
+        result = self.fanout(data, self._registry.values(), "*")
+        backplane = self.server.backplane
+        if result is not None and backplane.clustered:
+            packet, wires = result
+            wire = wires.get(DEFAULT_CODEC) or next(iter(wires.values()), None)
+            if wire is None:
+                wire = frame(DEFAULT_CODEC.encode(packet))
+            backplane.broadcast(wire)
+
+    def relay(self, packet: MessagePacket, user: UserProtocol) -> None:
+        """
+        Handles ``Recv.MessagePacket`` by broadcasting the message to everyone.
+
+        Args:
+            packet (MessagePacket): The message received.
+            user (UserProtocol): The user who sent it.
+        """
+        if not self.registered(user) or not packet.verify():
+            return
+        self.broadcast(packet)
+
+    def fanout(
+        self,
+        data: str | bytes | dict | BasePacket,
+        users: Iterable[UserProtocol],
+        group: str = None,
+    ) -> None:
+        """
+        Sends data to many users, encoding it only once per codec in use.
+
+        A received packet whose body was never read is verified and then
+        relayed as its original bytes to users on the same codec. For users with
+        compression, a ``group`` lets the packet be compressed once per codec
+        through that group's shared compressor (see app.compression). With
+        sessions, chat messages sent to a group are numbered and kept for
+        resuming clients (see app.sessions).
+
+        Args:
+            data (str | bytes | dict | BasePacket): The data to send.
+            users (Iterable[UserProtocol]): The recipients.
+            group (str): Name of the shared compression group of these
+                recipients, e.g. ``*`` for everyone or a channel's name.
 
-        for user in self.users:
-            self.send_to(data, user)
+        Returns:
+            tuple | None: The packet and the frames written, keyed by codec, or
+            None if the data could not be decoded.
+        """
+        wires = {}
+        if issubclass(data.__class__, BasePacket):
+            packet = data
+        else:
+            data = self.pack_packet(data)
+            packet = BasePacket.view(data)
+            if packet is None:
+                return None
+        sessions = self.server.sessions
+        if sessions is not None and group is not None and packet.type in RESUMABLE:
+            # Numbering changes the body, so the received bytes can't be reused.
+            sessions.record(packet, group, wires)
+        else:
+            raw = packet.forwardable()
+            if raw is not None:
+                wires[payload_codec(raw)] = frame(raw)
+        self.server.events.emit(f"Send.{packet.type}", packet)
+        droppable = packet.type == "MessagePacket"
+
+        compression = self.server.compression if group is not None else None
+        shared = {}
+        count = size = 0
+        for user in tuple(users):
+            wire = wires.get(user.codec)
+            if wire is None:
+                wire = wires[user.codec] = frame(user.codec.encode(packet))
+            outbound = user.outbound
+            if outbound.deflater is None or compression is None:
+                outbound.write(wire, droppable)
+            else:
+                sender = shared.get(user.codec)
+                if sender is None:
+                    sender = shared[user.codec] = compression.shared(
+                        group, user.codec, wire, droppable
+                    )
+                sender.write(outbound)
+            count += 1
+            size += len(wire)
+        metrics = self.server.metrics
+        if metrics is not None and count:
+            metrics.bytes_out += size
+            metrics.sent(packet.type, count)
+        return packet, wires
+
+    def queue_stats(self) -> Dict[str, dict]:
+        """
+        Returns the outbound queue metrics of every registered user.
+
+        Returns:
+            Dict[str, dict]: OutboundQueue.stats() keyed by user ID.
+        """
+        return {str(id_): user.outbound.stats() for id_, user in self._registry.items()}
 
-    def send_to(self, data: str | bytes | dict, who: str | UserProtocol) -> None:
+    def send_to(self, data: str | bytes | dict, who: int | UserProtocol) -> None:
         """
         Sends data to a specific user.
 
@@ -178,7 +476,7 @@ class UserRegistry:
 
         Args:
             data (str | bytes | dict): The data to send.
-            who (str | UserProtocol): The user ID (string) or the UserProtocol object to send to.
+            who (int | UserProtocol): The user ID or the UserProtocol object to send to.
         """
         data = self.pack_packet(data)
 
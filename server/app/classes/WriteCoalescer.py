@@ -0,0 +1,65 @@
+from typing import List
+from twisted.internet import reactor
+
+
+class WriteCoalescer:
+    """
+    Flushes the write batches of every OutboundQueue once per reactor tick.
+
+    Queues append what they are given to a batch and add themselves to
+    ``pending`` once per batch, calling ``schedule`` if no flush is scheduled
+    yet; a single DelayedCall then writes every batch with one
+    ``transport.write`` each, instead of one per packet.
+    """
+
+    def __init__(self, max_delay: float = 0.0, max_batch: int = 64 * 1024) -> None:
+        """
+        Initializes a new WriteCoalescer instance.
+
+        Args:
+            max_delay (float): Seconds a batch may wait. 0 flushes at the end of
+                the current reactor iteration.
+            max_batch (int): Batch size, in bytes, at which a queue writes
+                right away instead of waiting.
+        """
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self.pending: List = []
+        """Queues with a batch waiting, in the order they started it."""
+        self.call = None
+
+        self.flushes = 0
+        self.batches = 0
+        self.packets = 0
+
+    def schedule(self) -> None:
+        """Schedules the flush of the pending queues."""
+        self.call = reactor.callLater(self.max_delay, self.flush)
+
+    def flush(self) -> None:
+        """Writes every waiting batch."""
+        self.call = None
+        pending, self.pending = self.pending, []
+        self.flushes += 1
+        for queue in pending:
+            queue.flush_batch()
+
+    def stop(self) -> None:
+        """Writes what is waiting and cancels the scheduled flush."""
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.flush()
+
+    def stats(self) -> dict:
+        """
+        Returns the coalescer's counters.
+
+        Returns:
+            dict: Flushes, batches written and the packets they held.
+        """
+        return {
+            "flushes": self.flushes,
+            "batches": self.batches,
+            "packets": self.packets,
+            "packets_per_batch": self.packets / self.batches if self.batches else 0.0,
+        }
@@ -22,3 +22,13 @@ class UserJoinState(Enum):
     USERNAME = 2
     # PASSWORD = 3
     JOINED = 4
+
+
+class OverflowPolicy(Enum):
+    """
+    What an outbound queue does once a slow client exceeds its limits.
+    """
+
+    DROP_OLDEST = "drop_oldest"
+    COALESCE = "coalesce"
+    DISCONNECT = "disconnect"
@@ -0,0 +1,199 @@
+"""Server side of the negotiated deflate compression; see common.compression.
+
+Every compressed connection has a Deflater on its OutboundQueue. Fan-outs
+also go through shared compressors: one CompressionGroup per group name
+(everyone, or a channel) and codec. A group frame is compressed once and
+the same bytes are written to every recipient that decoded all of the
+group's previous frames. Anyone else (new members, or connections whose
+queue is holding frames back) gets the packet through its own compressor
+instead, until the group's next reset frame brings them in. Groups reset
+once recipients were left out and ``reset_every`` frames went by since the
+last reset, or right away if nobody is in sync.
+"""
+
+import zlib
+from collections import OrderedDict
+from common.compression import (
+    FLAG_GROUP,
+    FLAG_GROUP_RESET,
+    GROUP_ID,
+    Deflater,
+    deflate,
+)
+from common.packets import Codec, frame
+
+
+class CompressionGroup:
+    """A compressor shared by the recipients of one kind of fan-out."""
+
+    __slots__ = ("id", "compressor", "seq", "since_reset", "synced", "pending")
+
+    def __init__(self, id_: int) -> None:
+        self.id = id_
+        self.compressor = None
+        self.seq = 0
+        """Number of frames compressed so far; recipients store the next one they can decode."""
+        self.since_reset = 0
+        self.synced = 0
+        """Recipients that got the latest frame through the group."""
+        self.pending = False
+        """Whether a recipient was left out since the last reset."""
+
+
+class SharedFrame:
+    """One fan-out's packet for the members of a CompressionGroup."""
+
+    __slots__ = ("groups", "group", "wire", "droppable", "seq", "reset", "encoded")
+
+    def __init__(
+        self,
+        groups: "CompressionGroups",
+        group: CompressionGroup,
+        wire: bytes,
+        droppable: bool,
+    ) -> None:
+        self.groups = groups
+        self.group = group
+        self.wire = wire
+        self.droppable = droppable
+        self.seq = group.seq
+        self.reset = not group.synced or (
+            group.pending and group.since_reset >= groups.reset_every
+        )
+        self.encoded = None
+
+    def write(self, outbound) -> None:
+        """
+        Writes the packet to one recipient, shared if it can decode the group's frame.
+
+        Args:
+            outbound (OutboundQueue): The recipient's queue, with a deflater.
+        """
+        deflater = outbound.deflater
+        group = self.group
+        if len(self.wire) >= deflater.min_size and (
+            self.reset or deflater.groups.get(group.id) == self.seq
+        ):
+            if self.encoded is None:
+                self.encoded = self.groups.compress(group, self.wire, self.reset)
+            if outbound.write_shared(self.encoded, self.wire, self.droppable):
+                deflater.synced(group.id, self.seq + 1)
+                group.synced += 1
+                return
+            # Queued: compressed with the connection's own context once flushed.
+        else:
+            outbound.write(self.wire, self.droppable)
+        if len(self.wire) >= deflater.min_size:
+            group.pending = True
+            self.groups.private += 1
+
+
+class CompressionGroups:
+    """The compression settings, and the shared compressors by group name and codec."""
+
+    def __init__(
+        self,
+        min_size: int = 128,
+        level: int = 6,
+        window_bits: int = 12,
+        mem_level: int = 5,
+        reset_every: int = 64,
+        max_groups: int = 1024,
+    ) -> None:
+        """
+        Initializes a new CompressionGroups instance.
+
+        Args:
+            min_size (int): Smallest write, in framed bytes, that is compressed.
+            level (int): zlib compression level.
+            window_bits (int): Base two logarithm of each compressor's context, 9 to 15.
+            mem_level (int): zlib memory level, 1 to 9.
+            reset_every (int): Least frames between resets of a group that left
+                recipients out.
+            max_groups (int): Most groups kept; the least recently used are dropped.
+        """
+        self.min_size = min_size
+        self.level = level
+        self.window_bits = window_bits
+        self.mem_level = mem_level
+        self.reset_every = reset_every
+        self.max_groups = max_groups
+
+        self.groups: OrderedDict = OrderedDict()
+        """``(name, codec name)`` to CompressionGroup, least recently used first."""
+        self.next_id = 0
+
+        self.frames = 0
+        self.resets = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.private = 0
+
+    def deflater(self) -> Deflater:
+        """Returns a Deflater for a connection that agreed to compression."""
+        return Deflater(
+            self.min_size, self.level, self.window_bits, self.mem_level, self.max_groups
+        )
+
+    def shared(self, name: str, codec: Codec, wire: bytes, droppable: bool) -> SharedFrame:
+        """
+        Starts sending a fan-out's packet through a group's compressor.
+
+        Args:
+            name (str): The group, e.g. ``*`` for everyone or a channel.
+            codec (Codec): The codec ``wire`` is encoded with.
+            wire (bytes): The framed packet.
+            droppable (bool): Whether a full queue may discard it.
+
+        Returns:
+            SharedFrame: Writes the packet to each recipient.
+        """
+        key = (name, codec.name)
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = CompressionGroup(self.next_id)
+            self.next_id = (self.next_id + 1) % (1 << 32)
+            if len(self.groups) > self.max_groups:
+                self.groups.popitem(last=False)
+        else:
+            self.groups.move_to_end(key)
+        return SharedFrame(self, group, wire, droppable)
+
+    def compress(self, group: CompressionGroup, wire: bytes, reset: bool) -> bytes:
+        """Compresses a group's next frame, starting a new context if ``reset``."""
+        if reset:
+            compressor = group.compressor = zlib.compressobj(
+                self.level, zlib.DEFLATED, -self.window_bits, self.mem_level
+            )
+            group.since_reset = 0
+            group.pending = False
+            self.resets += 1
+            flag = FLAG_GROUP_RESET
+        else:
+            compressor = group.compressor
+            flag = FLAG_GROUP
+        group.seq += 1
+        group.since_reset += 1
+        group.synced = 0
+        data = frame(bytes((flag,)) + GROUP_ID.pack(group.id) + deflate(compressor, wire))
+        self.frames += 1
+        self.bytes_in += len(wire)
+        self.bytes_out += len(data)
+        return data
+
+    def stats(self) -> dict:
+        """
+        Returns the shared compressors' counters.
+
+        Returns:
+            dict: Groups, frames and resets, bytes before and after
+            compression, and recipients that needed a private copy.
+        """
+        return {
+            "groups": len(self.groups),
+            "frames": self.frames,
+            "resets": self.resets,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "private": self.private,
+        }
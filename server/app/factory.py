@@ -2,7 +2,20 @@ from configparser import ConfigParser
 from pathlib import Path
 from common.events import EventHandler
 from app.classes.UserRegistry import UserRegistry
+from app.classes.ChannelRegistry import ChannelRegistry
 from app.classes.UserProtocol import UserProtocol
+from app.classes.enums import OverflowPolicy
+from app.classes.RateLimiter import RateLimiter
+from app.classes.WriteCoalescer import WriteCoalescer
+from app.classes.Heartbeat import Heartbeat
+from app.backplane import Backplane, LocalBackplane
+from app.history import HistoryLog
+from app.metrics import Metrics
+from app.compression import CompressionGroups
+from app.reactors import run_handler
+from app.profiler import ReactorProfiler
+from app.search import SearchIndex
+from app.sessions import SessionStore
 from twisted.internet.protocol import Protocol
 from twisted.internet.protocol import ServerFactory as ServFactory
 import os
@@ -22,17 +35,205 @@ logger = logging.getLogger("Server")
 
 class ServerFactory(ServFactory):
     def __init__(self, config: ConfigParser) -> None:
-        self.users = UserRegistry(self)
-
-        self.events = EventHandler()
         self.base = BASE
         self.config = config
+        self.motd = config.get("General", "motd", fallback="")
+        self.events = EventHandler()
+        self.events.runner = run_handler
+        self.metrics: Metrics | None = None
+        """Counters and latency histograms; see app.metrics."""
+        self.users = UserRegistry(self)
+        self.events.on("Connection.Made", self.users.addUser)
+        self.events.on("Connection.Adopted", self.users.adopt)
+        self.events.on("Connection.Lost", self.users.removeUser)
+        self.events.on("Recv.MessagePacket", self.users.relay)
+        self.backplane: Backplane = LocalBackplane()
+        """Connects this node to the rest of the cluster; see app.backplane."""
+
+        self.channels = ChannelRegistry(
+            self,
+            max_per_user=config.getint("Channels", "max_per_user", fallback=64),
+            max_name_length=config.getint("Channels", "max_name_length", fallback=64),
+        )
+        self.events.on("Connection.Adopted", self.channels.rejoin)
+        self.events.on("Connection.Lost", self.channels.leave_all)
+        self.events.on("Recv.ChannelJoinPacket", self.channels.on_join)
+        self.events.on("Recv.ChannelLeavePacket", self.channels.on_leave)
+        self.events.on("Recv.ChannelMessagePacket", self.channels.on_message)
+
         self.debug = config.getboolean("Server", "debug")
+        self.codecs = [
+            name.strip()
+            for name in config.get("Server", "codecs", fallback="binary, json").split(",")
+        ]
+        self.outbound_max_bytes = config.getint(
+            "Outbound", "max_bytes", fallback=1024 * 1024
+        )
+        self.outbound_max_packets = config.getint(
+            "Outbound", "max_packets", fallback=2048
+        )
+        self.outbound_policy = OverflowPolicy(
+            config.get("Outbound", "overflow", fallback="drop_oldest")
+        )
+        self.coalescer: WriteCoalescer | None = None
+        if config.getboolean("Outbound", "coalesce", fallback=False):
+            self.coalescer = WriteCoalescer(
+                max_delay=config.getfloat("Outbound", "max_delay", fallback=0.0),
+                max_batch=config.getint("Outbound", "max_batch", fallback=64 * 1024),
+            )
+        self.compression: CompressionGroups | None = None
+        """Settings and shared compressors of the negotiated compression."""
+        if config.getboolean("Compression", "enabled", fallback=False):
+            self.compression = CompressionGroups(
+                min_size=config.getint("Compression", "min_size", fallback=128),
+                level=config.getint("Compression", "level", fallback=6),
+                window_bits=config.getint("Compression", "window_bits", fallback=12),
+                mem_level=config.getint("Compression", "mem_level", fallback=5),
+                reset_every=config.getint("Compression", "group_reset", fallback=64),
+                max_groups=config.getint("Compression", "max_groups", fallback=1024),
+            )
+        self.limiter: RateLimiter | None = None
+        if config.getboolean("Limits", "enabled", fallback=False):
+            self.limiter = RateLimiter(
+                self,
+                packets=config.getfloat("Limits", "packets_per_second", fallback=0),
+                bytes_=config.getfloat("Limits", "bytes_per_second", fallback=0),
+                ip_packets=config.getfloat("Limits", "ip_packets_per_second", fallback=0),
+                ip_bytes=config.getfloat("Limits", "ip_bytes_per_second", fallback=0),
+                global_packets=config.getfloat(
+                    "Limits", "global_packets_per_second", fallback=0
+                ),
+                global_bytes=config.getfloat(
+                    "Limits", "global_bytes_per_second", fallback=0
+                ),
+                burst=config.getfloat("Limits", "burst", fallback=2.0),
+                strike_window=config.getfloat("Limits", "strike_window", fallback=5.0),
+                delay_after=config.getint("Limits", "delay_after", fallback=3),
+                kick_after=config.getint("Limits", "kick_after", fallback=10),
+            )
+            self.events.on("Connection.Lost", self.limiter.detach)
+
+        self.heartbeat: Heartbeat | None = None
+        """Pings, idle and AFK timeouts on one timing wheel."""
+        if config.getboolean("Heartbeat", "enabled", fallback=False):
+            self.heartbeat = Heartbeat(
+                self,
+                tick=config.getfloat("Heartbeat", "tick", fallback=1.0),
+                slots=config.getint("Heartbeat", "slots", fallback=512),
+                ping_interval=config.getfloat("Heartbeat", "ping_interval", fallback=30.0),
+                idle_timeout=config.getfloat("Heartbeat", "idle_timeout", fallback=90.0),
+                afk_timeout=config.getfloat("Heartbeat", "afk_timeout", fallback=300.0),
+            )
+            self.heartbeat.attach(self.events)
+
+        self.history: HistoryLog | None = None
+        if config.getboolean("History", "enabled", fallback=False):
+            self.history = HistoryLog(
+                BASE.joinpath(config.get("History", "path", fallback="history")),
+                replay=config.getint("History", "replay", fallback=50),
+                segment_bytes=config.getint(
+                    "History", "segment_bytes", fallback=4 * 1024 * 1024
+                ),
+                retain_bytes=config.getint(
+                    "History", "retain_bytes", fallback=64 * 1024 * 1024
+                ),
+                retain_age=config.getfloat(
+                    "History", "retain_age", fallback=7 * 24 * 3600
+                ),
+                fsync_interval=config.getfloat("History", "fsync_interval", fallback=1.0),
+            )
+            self.events.on("User.Joined", self.history.replay)
+            self.events.on("Recv.MessagePacket", self.history.append)
+            self.events.on("Remote.MessagePacket", self.history.append)
+
+        self.search: SearchIndex | None = None
+        if self.history is not None and config.getboolean(
+            "History", "search", fallback=False
+        ):
+            self.search = SearchIndex(
+                self.history,
+                max_limit=config.getint("History", "search_max_results", fallback=50),
+            )
+            self.search.rebuild()
+            self.events.on("Recv.SearchPacket", self.search.on_search)
+
+        self.sessions: SessionStore | None = None
+        """Resumable sessions and the messages they replay; see app.sessions."""
+        if config.getboolean("Sessions", "enabled", fallback=False):
+            self.sessions = SessionStore(
+                self,
+                size=config.getint("Sessions", "buffer", fallback=1024),
+                ttl=config.getfloat("Sessions", "ttl", fallback=120.0),
+                max_sessions=config.getint("Sessions", "max_sessions", fallback=100_000),
+                join_timeout=config.getfloat("Sessions", "join_timeout", fallback=0.5),
+            )
+            # Attached after the history, so the token follows the replayed
+            # messages and clients count the messages from its seq.
+            self.sessions.attach(self.events)
+
+        if config.getboolean("Metrics", "enabled", fallback=True):
+            self.metrics = Metrics(
+                self,
+                admin_hosts=[
+                    host.strip()
+                    for host in config.get("Metrics", "admin_hosts", fallback="").split(",")
+                    if host.strip()
+                ],
+                admin_token=config.get("Metrics", "admin_token", fallback=""),
+            )
+            self.metrics.attach(self.events)
+
+        self.profiler = ReactorProfiler(
+            self,
+            BASE.joinpath(config.get("Profiling", "path", fallback="profiles")),
+            seconds=config.getfloat("Profiling", "seconds", fallback=10.0),
+            mode=config.get("Profiling", "mode", fallback="sample"),
+            interval=config.getfloat("Profiling", "interval", fallback=0.005),
+            stall_threshold=config.getfloat("Profiling", "stall_threshold", fallback=0.25),
+            watch_stalls=config.getboolean("Profiling", "watch_stalls", fallback=False),
+            max_seconds=config.getfloat("Profiling", "max_seconds", fallback=300.0),
+        )
+        """Profiles the reactor on SIGUSR2 or an admin ProfilePacket."""
+        self.events.on("Recv.ProfilePacket", self.profiler.on_profile)
+
         if self.debug:
             logger.setLevel(logging.DEBUG)
             logger.debug("[green bold]Debugging mode enabled.[/]")
+            self.events.on("*", self.debug_event)
 
         logger.info("Server starting.")
 
+    def startFactory(self) -> None:
+        if self.history is not None:
+            self.history.start()
+        self.profiler.start()
+        if self.heartbeat is not None:
+            self.heartbeat.start()
+        endpoint = self.config.get("Metrics", "endpoint", fallback="")
+        if self.metrics is not None and endpoint:
+            self.metrics.listen(endpoint)
+
+    def stopFactory(self) -> None:
+        if self.coalescer is not None:
+            self.coalescer.stop()
+        self.profiler.stop()
+        if self.heartbeat is not None:
+            self.heartbeat.stop()
+        if self.metrics is not None:
+            self.metrics.stop()
+        if self.search is not None:
+            self.search.close()
+        if self.history is not None:
+            self.history.close()
+
+    def debug_event(self, *args, **kwargs) -> None:
+        """
+        Logs every event in debugging mode.
+
+        Only the types of the arguments are logged, since formatting a packet
+        would parse the body of every lazily decoded one.
+        """
+        logger.debug(" ".join(type(arg).__name__ for arg in (*args, *kwargs.values())))
+
     def buildProtocol(self, addr) -> Protocol:
         return UserProtocol(self)
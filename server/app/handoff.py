@@ -0,0 +1,353 @@
+"""Zero-downtime restarts: handing the port and connections to a new process.
+
+A running server listens on a Unix socket (``[Server] handoff_socket``).
+A new process started with ``main.py --takeover`` connects to it before
+building its ServerFactory, and the old process, in a single reactor
+callback:
+
+1. flushes its write batches and stops accepting;
+2. sends the listening socket and the sessions (``SessionStore.handoff_state``),
+   then every registered connection with its UserProtocol state
+   (``UserProtocol.handoff_state``), as descriptors over SCM_RIGHTS, in
+   messages of at most MAX_FDS descriptors;
+3. stops reading and writing those connections without closing them.
+
+It then stops its factory (history, search, metrics endpoint), closes the
+handoff socket and, once those are released, sends ``done`` and exits. The
+new process adopts the listening socket and each connection (see
+``UserProtocol.restore``) and serves them without a single disconnect;
+connections queue in the kernel meanwhile. Clients that were still joining
+are not handed off and have to reconnect.
+
+Messages are a 4-byte length and a JSON object; one carrying descriptors
+says how many in ``fds``.
+"""
+
+import json
+import logging
+import os
+import socket
+import struct
+import tempfile
+from pathlib import Path
+from typing import List, Tuple
+
+from twisted.internet import defer, reactor
+from twisted.internet.protocol import Factory
+from twisted.protocols.basic import LineReceiver
+
+logger = logging.getLogger("Server")
+
+VERSION = 1
+"""Handoff protocol version; both processes must speak the same."""
+HEADER = struct.Struct("!I")
+MAX_FDS = 250
+"""Descriptors per message; Linux takes at most 253 in one SCM_RIGHTS message."""
+
+
+class HandoffError(Exception):
+    """Raised when the handoff protocol is broken off or malformed."""
+
+
+def handoff_path(config) -> str:
+    """
+    Returns the path of the handoff socket.
+
+    Args:
+        config (ConfigParser): The server config.
+
+    Returns:
+        str: ``[Server] handoff_socket``, by default a socket named after the
+        port in the temporary directory.
+    """
+    port = config.get("Server", "port")
+    return config.get(
+        "Server",
+        "handoff_socket",
+        fallback=str(Path(tempfile.gettempdir(), f"chatremake-{port}-handoff.sock")),
+    )
+
+
+def send_message(sock: socket.socket, message: dict, fds: List[int] = ()) -> None:
+    """
+    Sends one message, with descriptors attached to its first byte.
+
+    Args:
+        sock (socket.socket): A blocking Unix stream socket.
+        message (dict): The message; ``fds`` is set to the descriptor count.
+        fds (List[int]): Descriptors to pass.
+    """
+    if fds:
+        message["fds"] = len(fds)
+    data = json.dumps(message, separators=(",", ":")).encode()
+    data = HEADER.pack(len(data)) + data
+    sent = socket.send_fds(sock, [data], list(fds)) if fds else 0
+    sock.sendall(data[sent:])
+
+
+class MessageReader:
+    """Reads messages and the descriptors passed with them from a Unix stream socket."""
+
+    def __init__(self, sock: socket.socket) -> None:
+        self.sock = sock
+        self.data = bytearray()
+        self.fds: List[int] = []
+        """Descriptors received but not yet claimed by a message, in order."""
+
+    def read(self) -> Tuple[dict, List[int]]:
+        """
+        Reads the next message.
+
+        Raises:
+            HandoffError: If the peer closed the socket or sent too many descriptors.
+
+        Returns:
+            Tuple[dict, List[int]]: The message and its descriptors.
+        """
+        data = self.data
+        while True:
+            if len(data) >= HEADER.size:
+                (length,) = HEADER.unpack_from(data)
+                end = HEADER.size + length
+                if len(data) >= end:
+                    message = json.loads(bytes(data[HEADER.size : end]))
+                    del data[:end]
+                    count = message.get("fds", 0)
+                    if count > len(self.fds):
+                        raise HandoffError("Descriptors missing from a message.")
+                    fds, self.fds = self.fds[:count], self.fds[count:]
+                    return message, fds
+            chunk, fds, flags, _ = socket.recv_fds(self.sock, 1 << 16, MAX_FDS)
+            self.fds.extend(fds)
+            if flags & socket.MSG_CTRUNC:
+                raise HandoffError("Descriptors were dropped in transit.")
+            if not chunk:
+                raise HandoffError("The serving process closed the handoff socket.")
+            data += chunk
+
+    def close(self) -> None:
+        """Closes descriptors that no message claimed."""
+        for fd in self.fds:
+            os.close(fd)
+        self.fds = []
+
+
+class HandoffProtocol(LineReceiver):
+    """The serving side of one handoff connection; the new process asks with ``takeover``."""
+
+    delimiter = b"\n"
+
+    def lineReceived(self, line: bytes) -> None:
+        if line.strip() == b"takeover":
+            self.factory.release(self.transport)
+        else:
+            self.transport.loseConnection()
+
+
+class Handoff(Factory):
+    """Hands a serving process's port and connections to a new process."""
+
+    protocol = HandoffProtocol
+    noisy = False
+
+    def __init__(self, server, port, path: str) -> None:
+        """
+        Initializes a new Handoff instance.
+
+        Args:
+            server (ServerFactory): The server to hand off.
+            port (IListeningPort): The port it accepts users on.
+            path (str): Path of the handoff socket.
+        """
+        from app.factory import ServerFactory as Server
+
+        self.server: Server = server
+        self.port = port
+        self.path = path
+        self.listening = None
+        self.released = False
+
+    def listen(self) -> None:
+        """Starts accepting handoff requests, replacing a stale socket file."""
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        self.listening = reactor.listenUNIX(self.path, self, mode=0o600)
+        logger.info(f"Accepting handoffs on {self.path}")
+
+    def release(self, transport) -> None:
+        """
+        Sends the port and the registered connections, then stops this process.
+
+        If the new process goes away before it has everything, this process
+        keeps serving.
+
+        Args:
+            transport: The handoff connection of the new process.
+        """
+        if self.released:
+            transport.loseConnection()
+            return
+        server = self.server
+        users = [user for user in server.users if not user.outbound.closed]
+        sock = socket.socket(fileno=os.dup(transport.fileno()))
+        sock.setblocking(True)
+        if server.coalescer is not None:
+            server.coalescer.stop()
+        self.port.stopReading()
+        try:
+            send_message(
+                sock,
+                {
+                    "version": VERSION,
+                    "family": int(self.port.addressFamily),
+                    "users": len(users),
+                    "sessions": (
+                        server.sessions.handoff_state()
+                        if server.sessions is not None
+                        else None
+                    ),
+                },
+                [self.port.fileno()],
+            )
+            for start in range(0, len(users), MAX_FDS):
+                chunk = users[start : start + MAX_FDS]
+                send_message(
+                    sock,
+                    {"users": [user.handoff_state() for user in chunk]},
+                    [user.transport.fileno() for user in chunk],
+                )
+        except OSError as e:
+            logger.error(f"Handoff failed, still serving: {e}")
+            sock.close()
+            transport.loseConnection()
+            self.port.startReading()
+            return
+
+        self.released = True
+        for user in users:
+            # The new process owns these now. Closing our descriptors later
+            # doesn't end the connections; a shutdown() would.
+            user.transport.stopReading()
+            user.transport.stopWriting()
+            user.outbound.stopProducing()
+        logger.info(f"Handed off the port and {len(users)} connections.")
+
+        released = [self.listening.stopListening()]
+        if server.metrics is not None:
+            released.append(server.metrics.stop())
+        server.doStop()
+        d = defer.DeferredList([d for d in released if d is not None])
+        d.addBoth(lambda _: self._done(sock, transport))
+
+    def _done(self, sock: socket.socket, transport) -> None:
+        try:
+            send_message(sock, {"done": True})
+        except OSError as e:
+            logger.error(f"Handoff finished with an error: {e}")
+        sock.close()
+        transport.loseConnection()
+        reactor.stop()
+
+
+class Takeover:
+    """The port and connections received from the process serving before."""
+
+    def __init__(self, listener: int, family: int, sessions: dict = None) -> None:
+        self.listener = listener
+        self.family = family
+        self.sessions = sessions
+        """``SessionStore.handoff_state`` of the serving process, if it had sessions."""
+        self.users: List[Tuple[int, dict]] = []
+        """Descriptor and ``UserProtocol.handoff_state`` of each connection."""
+
+    @classmethod
+    def receive(cls, path: str, timeout: float = 10.0) -> "Takeover | None":
+        """
+        Asks the server listening on a handoff socket for its port and connections.
+
+        Args:
+            path (str): The handoff socket.
+            timeout (float): Seconds to wait for each read.
+
+        Raises:
+            HandoffError: If the serving process broke off the handoff.
+            OSError: If reading timed out.
+
+        Returns:
+            Takeover | None: What was received, or None if no server listens there.
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            sock.close()
+            return None
+        reader = MessageReader(sock)
+        takeover = None
+        try:
+            sock.sendall(b"takeover\n")
+            header, fds = reader.read()
+            if header.get("version") != VERSION or len(fds) != 1:
+                raise HandoffError(f"Unsupported handoff {header}.")
+            takeover = cls(fds[0], header["family"], header.get("sessions"))
+            while True:
+                message, fds = reader.read()
+                if message.get("done"):
+                    return takeover
+                takeover.users.extend(zip(fds, message["users"]))
+        except BaseException:
+            if takeover is not None:
+                takeover.close()
+            raise
+        finally:
+            reader.close()
+            sock.close()
+
+    def adopt(self, factory):
+        """
+        Serves the port and the connections with a factory.
+
+        The sessions are restored first, so adopted users are tied to theirs.
+
+        Args:
+            factory (ServerFactory): The new server.
+
+        Returns:
+            IListeningPort: The adopted port.
+        """
+        if self.sessions is not None and factory.sessions is not None:
+            factory.sessions.restore(self.sessions)
+        port = reactor.adoptStreamPort(self.listener, self.family, factory)
+        os.close(self.listener)
+        users, self.users = self.users, []
+        for fd, state in users:
+            try:
+                reactor.adoptStreamConnection(fd, self.family, AdoptedUser(factory, state))
+            except OSError as e:
+                logger.warning(f"[{state['id']}] Could not adopt the connection: {e}")
+            finally:
+                os.close(fd)
+        return port
+
+    def close(self) -> None:
+        """Closes every descriptor received, without ending the connections."""
+        os.close(self.listener)
+        for fd, _ in self.users:
+            os.close(fd)
+        self.users = []
+
+
+class AdoptedUser(Factory):
+    """Builds the UserProtocol of one adopted connection from its handed off state."""
+
+    def __init__(self, server, state: dict) -> None:
+        self.server = server
+        self.state = state
+
+    def buildProtocol(self, addr):
+        user = self.server.buildProtocol(addr)
+        user.restore(self.state)
+        return user
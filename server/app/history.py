@@ -0,0 +1,466 @@
+"""Append-only message history.
+
+Chat messages are appended to a log split into segment files. Each segment
+is a ``.log`` file holding the framed packets, exactly as they are written to
+clients, and a ``.index`` file holding the byte offset of every record.
+Records are numbered with a sequence number that keeps counting across
+segments, so the index turns a sequence number into a file offset without a
+scan.
+
+Appends go through buffered files and are fsynced in batches on a timer, off
+the reactor thread. Reads map the segments with ``mmap``, so replaying the
+tail of the log to a joining user is one slice per segment and one write.
+Full segments are sealed and a new one is started; sealed segments are
+deleted once the log grows past its size limit or they get too old.
+"""
+
+import logging
+import mmap
+import os
+import struct
+import time
+from array import array
+from pathlib import Path
+from typing import List
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted.internet.threads import deferToThread
+
+from common.events import EventHandler
+from common.packets import (
+    DEFAULT_CODEC,
+    FRAME_HEADER,
+    BasePacket,
+    frame,
+    payload_codec,
+)
+
+logger = logging.getLogger("Server")
+
+INDEX_ENTRY = struct.Struct("!Q")
+"""One index record: the byte offset of a frame in the segment's log."""
+
+
+class Segment:
+    """One log file of the history and its offset index."""
+
+    def __init__(self, directory: Path, base: int) -> None:
+        """
+        Opens a segment, creating its files if they don't exist yet.
+
+        Args:
+            directory (Path): The history directory.
+            base (int): Sequence number of the segment's first record.
+        """
+        self.base = base
+        self.log_path = directory.joinpath(f"{base:020d}.log")
+        self.index_path = directory.joinpath(f"{base:020d}.index")
+        self.log_path.touch()
+        self.index_path.touch()
+
+        self.positions = array("Q")
+        """Offsets of the records, only kept in memory while the segment is active."""
+        self.count = self.index_path.stat().st_size // INDEX_ENTRY.size
+        self.size = self.log_path.stat().st_size
+        self.log = None
+        self.index = None
+
+        self._log_map = None
+        self._index_map = None
+        self._mapped = 0
+
+    @property
+    def end(self) -> int:
+        """Sequence number following the segment's last record."""
+        return self.base + self.count
+
+    @property
+    def modified(self) -> float:
+        return self.log_path.stat().st_mtime
+
+    def activate(self) -> None:
+        """
+        Opens the segment for appending.
+
+        Loads the offset index and repairs the tail of the log, which may hold
+        a partly written frame or lack index entries after a crash.
+        """
+        with open(self.index_path, "rb") as f:
+            data = f.read()
+        data = data[: len(data) - len(data) % INDEX_ENTRY.size]
+        positions = array("Q", (p for (p,) in INDEX_ENTRY.iter_unpack(data)))
+
+        size = self.log_path.stat().st_size
+        while positions and positions[-1] >= size:
+            positions.pop()
+        position = positions.pop() if positions else 0
+
+        with open(self.log_path, "rb") as f:
+            f.seek(position)
+            tail = f.read()
+        offset = 0
+        while offset + FRAME_HEADER.size <= len(tail):
+            (length,) = FRAME_HEADER.unpack_from(tail, offset)
+            if offset + FRAME_HEADER.size + length > len(tail):
+                break
+            positions.append(position + offset)
+            offset += FRAME_HEADER.size + length
+
+        self.size = position + offset
+        if self.size != size:
+            logger.warning(
+                f"History: dropped {size - self.size} bytes of a partly written "
+                f"record in {self.log_path.name}."
+            )
+        self.positions = positions
+        self.count = len(positions)
+
+        self.log = open(self.log_path, "r+b")
+        self.log.truncate(self.size)
+        self.log.seek(self.size)
+        self.index = open(self.index_path, "r+b")
+        self.index.truncate(0)
+        self.index.write(b"".join(INDEX_ENTRY.pack(p) for p in positions))
+
+    def append(self, record: bytes) -> None:
+        """
+        Appends a framed record.
+
+        Args:
+            record (bytes): The framed packet.
+        """
+        self.positions.append(self.size)
+        self.index.write(INDEX_ENTRY.pack(self.size))
+        self.log.write(record)
+        self.size += len(record)
+        self.count += 1
+
+    def flush(self) -> None:
+        """Hands buffered appends to the OS, without waiting for the disk."""
+        if self.log is not None:
+            self.log.flush()
+            self.index.flush()
+
+    def filenos(self) -> List[int]:
+        return [self.log.fileno(), self.index.fileno()] if self.log is not None else []
+
+    def seal(self) -> None:
+        """Flushes, syncs and closes the segment's writers. It stays readable."""
+        if self.log is None:
+            return
+        self.flush()
+        for fd in self.filenos():
+            os.fsync(fd)
+        self.log.close()
+        self.index.close()
+        self.log = self.index = None
+        self.positions = array("Q")
+
+    def position(self, seq: int) -> int:
+        """
+        Returns the log offset of a record.
+
+        Args:
+            seq (int): Sequence number of a record in this segment.
+
+        Returns:
+            int: The byte offset of the record's frame.
+        """
+        i = seq - self.base
+        if self.log is not None:
+            return self.positions[i]
+        if self._index_map is None:
+            with open(self.index_path, "rb") as f:
+                self._index_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return INDEX_ENTRY.unpack_from(self._index_map, i * INDEX_ENTRY.size)[0]
+
+    def read(self, seq: int) -> bytes:
+        """
+        Returns the frames from a record to the end of the segment.
+
+        Args:
+            seq (int): Sequence number of the first record to read.
+
+        Returns:
+            bytes: The framed records, ready to be written to a client.
+        """
+        if seq >= self.end or self.size == 0:
+            return b""
+        return self._map_log()[self.position(seq) : self.size]
+
+    def record(self, seq: int) -> bytes:
+        """
+        Returns one record's payload, without its frame header.
+
+        Args:
+            seq (int): Sequence number of a record in this segment.
+
+        Returns:
+            bytes: The encoded packet.
+        """
+        log_map = self._map_log()
+        position = self.position(seq)
+        (length,) = FRAME_HEADER.unpack_from(log_map, position)
+        start = position + FRAME_HEADER.size
+        return log_map[start : start + length]
+
+    def _map_log(self) -> mmap.mmap:
+        """Maps the log, remapping it if records were appended since."""
+        if self._mapped < self.size:
+            self.flush()
+            self._unmap_log()
+            with open(self.log_path, "rb") as f:
+                self._log_map = mmap.mmap(f.fileno(), self.size, access=mmap.ACCESS_READ)
+            self._mapped = self.size
+        return self._log_map
+
+    def _unmap_log(self) -> None:
+        if self._log_map is not None:
+            self._log_map.close()
+            self._log_map = None
+            self._mapped = 0
+
+    def close(self) -> None:
+        self.seal()
+        self._unmap_log()
+        if self._index_map is not None:
+            self._index_map.close()
+            self._index_map = None
+
+    def delete(self) -> None:
+        self.close()
+        self.log_path.unlink(missing_ok=True)
+        self.index_path.unlink(missing_ok=True)
+
+
+class HistoryLog:
+    """
+    Segmented, append-only log of the messages broadcast on this node.
+
+    Fed from ``Recv.MessagePacket`` (and ``Remote.MessagePacket`` for
+    messages from other nodes); replays the last messages to every user that
+    joins. ``events`` emits ``History.Append`` with the sequence number and
+    packet of every record and ``History.Truncate`` with the new first
+    sequence number once old segments are deleted.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        replay: int = 50,
+        segment_bytes: int = 4 * 1024 * 1024,
+        retain_bytes: int = 64 * 1024 * 1024,
+        retain_age: float = 7 * 24 * 3600,
+        fsync_interval: float = 1.0,
+    ) -> None:
+        """
+        Opens the history in a directory, recovering any existing segments.
+
+        Args:
+            path (Path): Directory holding the segment files.
+            replay (int): Number of messages replayed to joining users.
+            segment_bytes (int): Size after which the active segment is sealed.
+            retain_bytes (int): Total size above which the oldest segments are deleted.
+            retain_age (float): Seconds after which a sealed segment is deleted.
+            fsync_interval (float): Seconds between batched fsyncs.
+        """
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.replay_count = replay
+        self.segment_bytes = segment_bytes
+        self.retain_bytes = retain_bytes
+        self.retain_age = retain_age
+        self.fsync_interval = fsync_interval
+        self.events = EventHandler()
+
+        bases = sorted(int(p.stem) for p in self.path.glob("*.log") if p.stem.isdigit())
+        self.segments = [Segment(self.path, base) for base in bases] or [
+            Segment(self.path, 0)
+        ]
+        self.segments[-1].activate()
+
+        self._syncing = None
+        self._retention = LoopingCall(self.enforce_retention)
+        self._tail = None
+        """Cached ``(seq, frames)`` of the last replay, dropped on append."""
+        self.enforce_retention()
+
+    @property
+    def active(self) -> Segment:
+        return self.segments[-1]
+
+    @property
+    def first_seq(self) -> int:
+        """Sequence number of the oldest retained record."""
+        return self.segments[0].base
+
+    @property
+    def next_seq(self) -> int:
+        """Sequence number the next record will get."""
+        return self.active.end
+
+    @property
+    def size(self) -> int:
+        return sum(segment.size for segment in self.segments)
+
+    def start(self) -> None:
+        """Starts the periodic retention check."""
+        if not self._retention.running:
+            self._retention.start(min(self.retain_age, 60.0), now=False)
+
+    def append(self, packet: BasePacket, user=None) -> int | None:
+        """
+        Appends a message. Handles ``Recv.MessagePacket``.
+
+        Messages are stored JSON encoded, the codec every connection starts
+        with, so replays are written without re-encoding. A received message
+        that is already JSON and passes ``BasePacket.forwardable`` is stored
+        as its raw bytes. Messages that fail verification are not stored.
+
+        Args:
+            packet (BasePacket): The message.
+            user (UserProtocol): The sender, unused.
+
+        Returns:
+            int | None: The message's sequence number, or None if it was invalid.
+        """
+        raw = packet.forwardable()
+        if raw is not None and payload_codec(raw) is DEFAULT_CODEC:
+            record = frame(raw)
+        elif packet.verify():
+            record = frame(DEFAULT_CODEC.encode(packet))
+        else:
+            return None
+
+        if self.active.size + len(record) > self.segment_bytes and self.active.count:
+            self.roll()
+        seq = self.active.end
+        self.active.append(record)
+        self._tail = None
+        self.events.emit("History.Append", seq, packet)
+        if self._syncing is None:
+            self._syncing = reactor.callLater(self.fsync_interval, self.sync)
+        return seq
+
+    def sync(self):
+        """
+        Flushes the active segment and fsyncs it in a worker thread.
+
+        Returns:
+            Deferred: Fires once the data is on disk.
+        """
+        self._syncing = None
+        segment = self.active
+        segment.flush()
+        # Duplicated descriptors stay valid if the segment is sealed meanwhile.
+        fds = [os.dup(fd) for fd in segment.filenos()]
+
+        def fsync():
+            for fd in fds:
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+
+        return deferToThread(fsync).addErrback(
+            lambda failure: logger.error(f"History: fsync failed: {failure.value}")
+        )
+
+    def roll(self) -> None:
+        """Seals the active segment and starts a new one."""
+        self.active.seal()
+        segment = Segment(self.path, self.active.end)
+        segment.activate()
+        self.segments.append(segment)
+        self.enforce_retention()
+
+    def enforce_retention(self) -> None:
+        """Deletes the oldest sealed segments that are over the size or age limit."""
+        cutoff = time.time() - self.retain_age
+        total = self.size
+        first = self.first_seq
+        while len(self.segments) > 1:
+            oldest = self.segments[0]
+            if total <= self.retain_bytes and oldest.modified >= cutoff:
+                break
+            total -= oldest.size
+            oldest.delete()
+            del self.segments[0]
+        if self.first_seq != first:
+            self.events.emit("History.Truncate", self.first_seq)
+
+    def read_from(self, seq: int) -> bytes:
+        """
+        Returns the framed records from a sequence number to the end of the log.
+
+        Args:
+            seq (int): Sequence number of the first record; clamped to the
+                retained range.
+
+        Returns:
+            bytes: The framed records.
+        """
+        seq = max(seq, self.first_seq)
+        chunks = [
+            segment.read(max(seq, segment.base))
+            for segment in self.segments
+            if segment.end > seq
+        ]
+        return b"".join(chunks)
+
+    def record(self, seq: int) -> bytes | None:
+        """
+        Returns one record's encoded packet.
+
+        Args:
+            seq (int): The record's sequence number.
+
+        Returns:
+            bytes | None: The JSON encoded packet, or None if the record was
+            deleted or doesn't exist yet.
+        """
+        if not self.first_seq <= seq < self.next_seq:
+            return None
+        for segment in reversed(self.segments):
+            if seq >= segment.base:
+                return segment.record(seq)
+
+    def tail(self, count: int) -> bytes:
+        """
+        Returns the last records of the log as framed bytes.
+
+        Args:
+            count (int): Number of records.
+
+        Returns:
+            bytes: The framed records, oldest first.
+        """
+        seq = max(self.next_seq - count, self.first_seq)
+        if self._tail is None or self._tail[0] != seq:
+            self._tail = (seq, self.read_from(seq))
+        return self._tail[1]
+
+    def replay(self, user) -> None:
+        """
+        Writes the latest messages to a user that just joined. Handles
+        ``User.Joined``.
+
+        Args:
+            user (UserProtocol): The user.
+        """
+        if self.replay_count <= 0:
+            return
+        data = self.tail(self.replay_count)
+        if data:
+            user.write(data)
+
+    def close(self) -> None:
+        """Stops the timers and seals and closes every segment."""
+        if self._retention.running:
+            self._retention.stop()
+        if self._syncing is not None and self._syncing.active():
+            self._syncing.cancel()
+        self._syncing = None
+        for segment in self.segments:
+            segment.close()
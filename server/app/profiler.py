@@ -0,0 +1,302 @@
+"""On-demand profiling of the live reactor.
+
+A ReactorProfiler profiles the reactor thread for a number of seconds when
+an operator asks for it (SIGUSR2, or an admin ProfilePacket), without
+restarting the server:
+
+- ``sample`` mode reads the reactor thread's stack from a background thread
+  every ``interval`` seconds and writes the counts as collapsed stacks
+  (``frame;frame;frame count`` lines), the input of flamegraph.pl and
+  speedscope. The reactor itself runs unmodified.
+- ``pstats`` mode runs cProfile on the reactor thread and dumps its stats,
+  readable with ``python -m pstats``. Exact, but slows every call down.
+
+Stalls are caught with a heartbeat: the reactor stamps the time every
+``stall_threshold / 2`` seconds and a watchdog thread grabs the reactor's
+stack once the stamp is older than ``stall_threshold``. When the reactor
+gets going again the stall is logged with its length and that stack, and
+appended to ``stalls.log``. Stalls are watched while profiling, or always
+with ``watch_stalls``.
+"""
+
+import cProfile
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from pathlib import Path
+from typing import Dict, List
+from twisted.internet import defer, reactor
+from twisted.internet.task import LoopingCall
+from common.packets import ProfilePacket
+
+logger = logging.getLogger("Server")
+
+MODES = ("sample", "pstats")
+
+
+class ReactorProfiler:
+    """Sampling or cProfile sessions over the reactor thread, and a stall watchdog."""
+
+    def __init__(
+        self,
+        server,
+        path: Path,
+        seconds: float = 10.0,
+        mode: str = "sample",
+        interval: float = 0.005,
+        stall_threshold: float = 0.25,
+        watch_stalls: bool = False,
+        max_seconds: float = 300.0,
+    ) -> None:
+        """
+        Initializes a new ReactorProfiler instance.
+
+        Args:
+            server (ServerFactory): The server being profiled.
+            path (Path): Directory the profiles and ``stalls.log`` are written to.
+            seconds (float): Default length of a session.
+            mode (str): Default mode, ``sample`` or ``pstats``.
+            interval (float): Seconds between stack samples.
+            stall_threshold (float): Seconds without the reactor running after
+                which it counts as stalled. 0 disables stall detection.
+            watch_stalls (bool): Watch for stalls outside sessions too.
+            max_seconds (float): Longest session an admin may ask for.
+        """
+        from app.factory import ServerFactory as Server
+
+        if mode not in MODES:
+            raise ValueError(f"Unknown profiling mode {mode!r}, expected one of {MODES}.")
+        self.server: Server = server
+        self.path = path
+        self.seconds = seconds
+        self.mode = mode
+        self.interval = interval
+        self.stall_threshold = stall_threshold
+        self.watch_stalls = watch_stalls
+        self.max_seconds = max_seconds
+
+        self.thread_id: int | None = None
+        """The reactor thread, set on start."""
+        self.session: dict | None = None
+        """The running session: its mode, end, result Deferred and samples."""
+        self.stalls = deque(maxlen=100)
+        """The latest stalls, as ``(time, seconds, stack)``."""
+
+        self._beat = time.monotonic()
+        self._heartbeat = LoopingCall(self._stamp)
+        self._stall_stack: List[str] | None = None
+        self._active = threading.Event()
+        """Set while the watchdog has a session or stalls to watch."""
+        self._watchdog: threading.Thread | None = None
+        self._stopped = False
+
+    def start(self) -> None:
+        """Starts watching for stalls if they are always watched."""
+        self.thread_id = threading.get_ident()
+        if self.watch_stalls:
+            self._watch()
+
+    def stop(self) -> None:
+        """Ends a running session and stops the watchdog."""
+        if self.session is not None:
+            self._finish()
+        self._stopped = True
+        self._active.set()
+        if self._heartbeat.running:
+            self._heartbeat.stop()
+
+    def profile(self, seconds: float = None, mode: str = None) -> defer.Deferred:
+        """
+        Profiles the reactor thread for a while. Must be called on the reactor thread.
+
+        Args:
+            seconds (float): How long to profile, above 0 and at most
+                ``max_seconds``. Defaults to the configured length.
+            mode (str): ``sample`` or ``pstats``. Defaults to the configured mode.
+
+        Returns:
+            Deferred: Fires with the path of the written profile, or fails with
+            ValueError if a session is already running, the mode is unknown or
+            the length is out of range.
+        """
+        mode = mode or self.mode
+        if mode not in MODES:
+            return defer.fail(ValueError(f"Unknown profiling mode {mode!r}."))
+        if self.session is not None:
+            return defer.fail(ValueError("A profiling session is already running."))
+        if seconds is None:
+            seconds = min(self.seconds, self.max_seconds)
+        try:
+            seconds = float(seconds)
+        except (TypeError, ValueError):
+            return defer.fail(ValueError(f"Invalid profiling length {seconds!r}."))
+        if not 0 < seconds <= self.max_seconds:
+            return defer.fail(
+                ValueError(f"Profiling length must be above 0 and at most {self.max_seconds:g}s.")
+            )
+        if self.thread_id is None:
+            self.thread_id = threading.get_ident()
+
+        result = defer.Deferred()
+        self.session = {
+            "mode": mode,
+            "started": time.time(),
+            "result": result,
+            "samples": {},
+            "count": 0,
+            "stalls": 0,
+            "profile": None,
+            "timer": reactor.callLater(seconds, self._finish),
+        }
+        if mode == "pstats":
+            profile = self.session["profile"] = cProfile.Profile()
+            profile.enable()
+        self._watch()
+        logger.warning(f"Profiling the reactor for {seconds:g}s ({mode}).")
+        return result
+
+    def _finish(self) -> None:
+        session, self.session = self.session, None
+        if not self.watch_stalls:
+            self._active.clear()
+        if session["timer"].active():
+            session["timer"].cancel()
+        name = f"profile-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}"
+        try:
+            self.path.mkdir(parents=True, exist_ok=True)
+            if session["mode"] == "pstats":
+                session["profile"].disable()
+                output = self.path.joinpath(f"{name}.pstats")
+                session["profile"].dump_stats(output)
+            else:
+                output = self.path.joinpath(f"{name}.folded")
+                samples: Dict[str, int] = dict(session["samples"])
+                with open(output, "w") as f:
+                    for stack, count in sorted(samples.items()):
+                        f.write(f"{stack} {count}\n")
+        except OSError as e:
+            logger.error(f"Could not write the profile: {e}")
+            session["result"].errback(e)
+            return
+        samples = f"{session['count']} samples, " if session["mode"] == "sample" else ""
+        logger.warning(
+            f"Profile written to {output} ({samples}{session['stalls']} stalls)."
+        )
+        session["result"].callback(output)
+
+    # Heartbeat, on the reactor thread
+
+    def _watch(self) -> None:
+        if self.stall_threshold and not self._heartbeat.running:
+            self._beat = time.monotonic()
+            self._heartbeat.start(self.stall_threshold / 2, now=False)
+        self._active.set()
+        if self._watchdog is None:
+            self._watchdog = threading.Thread(
+                target=self._run, name="Profiler", daemon=True
+            )
+            self._watchdog.start()
+
+    def _stamp(self) -> None:
+        now = time.monotonic()
+        gap, self._beat = now - self._beat, now
+        stack = self._stall_stack
+        if stack is not None:
+            self._stall_stack = None
+            self._stalled(gap, stack)
+        if self.session is None and not self.watch_stalls:
+            self._heartbeat.stop()
+
+    def _stalled(self, seconds: float, stack: List[str]) -> None:
+        self.stalls.append((time.time(), seconds, stack))
+        if self.session is not None:
+            self.session["stalls"] += 1
+        trace = "".join(stack)
+        logger.warning(f"Reactor stalled for {seconds * 1000:.0f} ms in:\n{trace}")
+        try:
+            self.path.mkdir(parents=True, exist_ok=True)
+            with open(self.path.joinpath("stalls.log"), "a") as f:
+                f.write(
+                    f"{time.strftime('%Y-%m-%dT%H:%M:%S')} pid {os.getpid()} "
+                    f"stalled {seconds * 1000:.0f} ms\n{trace}\n"
+                )
+        except OSError as e:
+            logger.error(f"Could not write the stall log: {e}")
+
+    # Watchdog thread
+
+    def _run(self) -> None:
+        while True:
+            self._active.wait()
+            if self._stopped:
+                return
+            session = self.session
+            sampling = session is not None and session["mode"] == "sample"
+            if sampling:
+                time.sleep(self.interval)
+            else:
+                time.sleep((self.stall_threshold or 1.0) / 4)
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            if sampling:
+                stack = self.collapse(frame)
+                samples = session["samples"]
+                samples[stack] = samples.get(stack, 0) + 1
+                session["count"] += 1
+            if (
+                self.stall_threshold
+                and self._stall_stack is None
+                and time.monotonic() - self._beat > self.stall_threshold
+            ):
+                # Reported by the heartbeat once the reactor runs again.
+                self._stall_stack = traceback.format_stack(frame)
+
+    @staticmethod
+    def collapse(frame) -> str:
+        """
+        Formats a stack as one collapsed line, outermost frame first.
+
+        Args:
+            frame (FrameType): The innermost frame.
+
+        Returns:
+            str: ``function (file:line);...`` without the count.
+        """
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(
+                f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            )
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+    # Admin command
+
+    def on_profile(self, packet: ProfilePacket, user) -> None:
+        """
+        Starts a session for an admin. Handles ``Recv.ProfilePacket``.
+
+        The user gets a ProfilePacket back once the profile is written.
+
+        Args:
+            packet (ProfilePacket): The request, with optional ``seconds`` and ``mode``.
+            user (UserProtocol): The user asking.
+        """
+        if not packet.verify():
+            return
+        metrics = self.server.metrics
+        if metrics is None or not metrics.is_admin(user, packet.data.get("token")):
+            logger.warning(f"[{user.info.id}] Refused a ProfilePacket from a non-admin.")
+            return
+        d = self.profile(packet.data.get("seconds"), packet.data.get("mode"))
+        d.addCallbacks(
+            lambda output: ProfilePacket({"path": str(output)}),
+            lambda failure: ProfilePacket({"error": failure.getErrorMessage()}),
+        )
+        d.addCallback(user.send)
@@ -0,0 +1,159 @@
+"""Choice of the Twisted reactor, and running coroutines on it.
+
+Twisted installs its platform default the first time anything imports
+``twisted.internet.reactor``, so ``main.py`` calls ``install_reactor``
+before importing the rest of the server. Nothing in this module may import
+the reactor at module level.
+
+Coroutine handlers and prechecks go through ``ensure_deferred``: on the
+asyncio reactor they run as asyncio tasks and can await asyncio code (and
+Deferreds, through ``Deferred.asFuture``); on the others they run through
+``Deferred.fromCoroutine`` and can await Deferreds.
+"""
+
+import argparse
+import logging
+import sys
+from collections.abc import Coroutine
+from typing import Callable, Dict, List
+
+logger = logging.getLogger("Server")
+
+
+def _epoll() -> None:
+    from twisted.internet import epollreactor
+
+    epollreactor.install()
+
+
+def _poll() -> None:
+    from twisted.internet import pollreactor
+
+    pollreactor.install()
+
+
+def _select() -> None:
+    from twisted.internet import selectreactor
+
+    selectreactor.install()
+
+
+def _asyncio(uvloop: bool | None = None) -> None:
+    """Installs the asyncio reactor, on uvloop if ``uvloop`` is True, or None and it is installed."""
+    import asyncio
+    from twisted.internet import asyncioreactor
+
+    if uvloop is not False:
+        try:
+            import uvloop as _uvloop
+        except ImportError:
+            if uvloop:
+                raise
+        else:
+            asyncioreactor.install(_uvloop.new_event_loop())
+            return
+    asyncioreactor.install(asyncio.new_event_loop())
+
+
+REACTORS: Dict[str, Callable[[], None]] = {
+    "default": lambda: None,
+    "epoll": _epoll,
+    "poll": _poll,
+    "select": _select,
+    "asyncio": _asyncio,
+    "uvloop": lambda: _asyncio(uvloop=True),
+    "asyncio-stdlib": lambda: _asyncio(uvloop=False),
+}
+"""Reactor names accepted by ``[Server] reactor``. ``asyncio`` uses uvloop when it is installed."""
+
+
+def install_reactor(name: str) -> str:
+    """
+    Installs a reactor by name, unless one is installed already.
+
+    Args:
+        name (str): One of REACTORS.
+
+    Raises:
+        ValueError: If the name is unknown.
+        ImportError: If the reactor needs a module that isn't installed
+            (e.g. ``uvloop``) or isn't available on this platform (``epoll``).
+
+    Returns:
+        str: The class name of the reactor now installed.
+    """
+    if name not in REACTORS:
+        raise ValueError(f"Unknown reactor {name!r}, expected one of {', '.join(REACTORS)}.")
+    if "twisted.internet.reactor" not in sys.modules:
+        REACTORS[name]()
+    elif name != "default":
+        logger.warning(f"A reactor was installed before [Server] reactor = {name}.")
+    from twisted.internet import reactor
+
+    return type(reactor).__name__
+
+
+def configured_reactor(argv: List[str], default_config: str) -> str:
+    """
+    Reads the reactor to install from the command line and the config file.
+
+    Only ``--reactor`` and ``--config`` are looked at, so this can run before
+    the rest of the arguments are parsed (and before Twisted is imported).
+
+    Args:
+        argv (List[str]): The command line arguments.
+        default_config (str): Config file used without ``--config``.
+
+    Returns:
+        str: ``--reactor`` if given, otherwise ``[Server] reactor``, otherwise ``default``.
+    """
+    import configparser
+
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--reactor")
+    parser.add_argument("--config", default=default_config)
+    args, _ = parser.parse_known_args(argv)
+    if args.reactor:
+        return args.reactor
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    return config.get("Server", "reactor", fallback="default").strip() or "default"
+
+
+def is_asyncio() -> bool:
+    """Whether the installed reactor runs on an asyncio event loop."""
+    from twisted.internet import reactor
+
+    return hasattr(reactor, "_asyncioEventloop")
+
+
+def ensure_deferred(coroutine: Coroutine):
+    """
+    Runs a coroutine on the reactor.
+
+    Args:
+        coroutine (Coroutine): The coroutine to run.
+
+    Returns:
+        Deferred: Fires with the coroutine's result. Cancelling it cancels
+        the coroutine.
+    """
+    from twisted.internet import defer, reactor
+
+    if is_asyncio():
+        import asyncio
+
+        return defer.Deferred.fromFuture(
+            asyncio.ensure_future(coroutine, loop=reactor._asyncioEventloop)
+        )
+    return defer.Deferred.fromCoroutine(coroutine)
+
+
+def run_handler(coroutine: Coroutine) -> None:
+    """Runs a coroutine returned by an event handler, logging what it raises."""
+    d = ensure_deferred(coroutine)
+    d.addErrback(
+        lambda failure: logger.error(
+            f"Coroutine handler {coroutine.__qualname__} failed: {failure.getErrorMessage()}"
+        )
+    )
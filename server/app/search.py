@@ -0,0 +1,303 @@
+"""Full-text search over the message history.
+
+Every message appended to the HistoryLog is tokenized into an inverted index
+that maps each word to the sequence numbers of the messages containing it.
+Posting lists are blocks of varint encoded deltas between sequence numbers,
+with each block's first and last sequence number kept in arrays, so lookups
+decode one block instead of a whole list.
+
+The index lives on a dedicated thread that owns it; the reactor only queues
+work to it and gets results back through ``callFromThread``, so neither
+indexing nor queries block the reactor. Results are the newest messages
+containing every word of the query, paged with a ``before`` cursor.
+"""
+
+import logging
+import queue
+import re
+import threading
+from array import array
+from bisect import bisect_left
+from typing import Dict, List, Tuple
+
+from twisted.internet import defer, reactor
+
+from common.packets import BasePacket, SearchPacket, SearchResultPacket
+
+logger = logging.getLogger("Server")
+
+TOKEN = re.compile(r"\w+")
+MAX_TOKEN_LENGTH = 64
+BLOCK_SIZE = 128
+"""Postings per compressed block."""
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Splits text into the distinct lowercase words that are indexed.
+
+    Args:
+        text (str): The message content or query.
+
+    Returns:
+        List[str]: The words, in order of first appearance.
+    """
+    words = dict.fromkeys(TOKEN.findall(text.lower()))
+    return [word for word in words if len(word) <= MAX_TOKEN_LENGTH]
+
+
+def _encode_deltas(docs) -> bytes:
+    out = bytearray()
+    previous = docs[0]
+    for doc in docs[1:]:
+        delta = doc - previous
+        previous = doc
+        while delta >= 0x80:
+            out.append((delta & 0x7F) | 0x80)
+            delta >>= 7
+        out.append(delta)
+    return bytes(out)
+
+
+def _decode_deltas(first: int, data: bytes) -> List[int]:
+    docs = [first]
+    doc = first
+    delta = shift = 0
+    for byte in data:
+        delta |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            doc += delta
+            docs.append(doc)
+            delta = shift = 0
+    return docs
+
+
+class Postings:
+    """Sorted sequence numbers of the messages containing one word."""
+
+    __slots__ = ("firsts", "lasts", "blocks", "tail", "count", "_decoded")
+
+    def __init__(self) -> None:
+        self.firsts = array("Q")
+        self.lasts = array("Q")
+        self.blocks: List[bytes] = []
+        """Varint encoded deltas following each block's first sequence number."""
+        self.tail = array("Q")
+        """Newest sequence numbers, not compressed into a block yet."""
+        self.count = 0
+        self._decoded: Tuple[int, List[int]] | None = None
+
+    def add(self, doc: int) -> None:
+        """Appends a sequence number, which must be larger than every other."""
+        self.tail.append(doc)
+        self.count += 1
+        if len(self.tail) == BLOCK_SIZE:
+            self.firsts.append(self.tail[0])
+            self.lasts.append(self.tail[-1])
+            self.blocks.append(_encode_deltas(self.tail))
+            self.tail = array("Q")
+
+    def block(self, i: int) -> List[int]:
+        """Returns one decoded block, caching the last one decoded."""
+        if self._decoded is None or self._decoded[0] != i:
+            self._decoded = (i, _decode_deltas(self.firsts[i], self.blocks[i]))
+        return self._decoded[1]
+
+    def __contains__(self, doc: int) -> bool:
+        if self.tail and doc >= self.tail[0]:
+            return doc in self.tail
+        i = bisect_left(self.lasts, doc)
+        if i == len(self.lasts) or doc < self.firsts[i]:
+            return False
+        docs = self.block(i)
+        j = bisect_left(docs, doc)
+        return j < len(docs) and docs[j] == doc
+
+    def descending(self, before: int | None = None):
+        """Yields the sequence numbers below ``before``, newest first."""
+        if before is None:
+            before = float("inf")
+        for doc in reversed(self.tail):
+            if doc < before:
+                yield doc
+        for i in range(bisect_left(self.firsts, before) - 1, -1, -1):
+            for doc in reversed(self.block(i)):
+                if doc < before:
+                    yield doc
+
+    def prune(self, first: int) -> None:
+        """Drops the blocks that only hold sequence numbers below ``first``."""
+        dropped = bisect_left(self.lasts, first)
+        if dropped:
+            self.count -= BLOCK_SIZE * dropped
+            del self.firsts[:dropped]
+            del self.lasts[:dropped]
+            del self.blocks[:dropped]
+            self._decoded = None
+
+
+class SearchIndex:
+    """
+    Inverted index over the message history, maintained on its own thread.
+
+    ``add`` and ``search`` may only be called from the reactor thread.
+    """
+
+    def __init__(self, history, max_limit: int = 50) -> None:
+        """
+        Initializes a new SearchIndex and starts its thread.
+
+        Args:
+            history (HistoryLog): The history to index and to read results from.
+            max_limit (int): Largest number of results per page.
+        """
+        from app.history import HistoryLog
+
+        self.history: HistoryLog = history
+        self.max_limit = max_limit
+        self.postings: Dict[str, Postings] = {}
+        """Only touched by the index thread."""
+        self.floor = history.first_seq
+        """Oldest sequence number still in the history."""
+
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self._run, name="SearchIndex", daemon=True)
+        self.thread.start()
+
+        history.events.on("History.Append", self.add)
+        history.events.on("History.Truncate", self.truncate)
+
+    def add(self, seq: int, packet: BasePacket) -> None:
+        """
+        Queues a message for indexing. Handles ``History.Append``.
+
+        Args:
+            seq (int): The message's sequence number.
+            packet (BasePacket): The message.
+        """
+        content = packet.data.get("content")
+        if isinstance(content, str):
+            self.queue.put((self._index, seq, content))
+
+    def truncate(self, first: int) -> None:
+        """
+        Forgets messages deleted from the history. Handles ``History.Truncate``.
+
+        Args:
+            first (int): The oldest sequence number left.
+        """
+        self.floor = first
+        self.queue.put((self._prune, first))
+
+    def rebuild(self) -> None:
+        """Queues every message already in the history for indexing."""
+        for seq in range(self.history.first_seq, self.history.next_seq):
+            packet = BasePacket.decode(bytes(self.history.record(seq)))
+            if packet is not None and packet.type == "MessagePacket":
+                self.add(seq, packet)
+
+    def search(
+        self, query: str, limit: int = 20, before: int | None = None
+    ) -> defer.Deferred:
+        """
+        Finds the newest messages containing every word of a query.
+
+        Args:
+            query (str): The words to look for.
+            limit (int): Largest number of results.
+            before (int | None): Only return messages older than this sequence
+                number, the ``next`` cursor of the previous page.
+
+        Returns:
+            Deferred: Fires with ``(sequence numbers, next cursor)``.
+        """
+        d = defer.Deferred()
+        limit = max(1, min(limit, self.max_limit))
+        self.queue.put((self._search, d, query, limit, before, self.floor))
+        return d
+
+    def on_search(self, packet: SearchPacket, user) -> None:
+        """
+        Answers a SearchPacket. Handles ``Recv.SearchPacket``.
+
+        Args:
+            packet (SearchPacket): The query.
+            user (UserProtocol): The user searching.
+        """
+        if not packet.verify():
+            return
+        query = packet.data["query"]
+        d = self.search(query, packet.data.get("limit", 20), packet.data.get("before"))
+        d.addCallback(self._results, query)
+        d.addCallback(user.send)
+        d.addErrback(lambda failure: logger.error(f"Search failed: {failure.value}"))
+
+    def _results(self, found: Tuple[List[int], int | None], query: str):
+        seqs, cursor = found
+        results = []
+        for seq in seqs:
+            record = self.history.record(seq)
+            packet = BasePacket.decode(bytes(record)) if record is not None else None
+            if packet is not None:
+                results.append({"seq": seq, "content": packet.data.get("content")})
+        return SearchResultPacket({"query": query, "results": results, "next": cursor})
+
+    def close(self) -> None:
+        """Stops the index thread."""
+        self.queue.put(None)
+        self.thread.join()
+
+    # Index thread
+
+    def _run(self) -> None:
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            try:
+                job[0](*job[1:])
+            except Exception:
+                logger.exception("Search index job failed.")
+
+    def _index(self, seq: int, content: str) -> None:
+        postings = self.postings
+        for word in tokenize(content):
+            entry = postings.get(word)
+            if entry is None:
+                entry = postings[word] = Postings()
+            entry.add(seq)
+
+    def _prune(self, first: int) -> None:
+        for word in list(self.postings):
+            entry = self.postings[word]
+            entry.prune(first)
+            if not entry.count:
+                del self.postings[word]
+
+    def _search(self, d, query, limit, before, floor) -> None:
+        try:
+            result = self._match(tokenize(query), limit, before, floor)
+        except Exception as e:
+            reactor.callFromThread(d.errback, e)
+        else:
+            reactor.callFromThread(d.callback, result)
+
+    def _match(self, words, limit, before, floor):
+        lists = [self.postings.get(word) for word in words]
+        if not lists or None in lists:
+            return [], None
+        lists.sort(key=lambda entry: entry.count)
+        rarest, others = lists[0], lists[1:]
+
+        seqs = []
+        for seq in rarest.descending(before):
+            if seq < floor:
+                break
+            if all(seq in entry for entry in others):
+                seqs.append(seq)
+                if len(seqs) == limit:
+                    break
+        cursor = seqs[-1] if len(seqs) == limit else None
+        return seqs, cursor
@@ -0,0 +1,383 @@
+"""Resumable sessions, and the ring buffer of messages they resume from.
+
+Every user that joins gets a Session: a random token tied to its
+``UserInfo.id``. The session outlives the connection for ``ttl`` seconds, so
+a client that reconnects after a network blip can send the token instead of
+joining anew. Its join then skips the prechecks and the history replay: it
+gets its id, username and channels back, and the chat messages it missed.
+
+Broadcast and channel messages are numbered as they are fanned out, with
+the number in the packet's ``seq``, and kept in a ring buffer of the last
+``size`` messages. Clients acknowledge the last number they handled with
+an AckPacket, or send it when resuming; the messages after it that the user
+would have received are written again. If the ring no longer reaches back
+that far, the client is told the replay is incomplete.
+"""
+
+import logging
+import secrets
+import time
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+from typing import Dict, List
+
+from common.packets import (
+    DEFAULT_CODEC,
+    AckPacket,
+    BasePacket,
+    SessionPacket,
+    frame,
+)
+from app.classes.UserInfo import UserInfo
+from app.classes.UserProtocol import NO_CHANNELS
+
+logger = logging.getLogger("Server")
+
+RESUMABLE = frozenset(("MessagePacket", "ChannelMessagePacket"))
+"""Packet types numbered and replayed to resuming clients."""
+
+
+class Session:
+    """One user's identity, kept to be resumed after its connection is lost."""
+
+    __slots__ = ("token", "id", "username", "channels", "acked", "user", "expires")
+
+    def __init__(self, token: str, id_: int, username: str | None) -> None:
+        self.token = token
+        self.id = id_
+        self.username = username
+        self.channels: List[str] = []
+        """Channels the user was in when its connection was lost."""
+        self.acked = -1
+        """Last message the client acknowledged."""
+        self.user = None
+        """The connected UserProtocol, or None while the session waits to be resumed."""
+        self.expires = 0.0
+
+
+class SessionStore:
+    """Issues, keeps and resumes sessions, and numbers the messages they replay."""
+
+    def __init__(
+        self,
+        server,
+        size: int = 1024,
+        ttl: float = 120.0,
+        max_sessions: int = 100_000,
+        join_timeout: float = 0.5,
+    ) -> None:
+        """
+        Initializes a new SessionStore instance.
+
+        Args:
+            server (ServerFactory): The server whose users get sessions.
+            size (int): Messages kept for resuming clients.
+            ttl (float): Seconds a session can be resumed after its connection is lost.
+            max_sessions (int): Most sessions kept; the longest disconnected go first.
+            join_timeout (float): Seconds a connection's join waits for its first
+                packet, which may resume a session.
+        """
+        from app.factory import ServerFactory as Server
+
+        self.server: Server = server
+        self.size = size
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.join_timeout = join_timeout
+
+        self.ring: list = [None] * size
+        """``(group, packet, frames by codec)`` of message ``seq`` at ``seq % size``."""
+        self.next_seq = 0
+        self.sessions: Dict[str, Session] = {}
+        """Sessions by token."""
+        self.by_id: Dict[int, Session] = {}
+        self.detached: OrderedDict = OrderedDict()
+        """Tokens of the sessions waiting to be resumed, longest waiting first."""
+
+        self.issued = 0
+        self.resumed = 0
+        self.expired = 0
+        self.replayed = 0
+
+    def attach(self, events) -> None:
+        """
+        Starts issuing sessions to joining users.
+
+        Args:
+            events (EventHandler): The server's event handler.
+        """
+        events.on("User.Joined", self.issue)
+        events.on("Connection.Adopted", self.relink)
+        events.on("Recv.AckPacket", self.on_ack)
+
+    @property
+    def first_seq(self) -> int:
+        """The oldest message still in the ring."""
+        return max(self.next_seq - self.size, 0)
+
+    def record(self, packet: BasePacket, group: str, frames: dict) -> int:
+        """
+        Numbers a message being fanned out and keeps it in the ring.
+
+        Args:
+            packet (BasePacket): The message; its ``seq`` is set.
+            group (str): Its recipients, ``*`` for everyone or ``#`` and a channel.
+            frames (dict): The fan-out's frames by codec, shared with the ring.
+
+        Returns:
+            int: The message's sequence number.
+        """
+        seq = self.next_seq
+        packet.data["seq"] = seq
+        self.ring[seq % self.size] = (group, packet, frames)
+        self.next_seq = seq + 1
+        return seq
+
+    def issue(self, user) -> None:
+        """
+        Gives a joined user a session and sends it the token. Handles ``User.Joined``.
+
+        Args:
+            user (UserProtocol): The user that joined.
+        """
+        self._expire()
+        if len(self.sessions) >= self.max_sessions and not self._evict():
+            return
+        session = Session(secrets.token_urlsafe(18), user.info.id, user.info.username)
+        session.user = user
+        session.acked = self.next_seq - 1
+        self.sessions[session.token] = session
+        self.by_id[session.id] = session
+        self.issued += 1
+        user.send(
+            SessionPacket(
+                {"token": session.token, "id": session.id, "seq": self.next_seq - 1}
+            )
+        )
+
+    def resume(self, user, packet: SessionPacket) -> bool:
+        """
+        Resumes a session on a new connection, in place of the join prechecks.
+
+        The user takes over the session's id, username and channels and is
+        registered, a connection still holding the session is closed, and the
+        messages after the client's ``seq`` (or its last acknowledgement) are
+        written after the answer.
+
+        Args:
+            user (UserProtocol): The connection that is not joined yet.
+            packet (SessionPacket): Its first packet.
+
+        Returns:
+            bool: Whether the session was resumed.
+        """
+        if not packet.verify():
+            return False
+        self._expire()
+        session = self.sessions.get(packet.data.get("token", ""))
+        if session is None:
+            return False
+        users = self.server.users
+        old = session.user
+        if old is not None:
+            # The old connection hasn't noticed it is gone yet.
+            users.removeUser(old)
+            old.loseConnection()
+        self.detached.pop(session.token, None)
+        session.user = user
+        user.info = UserInfo(session.id, session.username)
+        user.channels = set(session.channels) or NO_CHANNELS
+        users.adopt(user)
+        self.server.channels.rejoin(user)
+
+        seq = min(packet.data.get("seq", session.acked), self.next_seq - 1)
+        start = max(seq + 1, self.first_seq)
+        frames = self.missed(user, start)
+        self.resumed += 1
+        self.replayed += len(frames)
+        user.send(
+            SessionPacket(
+                {
+                    "token": session.token,
+                    "id": session.id,
+                    "seq": self.next_seq - 1,
+                    "resumed": True,
+                    "missed": len(frames),
+                    "complete": start == seq + 1,
+                }
+            )
+        )
+        for data in frames:
+            user.write(data, True)
+        return True
+
+    def missed(self, user, start: int) -> List[bytes]:
+        """
+        Returns the frames of the messages from ``start`` on that a user receives.
+
+        Args:
+            user (UserProtocol): The user, with its channels.
+            start (int): First sequence number; must still be in the ring.
+
+        Returns:
+            List[bytes]: The frames, in the user's codec.
+        """
+        ring, size = self.ring, self.size
+        channels = user.channels
+        codec = user.codec
+        out = []
+        for seq in range(start, self.next_seq):
+            group, packet, frames = ring[seq % size]
+            if group != "*" and group[1:] not in channels:
+                continue
+            data = frames.get(codec)
+            if data is None:
+                data = frames[codec] = frame(codec.encode(packet))
+            out.append(data)
+        return out
+
+    def relink(self, user) -> None:
+        """Ties an adopted connection to its session again. Handles ``Connection.Adopted``."""
+        session = self.by_id.get(user.info.id)
+        if session is not None:
+            self.detached.pop(session.token, None)
+            session.user = user
+
+    def detach(self, user) -> None:
+        """
+        Keeps a user's session for ``ttl`` seconds once it is unregistered.
+
+        Called by ``UserRegistry.removeUser``, before the user leaves its channels.
+
+        Args:
+            user (UserProtocol): The user being removed.
+        """
+        session = self.by_id.get(user.info.id)
+        if session is None or session.user is not user:
+            return
+        session.user = None
+        session.username = user.info.username
+        session.channels = sorted(user.channels)
+        session.expires = time.monotonic() + self.ttl
+        self.detached[session.token] = None
+        self._expire()
+
+    def end(self, user) -> None:
+        """
+        Drops a user's session, e.g. when it is kicked.
+
+        Args:
+            user (UserProtocol): The user.
+        """
+        session = self.by_id.get(user.info.id)
+        if session is not None and session.user is user:
+            self._drop(session)
+
+    def on_ack(self, packet: AckPacket, user) -> None:
+        """Records the last message a client handled. Handles ``Recv.AckPacket``."""
+        if not packet.verify():
+            return
+        session = self.by_id.get(user.info.id)
+        if session is not None and session.user is user:
+            session.acked = min(packet.data["seq"], self.next_seq - 1)
+
+    def _drop(self, session: Session) -> None:
+        del self.sessions[session.token]
+        self.detached.pop(session.token, None)
+        if self.by_id.get(session.id) is session:
+            del self.by_id[session.id]
+
+    def _expire(self) -> None:
+        now = time.monotonic()
+        detached, sessions = self.detached, self.sessions
+        while detached:
+            token = next(iter(detached))
+            if sessions[token].expires > now:
+                break
+            self._drop(sessions[token])
+            self.expired += 1
+
+    def _evict(self) -> bool:
+        if not self.detached:
+            return False
+        self._drop(self.sessions[next(iter(self.detached))])
+        self.expired += 1
+        return True
+
+    def handoff_state(self) -> dict:
+        """
+        Returns the sessions and the ring, for a process taking this one over.
+
+        Returns:
+            dict: JSON-serializable state, for ``restore``.
+        """
+        now = time.monotonic()
+        messages = []
+        for seq in range(self.first_seq, self.next_seq):
+            group, packet, _ = self.ring[seq % self.size]
+            messages.append([group, b64encode(DEFAULT_CODEC.encode(packet)).decode()])
+        return {
+            "next_seq": self.next_seq,
+            "messages": messages,
+            "sessions": [
+                [
+                    session.token,
+                    session.id,
+                    session.username,
+                    session.channels,
+                    session.acked,
+                    session.expires - now if session.user is None else None,
+                ]
+                for session in self.sessions.values()
+            ],
+        }
+
+    def restore(self, state: dict) -> None:
+        """
+        Takes over the sessions and the ring of the process serving before.
+
+        Connected sessions are tied to their users as those are adopted; any
+        that aren't expire like disconnected ones.
+
+        Args:
+            state (dict): The previous process's ``handoff_state``.
+        """
+        now = time.monotonic()
+        self.next_seq = state["next_seq"]
+        messages = state["messages"][-self.size :]
+        seq = self.next_seq - len(messages)
+        for group, payload in messages:
+            data = b64decode(payload)
+            packet = BasePacket.decode(data)
+            self.ring[seq % self.size] = (group, packet, {DEFAULT_CODEC: frame(data)})
+            seq += 1
+        sessions = []
+        for token, id_, username, channels, acked, remaining in state["sessions"]:
+            session = Session(token, id_, username)
+            session.channels = channels
+            session.acked = acked
+            session.expires = now + (self.ttl if remaining is None else remaining)
+            self.sessions[token] = session
+            self.by_id[id_] = session
+            sessions.append(session)
+        for session in sorted(sessions, key=lambda session: session.expires):
+            self.detached[session.token] = None
+
+    def stats(self) -> dict:
+        """
+        Returns the sessions' counters.
+
+        Returns:
+            dict: Sessions kept and waiting, issued, resumed and expired, messages
+            replayed, and the sequence numbers in the ring.
+        """
+        return {
+            "sessions": len(self.sessions),
+            "detached": len(self.detached),
+            "issued": self.issued,
+            "resumed": self.resumed,
+            "expired": self.expired,
+            "replayed": self.replayed,
+            "first_seq": self.first_seq,
+            "next_seq": self.next_seq,
+        }
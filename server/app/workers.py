@@ -0,0 +1,92 @@
+"""Multi-process server mode.
+
+``main.py --workers N`` starts a master process that runs a Broker on a Unix
+socket and spawns N worker processes. Every worker runs its own reactor,
+listens on the shared port with SO_REUSEPORT so the kernel spreads incoming
+connections across them, and joins the broker through a BrokerBackplane, so
+``UserRegistry.broadcast``, the username precheck and ``online_count`` cover
+the whole server.
+"""
+
+import os
+import signal
+import socket
+import subprocess
+import sys
+from typing import List
+
+
+def listen_reuseport(reactor, factory, port: int, interface: str = "", backlog=50):
+    """
+    Listens on a TCP port that other processes may also bind with SO_REUSEPORT.
+
+    Args:
+        reactor: The reactor to adopt the socket into.
+        factory (ServerFactory): The factory for accepted connections.
+        port (int): The port to listen on.
+        interface (str): The address to bind, all interfaces by default.
+        backlog (int): The listen backlog.
+
+    Returns:
+        IListeningPort: The adopted listening port.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((interface, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    try:
+        return reactor.adoptStreamPort(sock.fileno(), socket.AF_INET, factory)
+    finally:
+        # The reactor holds its own duplicate of the descriptor.
+        sock.close()
+
+
+def spawn_workers(
+    count: int, bus_path: str | None, argv: List[str]
+) -> List[subprocess.Popen]:
+    """
+    Starts the worker processes.
+
+    Args:
+        count (int): How many workers to start.
+        bus_path (str | None): Path of the master's broker socket, or None when
+            the workers join a cluster broker from [Cluster] backplane.
+        argv (List[str]): Arguments to run ``main.py`` with, minus the worker flags.
+
+    Returns:
+        List[subprocess.Popen]: The worker processes.
+    """
+    bus = ["--bus", bus_path] if bus_path is not None else []
+    return [
+        subprocess.Popen([sys.executable, *argv, "--worker-id", str(i), *bus])
+        for i in range(count)
+    ]
+
+
+def stop_workers(workers: List[subprocess.Popen]) -> None:
+    """Terminates the worker processes and waits for them to exit."""
+    for process in workers:
+        if process.poll() is None:
+            process.send_signal(signal.SIGTERM)
+    for process in workers:
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def signal_workers(workers: List[subprocess.Popen], signum: int) -> None:
+    """Sends a signal to every worker process still running."""
+    for process in workers:
+        if process.poll() is None:
+            process.send_signal(signum)
+
+
+def remove_socket(path: str) -> None:
+    """Removes a stale Unix socket file."""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
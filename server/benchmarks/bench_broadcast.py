@@ -0,0 +1,52 @@
+"""Per-message broadcast cost against the number of connected users.
+
+Run from the server directory::
+
+    python -m benchmarks.bench_broadcast
+"""
+
+import argparse
+import logging
+
+from benchmarks.common import connect_users, make_server, timeit
+
+logging.disable(logging.CRITICAL)
+
+USER_COUNTS = [10, 100, 1000, 5000]
+
+
+def legacy_broadcast(registry, packet):
+    """The pre fan-out path: pack and look up every recipient separately."""
+    data = registry.pack_packet(packet)
+    for user in list(registry.users):
+        registry.send_to(data, user.info.id)
+
+
+def main():
+    from common.packets import MessagePacket
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, nargs="*", default=USER_COUNTS)
+    parser.add_argument("--legacy", action="store_true", help="Also time send_to.")
+    args = parser.parse_args()
+
+    print(f"{'users':>8} {'broadcast us':>14} {'us/user':>9}", end="")
+    print(f" {'send_to us':>14}" if args.legacy else "")
+    for count in args.users:
+        server = make_server()
+        connect_users(server, count)
+        packet = MessagePacket({"content": "Hello everyone, how is it going?"})
+        repeat = max(3, 20000 // count)
+
+        cost = timeit(lambda: server.users.broadcast(packet), repeat)
+        line = f"{count:>8} {cost * 1e6:>14.1f} {cost * 1e6 / count:>9.3f}"
+        if args.legacy:
+            legacy = timeit(
+                lambda: legacy_broadcast(server.users, packet), max(1, repeat // 10)
+            )
+            line += f" {legacy * 1e6:>14.1f}"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
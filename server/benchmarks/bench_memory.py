@@ -0,0 +1,186 @@
+"""Resident memory per idle connection.
+
+``sockets`` starts ``main.py`` and opens real TCP connections to it from
+client processes, each sending a HelloPacket and then nothing; the server's
+RSS growth divided by the connections is what one idle user costs,
+including the kernel-side transport objects Twisted keeps. Source addresses
+are spread over 127.0.0.0/8 so 100k connections don't run out of ephemeral
+ports. Counts the server can't hold open under ``ulimit -n`` are skipped.
+
+``inprocess`` builds the same users on NullTransports in this process, which
+leaves out sockets and Twisted's transports but runs anywhere. With
+``--trace`` it also lists the Python allocation sites per connection.
+
+Run from the server directory::
+
+    python -m benchmarks.bench_memory --counts 10000 100000
+"""
+
+import argparse
+import gc
+import logging
+import multiprocessing
+import os
+import resource
+import socket
+import time
+import tracemalloc
+
+from benchmarks import loadgen
+from benchmarks.common import NullTransport, make_server
+
+logging.disable(logging.CRITICAL)
+
+PER_PROCESS = 15000
+"""Connections held by one client process."""
+PER_ADDRESS = 20000
+"""Connections per source address, below the ephemeral port range."""
+SPARE_FDS = 256
+
+
+def raise_fd_limit() -> int:
+    """Raises this process's open file limit to its hard limit, which children inherit."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def settle(pid: int, timeout: float) -> int:
+    """Waits for a process's RSS to stop growing, and returns it."""
+    deadline = time.monotonic() + timeout
+    last = loadgen.process_rss(pid)
+    while time.monotonic() < deadline:
+        time.sleep(0.5)
+        rss = loadgen.process_rss(pid)
+        if rss <= last:
+            return rss
+        last = rss
+    return last
+
+
+def hold_connections(numbers, port, hello, ready, done) -> None:
+    """Opens one connection per number, says hello and holds them until ``done`` is set."""
+    socks = []
+    for number in numbers:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind((f"127.0.{number // PER_ADDRESS // 250}.{number // PER_ADDRESS % 250 + 1}", 0))
+        sock.connect(("127.0.0.1", port))
+        if hello:
+            sock.sendall(hello)
+        socks.append(sock)
+    ready.put(len(socks))
+    done.wait()
+    for sock in socks:
+        sock.close()
+
+
+def measure_sockets(count: int, args) -> dict:
+    from common.packets import HelloPacket
+
+    limit = raise_fd_limit()
+    if count + SPARE_FDS > limit:
+        return {"skipped": f"the server needs ulimit -n above {count + SPARE_FDS} (it is {limit})"}
+    run_args = loadgen.build_parser().parse_args(
+        ["--port", str(args.port), *(["--reactor", args.reactor] if args.reactor else [])]
+    )
+    server, config_path = loadgen.start_server(run_args)
+    try:
+        before = settle(server.pid, 5)
+        hello = HelloPacket({"codecs": ["binary"]}).pack() if args.hello else b""
+        ready = multiprocessing.Queue()
+        done = multiprocessing.Event()
+        procs = [
+            multiprocessing.Process(
+                target=hold_connections,
+                args=(range(start, min(start + PER_PROCESS, count)), args.port, hello, ready, done),
+            )
+            for start in range(0, count, PER_PROCESS)
+        ]
+        for proc in procs:
+            proc.start()
+        opened = sum(ready.get(timeout=120) for _ in procs)
+        after = settle(server.pid, 10 + count / 10000)
+        done.set()
+        for proc in procs:
+            proc.join()
+    finally:
+        server.terminate()
+        server.wait()
+        os.unlink(config_path)
+    return {"connections": opened, "rss_before": before, "rss_after": after}
+
+
+def measure_inprocess(count: int, args) -> dict:
+    from common.packets import HelloPacket
+
+    server = make_server()
+    hello = HelloPacket({"codecs": ["binary"]}).pack()
+
+    def connect(n):
+        users = []
+        for _ in range(n):
+            user = server.buildProtocol(None)
+            user.makeConnection(NullTransport())
+            if args.hello:
+                user.dataReceived(hello)
+            users.append(user)
+        if server.coalescer is not None:
+            server.coalescer.flush()
+        return users
+
+    gc.collect()
+    before = loadgen.process_rss(os.getpid())
+    users = connect(count)
+    gc.collect()
+    after = loadgen.process_rss(os.getpid())
+    result = {"connections": len(users), "rss_before": before, "rss_after": after}
+    if args.trace:
+        sample = min(count, 10000)
+        tracemalloc.start()
+        snapshot = tracemalloc.take_snapshot()
+        traced = connect(sample)
+        stats = tracemalloc.take_snapshot().compare_to(snapshot, "lineno")
+        tracemalloc.stop()
+        result["heap"] = sum(stat.size_diff for stat in stats) / len(traced)
+        result["sites"] = [
+            (stat.size_diff / len(traced), str(stat.traceback)) for stat in stats[:8]
+        ]
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--counts", type=int, nargs="*", default=[10000, 100000])
+    parser.add_argument(
+        "--modes", nargs="*", choices=("sockets", "inprocess"), default=["sockets", "inprocess"]
+    )
+    parser.add_argument("--no-hello", dest="hello", action="store_false",
+                        help="Connect without sending a HelloPacket.")
+    parser.add_argument("--trace", action="store_true",
+                        help="List the allocation sites per in-process connection.")
+    parser.add_argument("--reactor", help="Reactor for the server; see [Server] reactor.")
+    parser.add_argument("--port", type=int, default=4192)
+    args = parser.parse_args()
+
+    print(f"{'mode':>10} {'connections':>12} {'rss MiB':>9} {'bytes/conn':>11}")
+    for mode in args.modes:
+        for count in args.counts:
+            measure = measure_sockets if mode == "sockets" else measure_inprocess
+            result = measure(count, args)
+            if "skipped" in result:
+                print(f"{mode:>10} {count:>12} skipped: {result['skipped']}")
+                continue
+            grown = result["rss_after"] - result["rss_before"]
+            print(
+                f"{mode:>10} {result['connections']:>12} "
+                f"{result['rss_after'] / 2**20:>9.1f} {grown / result['connections']:>11.0f}"
+            )
+            if "heap" in result:
+                print(f"{'':>10} python heap {result['heap']:.0f} bytes/conn:")
+                for size, site in result["sites"]:
+                    print(f"{'':>12}{size:>7.0f}  {site}")
+
+
+if __name__ == "__main__":
+    main()
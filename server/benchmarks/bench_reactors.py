@@ -0,0 +1,80 @@
+"""Fan-out throughput, latency and memory of the server on each reactor.
+
+Runs the load generator against ``main.py --reactor NAME`` for each
+reactor, with the same clients, rooms and message rate, and prints one row
+per reactor. Reactors that can't run here are skipped: ``uvloop`` without
+the package, ``epoll`` off Linux, and ``select`` above the 1024 descriptors
+``select(2)`` can watch. Run from the server directory::
+
+    python -m benchmarks.bench_reactors --clients 10000 --procs 4
+"""
+
+import argparse
+import importlib.util
+import select
+import uuid
+
+from benchmarks import loadgen
+
+REACTORS = ("epoll", "poll", "select", "asyncio-stdlib", "uvloop")
+
+
+def unavailable(reactor: str, clients: int) -> str | None:
+    """Returns why a reactor can't run the benchmark, or None if it can."""
+    if reactor == "uvloop" and importlib.util.find_spec("uvloop") is None:
+        return "uvloop is not installed"
+    if reactor == "epoll" and not hasattr(select, "epoll"):
+        return "no epoll on this platform"
+    if reactor == "select" and clients > 1000:
+        return "select() is limited to 1024 descriptors"
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--reactors", nargs="*", default=list(REACTORS))
+    parser.add_argument("--clients", type=int, default=10000)
+    parser.add_argument("--procs", type=int, default=4, help="Client processes.")
+    parser.add_argument("--rate", type=float, default=100, help="Messages/s sent in total.")
+    parser.add_argument("--room-size", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=10)
+    args = parser.parse_args()
+
+    print(
+        f"{'reactor':>15} {'sent/s':>8} {'delivered/s':>12} {'p50 ms':>8} "
+        f"{'p99 ms':>8} {'rss MiB':>8}"
+    )
+    for reactor in args.reactors:
+        reason = unavailable(reactor, args.clients)
+        if reason is not None:
+            print(f"{reactor:>15} skipped: {reason}")
+            continue
+        run_args = loadgen.build_parser().parse_args(
+            [
+                "--reactor",
+                reactor,
+                "--clients",
+                str(args.clients),
+                "--procs",
+                str(args.procs),
+                "--rate",
+                str(args.rate),
+                "--room-size",
+                str(args.room_size),
+                "--duration",
+                str(args.duration),
+            ]
+        )
+        run_args.run_id = uuid.uuid4().hex[:8]
+        result = loadgen.run(run_args)
+        latency = result["latency_ms"]
+        rss = result["server_rss_mb"]["peak"]
+        print(
+            f"{reactor:>15} {result['sent_per_second']:>8.0f} "
+            f"{result['delivered_per_second']:>12.0f} {latency['p50']:>8.2f} "
+            f"{latency['p99']:>8.2f} {rss or 0:>8.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""UserRegistry join, lookup and removal cost with many simulated users.
+
+Run from the server directory::
+
+    python -m benchmarks.bench_registry --users 100000
+"""
+
+import argparse
+import logging
+import random
+import time
+
+from benchmarks.common import NullTransport, make_server
+
+logging.disable(logging.CRITICAL)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--lookups", type=int, default=100000)
+    args = parser.parse_args()
+
+    server = make_server()
+    registry = server.users
+
+    users = []
+    for i in range(args.users):
+        user = server.buildProtocol(None)
+        user.info.username = f"user{i}"
+        users.append(user)
+
+    start = time.perf_counter()
+    for user in users:
+        user.makeConnection(NullTransport())
+    join = time.perf_counter() - start
+
+    ids = [random.choice(users).info.id for _ in range(args.lookups)]
+    names = [random.choice(users).info.username for _ in range(args.lookups)]
+    start = time.perf_counter()
+    for id_ in ids:
+        registry.getUser(id_)
+    by_id = time.perf_counter() - start
+    start = time.perf_counter()
+    for name in names:
+        registry.getUserByName(name)
+    by_name = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(args.lookups):
+        registry.online_count
+    count = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for user in users:
+        user.connectionLost(None)
+    remove = time.perf_counter() - start
+
+    print(f"users:           {args.users}")
+    print(f"join:            {join / args.users * 1e6:8.2f} us/user")
+    print(f"getUser:         {by_id / args.lookups * 1e6:8.3f} us")
+    print(f"getUserByName:   {by_name / args.lookups * 1e6:8.3f} us")
+    print(f"online_count:    {count / args.lookups * 1e6:8.3f} us")
+    print(f"disconnect:      {remove / args.users * 1e6:8.2f} us/user")
+    print(f"remaining:       {registry.online_count}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""Broadcast throughput of the server against its number of worker processes.
+
+Starts ``main.py --workers N`` for each N, connects simulated clients over
+localhost from several processes and counts how many chat messages reach
+them per second. Run from the server directory::
+
+    python -m benchmarks.bench_workers --workers 1 2 4
+"""
+
+import argparse
+import multiprocessing
+import os
+import selectors
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.common import BASE, load_config
+
+PORT = 4190
+
+
+def client_process(port, connections, rate, duration, results):
+    """Opens ``connections`` sockets, sends ``rate`` messages/s in total and counts deliveries."""
+    from common.packets import MessagePacket, PacketBuffer
+
+    selector = selectors.DefaultSelector()
+    socks = []
+    for _ in range(connections):
+        sock = socket.create_connection(("127.0.0.1", port))
+        sock.setblocking(False)
+        buffer = PacketBuffer()
+        selector.register(sock, selectors.EVENT_READ, buffer)
+        socks.append(sock)
+
+    message = MessagePacket({"content": "benchmark " * 4}).pack()
+    received = sent = 0
+    interval = 1.0 / rate if rate else None
+    start = time.perf_counter()
+    next_send = start
+    end = start + duration
+    while True:
+        now = time.perf_counter()
+        if now >= end:
+            break
+        while interval and now >= next_send:
+            try:
+                socks[sent % len(socks)].send(message)
+                sent += 1
+            except BlockingIOError:
+                pass
+            next_send += interval
+        for key, _ in selector.select(timeout=0.005):
+            try:
+                data = key.fileobj.recv(1 << 16)
+            except BlockingIOError:
+                continue
+            if data:
+                received += len(key.data.feed(data))
+    for sock in socks:
+        sock.close()
+    results.put((sent, received))
+
+
+def run(workers, clients, connections, rate, duration, config_path):
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            str(BASE.joinpath("main.py")),
+            "--config",
+            config_path,
+            "--port",
+            str(PORT),
+            "--workers",
+            str(workers),
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            try:
+                socket.create_connection(("127.0.0.1", PORT)).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        time.sleep(0.5 + 0.2 * workers)
+
+        results = multiprocessing.Queue()
+        procs = [
+            multiprocessing.Process(
+                target=client_process,
+                args=(PORT, connections, rate / clients, duration, results),
+            )
+            for _ in range(clients)
+        ]
+        for proc in procs:
+            proc.start()
+        totals = [results.get() for _ in procs]
+        for proc in procs:
+            proc.join()
+    finally:
+        server.terminate()
+        server.wait()
+    sent = sum(s for s, _ in totals)
+    received = sum(r for _, r in totals)
+    return sent, received
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--workers", type=int, nargs="*", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=4, help="Client processes.")
+    parser.add_argument("--connections", type=int, default=50, help="Per process.")
+    parser.add_argument("--rate", type=float, default=200, help="Messages/s sent.")
+    parser.add_argument("--duration", type=float, default=5)
+    args = parser.parse_args()
+
+    config = load_config()
+    fd, config_path = tempfile.mkstemp(suffix=".ini")
+    with os.fdopen(fd, "w") as f:
+        config.write(f)
+
+    try:
+        print(f"{'workers':>8} {'sent/s':>10} {'delivered/s':>12} {'cores':>6}")
+        for workers in args.workers:
+            sent, received = run(
+                workers,
+                args.clients,
+                args.connections,
+                args.rate,
+                args.duration,
+                config_path,
+            )
+            print(
+                f"{workers:>8} {sent / args.duration:>10.0f} "
+                f"{received / args.duration:>12.0f} {os.cpu_count():>6}"
+            )
+    finally:
+        os.unlink(config_path)
+
+
+if __name__ == "__main__":
+    main()
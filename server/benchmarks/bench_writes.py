@@ -0,0 +1,154 @@
+"""Write calls, send syscalls and throughput with and without write coalescing.
+
+Runs the server in-process on a real localhost port, connects clients from
+a second process and broadcasts bursts of messages, ``--burst`` per reactor
+tick, with ``[Outbound] coalesce`` off and on. Counts the server's
+``transport.write`` calls and the ``send`` syscalls behind them (one per
+``writeSomeData``), and times the run until the clients have every byte.
+Run from the server directory::
+
+    python -m benchmarks.bench_writes --clients 500 --burst 1 4 16
+"""
+
+import argparse
+import logging
+import multiprocessing
+import selectors
+import socket
+import time
+
+from benchmarks.common import load_config
+
+logging.disable(logging.CRITICAL)
+
+
+def client_process(port, clients, expected, ready, done):
+    """Connects ``clients`` sockets and reads until each got ``expected`` bytes."""
+    selector = selectors.DefaultSelector()
+    for _ in range(clients):
+        sock = socket.create_connection(("127.0.0.1", port))
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ, [0])
+    ready.set()
+    remaining = clients
+    while remaining:
+        for key, _ in selector.select(timeout=1):
+            try:
+                data = key.fileobj.recv(1 << 18)
+            except BlockingIOError:
+                continue
+            key.data[0] += len(data)
+            if key.data[0] >= expected or not data:
+                selector.unregister(key.fileobj)
+                remaining -= 1
+    done.set()
+
+
+def server_process(coalesce, clients, burst, messages, results):
+    from twisted.internet import abstract, reactor, tcp
+    from common.packets import MessagePacket, frame, JsonCodec
+
+    counts = {"write": 0, "send": 0}
+    write, write_some = abstract.FileDescriptor.write, tcp.Connection.writeSomeData
+
+    def counted_write(self, data):
+        counts["write"] += 1
+        return write(self, data)
+
+    def counted_send(self, data):
+        counts["send"] += 1
+        return write_some(self, data)
+
+    abstract.FileDescriptor.write = counted_write
+    tcp.Connection.writeSomeData = counted_send
+
+    config = load_config()
+    config.set("Outbound", "coalesce", str(coalesce).lower())
+    config.set("Metrics", "endpoint", "")
+    from app.factory import ServerFactory
+
+    factory = ServerFactory(config)
+    port = reactor.listenTCP(0, factory, backlog=4096, interface="127.0.0.1")
+    packet = MessagePacket({"content": "Hello everyone, how is it going?"})
+    expected = len(frame(JsonCodec().encode(packet))) * messages
+
+    ready, done = multiprocessing.Event(), multiprocessing.Event()
+    client = multiprocessing.Process(
+        target=client_process,
+        args=(port.getHost().port, clients, expected, ready, done),
+    )
+    client.start()
+    state = {"sent": 0}
+
+    def wait_for_clients():
+        if not ready.is_set() or len(factory.users) < clients:
+            reactor.callLater(0.05, wait_for_clients)
+            return
+        counts["write"] = counts["send"] = 0
+        state["started"] = time.perf_counter()
+        state["cpu"] = time.process_time()
+        step()
+
+    def step():
+        for _ in range(min(burst, messages - state["sent"])):
+            factory.users.broadcast(MessagePacket({"content": packet.data["content"]}))
+            state["sent"] += 1
+        if state["sent"] < messages:
+            reactor.callLater(0, step)
+        else:
+            wait_for_delivery()
+
+    def wait_for_delivery():
+        if not done.is_set():
+            reactor.callLater(0.001, wait_for_delivery)
+            return
+        elapsed = time.perf_counter() - state["started"]
+        results.put(
+            {
+                "seconds": elapsed,
+                "cpu": time.process_time() - state["cpu"],
+                "writes": counts["write"],
+                "sends": counts["send"],
+            }
+        )
+        reactor.stop()
+
+    reactor.callLater(0, wait_for_clients)
+    reactor.run()
+    client.join()
+
+
+def run(coalesce, clients, burst, messages) -> dict:
+    results = multiprocessing.Queue()
+    proc = multiprocessing.Process(
+        target=server_process, args=(coalesce, clients, burst, messages, results)
+    )
+    proc.start()
+    result = results.get()
+    proc.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--clients", type=int, default=500)
+    parser.add_argument("--burst", type=int, nargs="*", default=[1, 4, 16])
+    parser.add_argument("--messages", type=int, default=400, help="Broadcasts per run.")
+    args = parser.parse_args()
+
+    print(
+        f"{'burst':>6} {'coalesce':>9} {'writes':>9} {'sends':>9} "
+        f"{'cpu ms':>8} {'deliveries/s':>13}"
+    )
+    for burst in args.burst:
+        for coalesce in (False, True):
+            result = run(coalesce, args.clients, burst, args.messages)
+            rate = args.clients * args.messages / result["seconds"]
+            print(
+                f"{burst:>6} {'on' if coalesce else 'off':>9} {result['writes']:>9} "
+                f"{result['sends']:>9} {result['cpu'] * 1000:>8.0f} {rate:>13.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import configparser
+import sys
+import time
+from pathlib import Path
+
+BASE = Path(__file__).parent.parent
+
+if str(BASE) not in sys.path:
+    sys.path.insert(0, str(BASE))
+
+
+class NullTransport:
+    """Stands in for a TCP transport, counting writes instead of sending them."""
+
+    connected = True
+    disconnecting = False
+
+    def __init__(self):
+        self.writes = 0
+        self.bytes = 0
+
+    def write(self, data):
+        self.writes += 1
+        self.bytes += len(data)
+
+    def writeSequence(self, seq):
+        for data in seq:
+            self.write(data)
+
+    def loseConnection(self):
+        self.connected = False
+
+    def getPeer(self):
+        return None
+
+    def getHost(self):
+        return None
+
+    def registerProducer(self, producer, streaming):
+        pass
+
+    def unregisterProducer(self):
+        pass
+
+
+def load_config() -> configparser.ConfigParser:
+    config = configparser.ConfigParser()
+    config.read(BASE.joinpath("config.ini"))
+    config.set("Server", "debug", "false")
+    # Measure the relay path itself, without client limits or disk writes.
+    # Benchmark users never send a packet, so they join without sessions and
+    # aren't pinged or timed out.
+    for section in ("Limits", "History", "Sessions", "Heartbeat"):
+        if config.has_section(section):
+            config.set(section, "enabled", "false")
+    return config
+
+
+def make_server():
+    from app.factory import ServerFactory
+
+    return ServerFactory(load_config())
+
+
+def connect_users(server, count: int):
+    """Builds ``count`` protocols on NullTransports and runs their join."""
+    users = []
+    for _ in range(count):
+        user = server.buildProtocol(None)
+        user.makeConnection(NullTransport())
+        users.append(user)
+    return users
+
+
+def timeit(func, repeat: int) -> float:
+    """Returns the mean wall time of ``func`` in seconds."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
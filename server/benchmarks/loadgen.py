@@ -0,0 +1,323 @@
+"""Headless load generator for the chat server.
+
+Starts ``main.py`` (or targets a server that is already running with
+``--port``/``--host`` and ``--attach``), opens many simulated clients from
+one or more processes and has them send chat messages at a fixed total rate.
+Clients are split into rooms of ``--room-size`` members that talk through
+channels; a room size of 0 broadcasts every message to everyone.
+
+Every message carries its send time, so each delivery yields an end-to-end
+fan-out latency. The run reports send and delivery throughput, p50/p99/p999
+latency and the server's resident memory, and saves everything as JSON
+under ``benchmarks/results`` for comparing commits. Run from the server
+directory::
+
+    python -m benchmarks.loadgen --clients 2000 --procs 4 --rate 500 --room-size 50
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import selectors
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from pathlib import Path
+
+from benchmarks.common import BASE, load_config
+from common.histogram import Histogram
+
+RESULTS = BASE.joinpath("benchmarks", "results")
+
+
+def client_process(index, args, rooms, start_at, results):
+    """Runs this process's share of the clients and reports what they measured."""
+    from common.packets import (
+        CODECS,
+        ChannelJoinPacket,
+        ChannelMessagePacket,
+        HelloPacket,
+        MessagePacket,
+        PacketBuffer,
+        frame,
+    )
+
+    codec = CODECS[args.codec]
+    share = range(index, args.clients, args.procs)
+    selector = selectors.DefaultSelector()
+    clients = []
+    for number in share:
+        sock = socket.create_connection((args.host, args.port))
+        sock.setblocking(False)
+        room = rooms[number] if rooms else None
+        hello = HelloPacket({"codecs": [codec.name]}).pack()
+        join = ChannelJoinPacket({"channel": room}).pack() if room else b""
+        sock.sendall(hello + join)
+        selector.register(sock, selectors.EVENT_READ, PacketBuffer())
+        clients.append((sock, room))
+
+    tag = f"lg:{args.run_id}:"
+    padding = "x" * max(args.message_size - len(tag) - 20, 0)
+    histogram = Histogram()
+    sent = received = 0
+    interval = args.procs / args.rate if args.rate else None
+
+    while time.monotonic() < start_at:
+        drain(selector, None, None, 0, 0.01)
+    warm_until = start_at + args.warmup
+    warm_ns = int(warm_until * 1e9)
+    end = warm_until + args.duration
+    next_send = time.monotonic()
+    while True:
+        now = time.monotonic()
+        if now >= end:
+            break
+        while interval and now >= next_send:
+            sock, room = clients[sent % len(clients)]
+            content = f"{tag}{time.monotonic_ns()}:{padding}"
+            if room:
+                packet = ChannelMessagePacket({"channel": room, "content": content})
+            else:
+                packet = MessagePacket({"content": content})
+            try:
+                sock.send(frame(codec.encode(packet)))
+                if now >= warm_until:
+                    sent += 1
+            except BlockingIOError:
+                pass
+            next_send += interval
+        received += drain(selector, tag, histogram, warm_ns, 0.002)
+
+    # Let in-flight deliveries arrive.
+    settle = time.monotonic() + args.settle
+    while time.monotonic() < settle:
+        received += drain(selector, tag, histogram, warm_ns, 0.01)
+    for sock, _ in clients:
+        sock.close()
+    results.put((sent, received, histogram.to_dict()))
+
+
+def drain(selector, tag, histogram, since_ns, timeout) -> int:
+    """Reads every ready socket, recording the latency of tagged messages sent since ``since_ns``."""
+    received = 0
+    for key, _ in selector.select(timeout=timeout):
+        try:
+            data = key.fileobj.recv(1 << 18)
+        except (BlockingIOError, ConnectionError):
+            continue
+        if not data or tag is None:
+            continue
+        now = time.monotonic_ns()
+        for packet in key.data.packets(data):
+            content = packet.data.get("content")
+            if not isinstance(content, str) or not content.startswith(tag):
+                continue
+            sent_ns = int(content[len(tag) :].split(":", 1)[0])
+            if sent_ns >= since_ns:
+                received += 1
+                histogram.record((now - sent_ns) // 1000)
+    return received
+
+
+def assign_rooms(clients: int, room_size: int) -> list:
+    if room_size <= 0:
+        return []
+    return [f"room-{number // room_size}" for number in range(clients)]
+
+
+def process_rss(pid: int) -> int:
+    """Resident memory of a process and its children, in bytes."""
+    total = 0
+    pids = [pid]
+    while pids:
+        current = pids.pop()
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+            with open(f"/proc/{current}/task/{current}/children") as f:
+                pids.extend(int(child) for child in f.read().split())
+        except (FileNotFoundError, ProcessLookupError):
+            continue
+    return total
+
+
+def start_server(args):
+    config = load_config()
+    fd, config_path = tempfile.mkstemp(suffix=".ini")
+    with os.fdopen(fd, "w") as f:
+        config.write(f)
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            str(BASE.joinpath("main.py")),
+            "--config",
+            config_path,
+            "--port",
+            str(args.port),
+            "--workers",
+            str(args.workers),
+            *(["--reactor", args.reactor] if args.reactor else []),
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.time() + 15
+    while time.time() < deadline:
+        try:
+            socket.create_connection((args.host, args.port)).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+    time.sleep(0.5 + 0.2 * args.workers)
+    return server, config_path
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=BASE,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args) -> dict:
+    server = config_path = None
+    if not args.attach:
+        server, config_path = start_server(args)
+    try:
+        rooms = assign_rooms(args.clients, args.room_size)
+        connect_time = 1.0 + args.clients / 2000
+        start_at = time.monotonic() + connect_time
+        results = multiprocessing.Queue()
+        procs = [
+            multiprocessing.Process(
+                target=client_process, args=(i, args, rooms, start_at, results)
+            )
+            for i in range(args.procs)
+        ]
+        for proc in procs:
+            proc.start()
+
+        rss = []
+        finish = start_at + args.warmup + args.duration + args.settle
+        while time.monotonic() < finish:
+            if server is not None:
+                rss.append(process_rss(server.pid))
+            time.sleep(0.5)
+        totals = [results.get() for _ in procs]
+        for proc in procs:
+            proc.join()
+        if server is not None:
+            rss.append(process_rss(server.pid))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+            os.unlink(config_path)
+
+    histogram = Histogram()
+    sent = received = 0
+    for s, r, counts in totals:
+        sent += s
+        received += r
+        histogram.merge(Histogram.from_dict(counts))
+    fanout = args.room_size if args.room_size > 0 else args.clients
+    return {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "params": {
+            key: value
+            for key, value in vars(args).items()
+            if key not in ("output", "run_id")
+        },
+        "sent": sent,
+        "delivered": received,
+        "expected": sent * fanout,
+        "sent_per_second": sent / args.duration,
+        "delivered_per_second": received / args.duration,
+        "latency_ms": {
+            "p50": histogram.percentile(50) / 1000,
+            "p99": histogram.percentile(99) / 1000,
+            "p999": histogram.percentile(99.9) / 1000,
+            "max": histogram.max / 1000,
+            "samples": histogram.total,
+        },
+        "server_rss_mb": {
+            "peak": max(rss) / 2**20 if rss else None,
+            "final": rss[-1] / 2**20 if rss else None,
+        },
+    }
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--clients", type=int, default=1000, help="Connections in total.")
+    parser.add_argument("--procs", type=int, default=1, help="Client processes.")
+    parser.add_argument("--rate", type=float, default=200, help="Messages/s sent in total.")
+    parser.add_argument(
+        "--room-size",
+        type=int,
+        default=0,
+        help="Members per channel; 0 broadcasts to everyone.",
+    )
+    parser.add_argument("--message-size", type=int, default=64, help="Content bytes.")
+    parser.add_argument("--codec", choices=("json", "binary"), default="binary")
+    parser.add_argument("--duration", type=float, default=10, help="Measured seconds.")
+    parser.add_argument("--warmup", type=float, default=2, help="Unmeasured seconds first.")
+    parser.add_argument("--settle", type=float, default=1, help="Seconds to await stragglers.")
+    parser.add_argument("--workers", type=int, default=1, help="Server worker processes.")
+    parser.add_argument("--reactor", help="Reactor for the server; see [Server] reactor.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=4191)
+    parser.add_argument(
+        "--attach", action="store_true", help="Use a server that is already running."
+    )
+    parser.add_argument("--output", help="JSON file to write; defaults to benchmarks/results.")
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    args.run_id = uuid.uuid4().hex[:8]
+    args.procs = max(1, min(args.procs, args.clients))
+
+    result = run(args)
+    latency = result["latency_ms"]
+    print(
+        f"sent {result['sent_per_second']:.0f}/s, delivered "
+        f"{result['delivered_per_second']:.0f}/s "
+        f"({result['delivered']}/{result['expected']})"
+    )
+    print(
+        f"latency p50 {latency['p50']:.2f} ms, p99 {latency['p99']:.2f} ms, "
+        f"p999 {latency['p999']:.2f} ms, max {latency['max']:.2f} ms"
+    )
+    if result["server_rss_mb"]["peak"] is not None:
+        print(f"server rss peak {result['server_rss_mb']['peak']:.1f} MiB")
+
+    output = Path(args.output) if args.output else RESULTS.joinpath(
+        f"loadgen-{result['commit'] or 'unknown'}-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(result, indent=2))
+    print(f"saved {output}")
+
+
+if __name__ == "__main__":
+    main()
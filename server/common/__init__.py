@@ -1,6 +1,6 @@
 from .packets import *
 from .registry import BaseRegistry
-from .events import EventHandler
+from .events import EventHandler, Subscription, SubscriptionGroup
 
 
 class Lock:
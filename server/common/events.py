@@ -1,43 +1,202 @@
+import logging
+from time import perf_counter_ns
+from types import CoroutineType
+
+logger = logging.getLogger(__name__)
+
+WILDCARDS = ("*", "all")
+"""Patterns starting with one of these receive every event."""
+
+
+class _PrefixNode:
+    """One dotted segment of a ``X.*`` pattern in the EventHandler prefix trie."""
+
+    __slots__ = ("children", "callbacks")
+
+    def __init__(self):
+        self.children = {}
+        self.callbacks = None
+
+
+class Subscription:
+    """Handle for one callback registered with EventHandler.on/once.
+
+    Cancelling it removes the callback; it can also be used as a context
+    manager to unsubscribe on exit.
+    """
+
+    __slots__ = ("handler", "event_name", "callback", "active")
+
+    def __init__(self, handler, event_name, callback):
+        self.handler = handler
+        self.event_name = event_name
+        self.callback = callback
+        self.active = True
+
+    def cancel(self):
+        if self.active:
+            self.active = False
+            self.handler.off(self.event_name, self.callback)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.cancel()
+
+    def __repr__(self):
+        return f"<Subscription {self.event_name} {self.callback}>"
+
+
+class SubscriptionGroup:
+    """Collects subscriptions that share a lifetime, e.g. one connection.
+
+    Subscribe through the group instead of the EventHandler and cancel the
+    whole group once its owner goes away.
+    """
+
+    __slots__ = ("handler", "subscriptions")
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.subscriptions = []
+
+    def on(self, event_name, callback):
+        subscription = self.handler.on(event_name, callback)
+        self.subscriptions.append(subscription)
+        return subscription
+
+    def once(self, event_name, callback):
+        subscription = self.handler.once(event_name, callback)
+        self.subscriptions.append(subscription)
+        return subscription
+
+    def cancel(self):
+        subscriptions, self.subscriptions = self.subscriptions, []
+        for subscription in subscriptions:
+            subscription.cancel()
+
+    def __len__(self):
+        return len(self.subscriptions)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.cancel()
+
+
 class EventHandler:
     def __init__(self):
         self.events = {"all": []}
 
+        # Routing table compiled from self.events by on/off. Every entry shares
+        # the callback list stored in self.events. Exact names are a dict,
+        # "X.*" patterns live in a trie of dotted segments and "*"/"all"
+        # patterns are matched by every event.
+        self._exact = {}
+        self._prefixes = _PrefixNode()
+        self._wildcards = [self.events["all"]]
+        self._cache = {}
+
+        self.observer = None
+        """Called with the event name and the nanoseconds its handlers took, if set."""
+        self.runner = None
+        """Called with the coroutine of every ``async def`` handler, to run it."""
+
     def on(self, event_name, callback):
         if event_name not in self.events:
             self.events[event_name] = []
+            self._index(event_name, self.events[event_name])
         self.events[event_name].append(callback)
-        return self
+        self._cache.clear()
+        return Subscription(self, event_name, callback)
 
     def once(self, event_name, callback):
         def wrapper(*args, **kwargs):
-            callback(*args, **kwargs)
-            self.off(event_name, callback)
+            if subscription.active:
+                subscription.cancel()
+                callback(*args, **kwargs)
 
-        self.on(event_name, wrapper)
-        return self
+        wrapper.__wrapped__ = callback
+        subscription = self.on(event_name, wrapper)
+        return subscription
 
     def off(self, event_name, callback):
-        if event_name in self.events:
-            self.events[event_name].remove(callback)
+        callbacks = self.events.get(event_name)
+        if callbacks:
+            for i, registered in enumerate(callbacks):
+                if registered == callback or (
+                    getattr(registered, "__wrapped__", None) == callback
+                ):
+                    del callbacks[i]
+                    self._cache.clear()
+                    break
         return self
 
-    def emit(self, event_name, *args, **kwargs):
-        # print(self.events)
+    def scope(self):
+        """
+        Creates a SubscriptionGroup bound to this handler.
 
-        if event_name in self.events:
+        Returns:
+            SubscriptionGroup: An empty group.
+        """
+        return SubscriptionGroup(self)
 
-            for callback in self.events[event_name]:
-                # print(f"Fired callback for {event_name} matching: {callback}")
+    def emit(self, event_name, *args, **kwargs):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Emit %s args=%r kwargs=%r", event_name, args, kwargs)
 
-                callback(*args, **kwargs)
-        for pattern, callbacks in self.events.items():
-            if (
-                pattern.endswith(".*")
-                and event_name.startswith(pattern[:-2])
-                or pattern.startswith(("*", "all"))
-            ):
-                for callback in callbacks:
-                    # print(f"Fired callback for {event_name} matching: {pattern}")
-                    callback(*args, **kwargs)
+        callbacks = self._cache.get(event_name)
+        if callbacks is None:
+            callbacks = self._cache[event_name] = self._resolve(event_name)
+        if self.observer is None:
+            for callback in callbacks:
+                result = callback(*args, **kwargs)
+                if result is not None and type(result) is CoroutineType:
+                    self._run(result)
+        else:
+            started = perf_counter_ns()
+            for callback in callbacks:
+                result = callback(*args, **kwargs)
+                if result is not None and type(result) is CoroutineType:
+                    self._run(result)
+            self.observer(event_name, perf_counter_ns() - started)
 
         return self
+
+    def _run(self, coroutine):
+        """Hands a coroutine handler's coroutine to the runner."""
+        if self.runner is None:
+            coroutine.close()
+            logger.error("No runner for coroutine handler %s", coroutine.__qualname__)
+            return
+        self.runner(coroutine)
+
+    def _index(self, pattern, callbacks):
+        """Adds a newly seen pattern to the routing table."""
+        if pattern.startswith(WILDCARDS):
+            self._wildcards.append(callbacks)
+        elif pattern.endswith(".*"):
+            node = self._prefixes
+            for segment in pattern[:-2].split("."):
+                node = node.children.setdefault(segment, _PrefixNode())
+            node.callbacks = callbacks
+        else:
+            self._exact[pattern] = callbacks
+
+    def _resolve(self, event_name):
+        """Collects the callbacks for an event name, in firing order."""
+        callbacks = list(self._exact.get(event_name, ()))
+
+        node = self._prefixes
+        for segment in event_name.split("."):
+            node = node.children.get(segment)
+            if node is None:
+                break
+            if node.callbacks is not None:
+                callbacks.extend(node.callbacks)
+
+        for wildcard in self._wildcards:
+            callbacks.extend(wildcard)
+        return tuple(callbacks)
@@ -1,13 +1,33 @@
+import argparse
 import logging
 import configparser
+import signal
+import socket
+import sys
+import tempfile
 from pathlib import Path
+from app.reactors import configured_reactor, install_reactor
+
+BASE = Path(__file__).absolute().parent
+# Must run before anything imports twisted.internet.reactor, which installs
+# the platform default.
+REACTOR = install_reactor(configured_reactor(sys.argv[1:], str(BASE / "config.ini")))
+
 from twisted.internet import reactor
-from twisted.internet.endpoints import TCP4ServerEndpoint
+from twisted.internet.endpoints import TCP4ServerEndpoint, serverFromString
 from app.factory import ServerFactory
+from app.backplane import Broker, BrokerBackplane
+from app.handoff import Handoff, HandoffError, Takeover, handoff_path
+from app.workers import (
+    listen_reuseport,
+    remove_socket,
+    signal_workers,
+    spawn_workers,
+    stop_workers,
+)
 from rich.logging import RichHandler
 from rich.console import Console
 
-BASE = Path(__file__).absolute().parent
 console = Console()
 
 
@@ -25,20 +45,193 @@ def init_logger():
     return logger
 
 
-def main(reactor=reactor):
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Chatremake server.")
+    parser.add_argument(
+        "--config", default=str(BASE.joinpath("config.ini")), help="Config file."
+    )
+    parser.add_argument("--port", type=int, help="Override [Server] port.")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of worker processes sharing the port. Overrides [Server] workers.",
+    )
+    parser.add_argument(
+        "--broker",
+        metavar="ENDPOINT",
+        help="Run only the cluster broker, listening on a Twisted endpoint such as "
+        "tcp:4050 (on loopback unless it names an interface).",
+    )
+    parser.add_argument(
+        "--reactor",
+        help="Reactor to run on: default, epoll, poll, select, asyncio or uvloop. "
+        "Overrides [Server] reactor.",
+    )
+    parser.add_argument(
+        "--takeover",
+        action="store_true",
+        help="Take the port and connections over from the server running with "
+        "this config, without disconnecting anyone. Starts normally if none is.",
+    )
+    # Set by the master process on the workers it spawns.
+    parser.add_argument("--worker-id", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--bus", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def run_broker(reactor, endpoint: str, secret: str, logger) -> None:
+    if endpoint.startswith("tcp") and "interface=" not in endpoint:
+        # Nodes need the secret to join, but only when one is set.
+        endpoint += ":interface=127.0.0.1"
+    if not secret and "interface=127.0.0.1" not in endpoint:
+        logger.warning("The broker is reachable from other hosts without [Cluster] secret.")
+    d = serverFromString(reactor, endpoint).listen(Broker(secret))
+    d.addCallback(lambda port: logger.info(f"Broker listening on {endpoint}"))
+    reactor.run()
+
+
+def run_master(reactor, config, workers: int, argv, logger) -> None:
+    port = config.getint("Server", "port")
+    bus_path = None
+    if config.get("Cluster", "backplane", fallback="local") == "local":
+        bus_path = config.get(
+            "Server",
+            "bus_socket",
+            fallback=str(Path(tempfile.gettempdir(), f"chatremake-{port}.sock")),
+        )
+        remove_socket(bus_path)
+        reactor.listenUNIX(
+            bus_path, Broker(config.get("Cluster", "secret", fallback="")), mode=0o600
+        )
+        reactor.addSystemEventTrigger("after", "shutdown", remove_socket, bus_path)
+
+    processes = spawn_workers(workers, bus_path, [str(BASE.joinpath("main.py")), *argv])
+    reactor.addSystemEventTrigger("before", "shutdown", stop_workers, processes)
+    signal.signal(
+        signal.SIGUSR2, lambda signum, frame: signal_workers(processes, signum)
+    )
+    logger.info(f"Started {workers} workers on port {port}, broker at {bus_path}")
+    reactor.run()
+
+
+def profile_on_signal(reactor, factory: ServerFactory, logger) -> None:
+    """Profiles the reactor with the [Profiling] defaults whenever SIGUSR2 arrives."""
+
+    def profile():
+        d = factory.profiler.profile()
+        d.addErrback(lambda failure: logger.warning(failure.getErrorMessage()))
+
+    signal.signal(signal.SIGUSR2, lambda signum, frame: reactor.callFromThread(profile))
+
+
+def make_backplane(factory: ServerFactory, config, args):
+    """Builds the node's backplane from the command line and [Cluster] config."""
+    port = config.get("Server", "port")
+    endpoint = config.get("Cluster", "backplane", fallback="local")
+    node = config.get("Cluster", "node", fallback="") or f"{socket.gethostname()}:{port}"
+    if args.worker_id is not None:
+        node = f"{node}/{args.worker_id}"
+    if endpoint == "local" and args.bus is not None:
+        endpoint = f"unix:path={args.bus}"
+    if endpoint == "local":
+        return None
+    return BrokerBackplane(
+        factory, endpoint, node, config.get("Cluster", "secret", fallback="")
+    )
+
+
+def main(reactor=reactor, argv=None):
+    args = parse_args(argv)
     config = configparser.ConfigParser()
-    config.read(BASE.joinpath("config.ini"))
+    config.read(args.config)
+    if args.port is not None:
+        config.set("Server", "port", str(args.port))
 
     logger = init_logger()
+    logger.info(f"Running on {REACTOR}")
+    if args.broker is not None:
+        return run_broker(
+            reactor, args.broker, config.get("Cluster", "secret", fallback=""), logger
+        )
+
+    workers = args.workers or config.getint("Server", "workers", fallback=1)
+    if args.takeover and (workers > 1 or args.worker_id is not None):
+        logger.warning("--takeover only works with a single process, ignoring it.")
+        args.takeover = False
+    if args.worker_id is None and workers > 1:
+        argv = ["--config", args.config, "--port", config.get("Server", "port")]
+        if args.reactor:
+            argv += ["--reactor", args.reactor]
+        return run_master(reactor, config, workers, argv, logger)
+
+    if args.worker_id is not None and config.has_section("History"):
+        # Every worker receives every broadcast and keeps its own history.
+        path = config.get("History", "path", fallback="history")
+        config.set("History", "path", str(Path(path, f"worker-{args.worker_id}")))
+
+    if args.worker_id is not None and config.has_section("Metrics"):
+        # Workers can't share one stats endpoint; each needs its own.
+        endpoint = config.get("Metrics", "endpoint", fallback="")
+        config.set(
+            "Metrics",
+            "endpoint",
+            endpoint.format(worker=args.worker_id) if "{worker}" in endpoint else "",
+        )
+
+    takeover = None
+    if args.takeover:
+        # Before the factory exists: the old process releases the history
+        # and the metrics endpoint before finishing the handoff.
+        try:
+            takeover = Takeover.receive(
+                handoff_path(config),
+                config.getfloat("Server", "handoff_timeout", fallback=10.0),
+            )
+        except (HandoffError, OSError) as e:
+            logger.error(f"Taking over failed: {e}")
+            return
+        if takeover is None:
+            logger.info("No server to take over, starting normally.")
+
     factory = ServerFactory(config)
-    endpoint = TCP4ServerEndpoint(reactor, config.getint("Server", "port"))
+    profile_on_signal(reactor, factory, logger)
+    backplane = make_backplane(factory, config, args)
+    if backplane is not None:
+        factory.backplane = backplane
+        backplane.start(reactor)
+        reactor.addSystemEventTrigger("before", "shutdown", backplane.stop)
 
-    d = endpoint.listen(factory)
-    d.addCallback(
-        lambda port: logger.info(
+    backlog = config.getint("Server", "backlog", fallback=50)
+    if args.worker_id is not None:
+        port = listen_reuseport(
+            reactor, factory, config.getint("Server", "port"), backlog=backlog
+        )
+        logger.info(
+            f"Worker {args.worker_id} serving on "
+            f"{config.get('Server', 'ip')}:{port.getHost().port}"
+        )
+        reactor.run()
+        return
+
+    def listening(port):
+        logger.info(
             f"Starting server on {config.get('Server', 'ip')}:{port.getHost().port}"
         )
+        if config.getboolean("Server", "handoff", fallback=True):
+            Handoff(factory, port, handoff_path(config)).listen()
+
+    if takeover is not None:
+        listening(takeover.adopt(factory))
+        logger.info(f"Took over {len(factory.users)} connections.")
+        reactor.run()
+        return
+
+    endpoint = TCP4ServerEndpoint(
+        reactor, config.getint("Server", "port"), backlog=backlog
     )
+
+    d = endpoint.listen(factory)
+    d.addCallback(listening)
     reactor.run()
 
 
@@ -3,17 +3,18 @@ import subprocess
 import time
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
-import psutil
 
 
 BASE = Path(__file__).parent.parent
 
-# Command to start the server process using pipenv
-SERVER_COMMAND = ["pipenv", "run", "python", "serv.py"]
+# Command to start the server process using pipenv. With --takeover, a new
+# process takes the port and every connection over from the running one,
+# which then exits, so restarting disconnects nobody.
+SERVER_COMMAND = ["pipenv", "run", "python", "serv.py", "--takeover"]
 # Directory to monitor for changes
 MONITOR_DIRECTORY = BASE.joinpath("app")
-# Port number used by the server
-SERVER_PORT = 2000
+
+processes = []
 
 
 class FileChangeHandler(FileSystemEventHandler):
@@ -24,35 +25,17 @@ class FileChangeHandler(FileSystemEventHandler):
 
 def start_server():
     print("Starting server...")
-    subprocess.Popen(SERVER_COMMAND, cwd=BASE)
-
+    processes.append(subprocess.Popen(SERVER_COMMAND, cwd=BASE))
 
-def find_process_by_port(port):
-    for proc in psutil.net_connections():
-        if proc.laddr.port == port:
-            return proc.pid
-    return None
 
-
-def terminate_process(pid):
-    try:
-        process = psutil.Process(pid)
-        process.terminate()
-        print(f"Process with PID {pid} terminated successfully.")
-    except psutil.NoSuchProcess:
-        print(f"Process with PID {pid} not found.")
+def reap_servers():
+    """Forgets the server processes that exited after handing off."""
+    processes[:] = [process for process in processes if process.poll() is None]
 
 
 def restart_server():
     print("Restarting server...")
-    # Find and terminate processes listening on the server port
-    pid = find_process_by_port(SERVER_PORT)
-    if pid is not None:
-        terminate_process(pid)
-    else:
-        print(f"No process found using port {SERVER_PORT}.")
-
-    # Start the server process again
+    # The new process takes over from the running one.
     start_server()
 
 
@@ -67,6 +50,7 @@ def main():
     try:
         while True:
             time.sleep(1)
+            reap_servers()
     except KeyboardInterrupt:
         observer.stop()
     observer.join()
@@ -0,0 +1,127 @@
+import unittest
+
+from common import codecs
+from common.codecs import DecodeError
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - depends on the environment
+    msgpack = None
+
+VALUES = [
+    None,
+    True,
+    False,
+    0,
+    1,
+    127,
+    128,
+    255,
+    256,
+    65535,
+    65536,
+    2**32 - 1,
+    2**32,
+    2**64 - 1,
+    -1,
+    -32,
+    -33,
+    -128,
+    -129,
+    -32768,
+    -32769,
+    -(2**31),
+    -(2**31) - 1,
+    -(2**63),
+    0.0,
+    -1.5,
+    3.141592653589793,
+    1e300,
+    "",
+    "a",
+    "x" * 31,
+    "x" * 32,
+    "x" * 255,
+    "x" * 256,
+    "x" * 65536,
+    "héllo wörld ✓",
+    b"",
+    b"\x00\xff",
+    b"b" * 256,
+    b"b" * 65536,
+    [],
+    list(range(15)),
+    list(range(16)),
+    list(range(65536)),
+    {},
+    {str(i): i for i in range(15)},
+    {str(i): i for i in range(16)},
+    {"type": "MessagePacket", "content": "hi", "nested": {"list": [1, "two", None, [b"3"]]}},
+]
+
+
+def fallback_packb(obj) -> bytes:
+    out = bytearray()
+    codecs._pack(out, obj)
+    return bytes(out)
+
+
+def fallback_unpackb(data: bytes):
+    obj, offset = codecs._unpack(data, 0)
+    assert offset == len(data)
+    return obj
+
+
+class FallbackCodecTest(unittest.TestCase):
+    def test_round_trip(self):
+        for value in VALUES:
+            with self.subTest(value=repr(value)[:40]):
+                self.assertEqual(fallback_unpackb(fallback_packb(value)), value)
+
+    def test_tuples_decode_as_lists(self):
+        self.assertEqual(fallback_unpackb(fallback_packb((1, (2, 3)))), [1, [2, 3]])
+
+    def test_truncated(self):
+        data = codecs.packb({"content": "hello", "list": [1, 2, 3]})
+        for end in range(len(data)):
+            with self.subTest(end=end), self.assertRaises(DecodeError):
+                codecs.unpackb(data[:end])
+
+    def test_trailing_data(self):
+        with self.assertRaises(DecodeError):
+            codecs.unpackb(codecs.packb(1) + b"\x00")
+
+    def test_unhashable_key(self):
+        # fixmap of one entry whose key is a fixarray.
+        with self.assertRaises(DecodeError):
+            codecs.unpackb(b"\x81\x90\x00")
+
+    @unittest.skipIf(msgpack is not None, "unpackb uses the msgpack package")
+    def test_depth_limit(self):
+        nested = b"\x91" * (codecs.MAX_DEPTH - 1) + b"\x90"
+        self.assertEqual(codecs._unpack(nested, 0)[1], len(nested))
+        with self.assertRaises(DecodeError):
+            codecs.unpackb(b"\x91" * codecs.MAX_DEPTH + b"\x90")
+        with self.assertRaises(DecodeError):
+            codecs.unpackb(b"\x91" * 100000)
+
+
+@unittest.skipIf(msgpack is None, "msgpack is not installed")
+class MsgpackCompatibilityTest(unittest.TestCase):
+    def test_same_bytes(self):
+        for value in VALUES:
+            with self.subTest(value=repr(value)[:40]):
+                self.assertEqual(
+                    fallback_packb(value), msgpack.packb(value, use_bin_type=True)
+                )
+
+    def test_decodes_msgpack_output(self):
+        for value in VALUES:
+            with self.subTest(value=repr(value)[:40]):
+                self.assertEqual(
+                    fallback_unpackb(msgpack.packb(value, use_bin_type=True)), value
+                )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,185 @@
+import unittest
+
+from app.compression import CompressionGroups
+from common.compression import (
+    FLAG_GROUP,
+    FLAG_GROUP_RESET,
+    FLAG_PLAIN,
+    GROUP_ID,
+    Deflater,
+    Inflater,
+)
+from common.packets import FrameError, PacketBuffer, frame
+from common.packets import DEFAULT_CODEC as JSON
+
+
+class Recipient:
+    """Stands in for an OutboundQueue, and decodes what it is sent like a client."""
+
+    def __init__(self, groups: CompressionGroups) -> None:
+        self.deflater = groups.deflater()
+        self.inflater = Inflater(groups.max_groups)
+        self.paused = False
+        self.queued = []
+        self.sent = []
+
+    def write_shared(self, encoded: bytes, data: bytes, droppable: bool = False) -> bool:
+        if self.paused:
+            self.queued.append(data)
+            return False
+        self.sent.append(encoded)
+        return True
+
+    def write(self, data: bytes, droppable: bool = False) -> None:
+        if self.paused:
+            self.queued.append(data)
+        else:
+            self.sent.append(self.deflater.encode(data))
+
+    def resume(self) -> None:
+        self.paused = False
+        if self.queued:
+            self.sent.append(self.deflater.encode(b"".join(self.queued)))
+            self.queued.clear()
+
+    def received(self) -> list:
+        payloads = []
+        for payload in PacketBuffer().feed(b"".join(self.sent)):
+            payloads.extend(bytes(p) for p in self.inflater.payloads(payload))
+        self.sent.clear()
+        return payloads
+
+
+def flags(data: bytes) -> list:
+    return [payload[0] for payload in PacketBuffer().feed(data)]
+
+
+class StreamTest(unittest.TestCase):
+    def test_round_trip(self):
+        deflater, inflater = Deflater(min_size=32), Inflater()
+        messages = [b"x", b"hello " * 20, b"", b"hello world " * 50, b"y" * 31]
+        for message in messages:
+            encoded = deflater.encode(frame(message))
+            payloads = PacketBuffer().feed(encoded)
+            self.assertEqual(len(payloads), 1)
+            decoded = inflater.payloads(payloads[0])
+            self.assertEqual([bytes(p) for p in decoded], [message])
+
+    def test_plain_keeps_frames_apart(self):
+        data = frame(b"a") + frame(b"bc") + frame(b"")
+        encoded = Deflater(min_size=1024).encode(data)
+        self.assertEqual(flags(encoded), [FLAG_PLAIN] * 3)
+        inflater = Inflater()
+        decoded = [
+            bytes(p) for x in PacketBuffer().feed(encoded) for p in inflater.payloads(x)
+        ]
+        self.assertEqual(decoded, [b"a", b"bc", b""])
+
+    def test_several_frames_in_one(self):
+        data = b"".join(frame(b"message %d " % i * 10) for i in range(5))
+        encoded = Deflater(min_size=16).encode(data)
+        (payload,) = PacketBuffer().feed(encoded)
+        decoded = [bytes(p) for p in Inflater().payloads(payload)]
+        self.assertEqual(decoded, [b"message %d " % i * 10 for i in range(5)])
+
+    def test_malformed(self):
+        inflater = Inflater()
+        with self.assertRaises(FrameError):
+            inflater.payloads(b"")
+        with self.assertRaises(FrameError):
+            inflater.payloads(b"\x09data")
+        with self.assertRaises(FrameError):
+            inflater.payloads(bytes((FLAG_GROUP,)) + GROUP_ID.pack(7) + b"\x00")
+
+
+class GroupTest(unittest.TestCase):
+    def setUp(self):
+        self.groups = CompressionGroups(min_size=16, reset_every=4, max_groups=2)
+
+    def send(self, name: str, message: bytes, recipients) -> None:
+        shared = self.groups.shared(name, JSON, frame(message), False)
+        for recipient in recipients:
+            shared.write(recipient)
+
+    def test_shared_frames(self):
+        a, b = Recipient(self.groups), Recipient(self.groups)
+        for i in range(10):
+            self.send("*", b"broadcast number %d " % i * 5, (a, b))
+        self.assertEqual(self.groups.frames, 10)
+        self.assertEqual(self.groups.resets, 1)
+        expected = [b"broadcast number %d " % i * 5 for i in range(10)]
+        self.assertEqual(a.received(), expected)
+        self.assertEqual(b.received(), expected)
+
+    def test_left_out_recipient_rejoins_on_reset(self):
+        a, b = Recipient(self.groups), Recipient(self.groups)
+        messages = [b"message number %d " % i * 3 for i in range(12)]
+        self.send("*", messages[0], (a, b))
+        b.paused = True
+        for message in messages[1:3]:
+            self.send("*", message, (a, b))
+        b.resume()
+        for message in messages[3:]:
+            self.send("*", message, (a, b))
+        # b gets frames 1 to 3 through its own context, and the group's
+        # again from the reset reset_every frames after the first.
+        self.assertEqual(self.groups.resets, 2)
+        self.assertEqual(self.groups.private, 3)
+        self.assertEqual(a.received(), messages)
+        self.assertEqual(b.received(), messages)
+        self.assertEqual(b.deflater.groups, a.deflater.groups)
+
+    def test_reset_starts_a_new_context(self):
+        a = Recipient(self.groups)
+        self.send("*", b"before the reset " * 3, (a,))
+        self.groups.groups[("*", JSON.name)].synced = 0
+        shared = self.groups.shared("*", JSON, frame(b"after the reset " * 3), False)
+        self.assertTrue(shared.reset)
+        shared.write(a)
+        self.assertEqual(
+            [payload[0] for payload in PacketBuffer().feed(b"".join(a.sent))],
+            [FLAG_GROUP_RESET, FLAG_GROUP_RESET],
+        )
+        self.assertEqual(a.received(), [b"before the reset " * 3, b"after the reset " * 3])
+
+    def test_evictions(self):
+        a, b = Recipient(self.groups), Recipient(self.groups)
+        names = ["*", "#one", "#two"]
+        expected_a, expected_b = [], []
+        for i in range(30):
+            name = names[i % 3]
+            message = b"%s message %d " % (name.encode(), i) * 3
+            recipients = (a, b) if name != "#two" else (a,)
+            self.send(name, message, recipients)
+            expected_a.append(message)
+            if b in recipients:
+                expected_b.append(message)
+            self.assertLessEqual(len(self.groups.groups), 2)
+            for recipient in (a, b):
+                self.assertLessEqual(len(recipient.deflater.groups), 2)
+        self.assertEqual(a.received(), expected_a)
+        self.assertEqual(b.received(), expected_b)
+        self.assertLessEqual(len(a.inflater.groups), 2)
+        self.assertLessEqual(len(b.inflater.groups), 2)
+
+    def test_client_keeps_what_the_server_remembers(self):
+        # Per connection, the server forgets groups in the order the client does.
+        groups = CompressionGroups(min_size=16, reset_every=1000, max_groups=3)
+        a = Recipient(groups)
+        order = ["g0", "g1", "g2", "g0", "g3", "g1", "g4", "g0", "g2", "g3"] * 5
+        for i, name in enumerate(order):
+            message = b"%s says %d " % (name.encode(), i) * 3
+            groups.shared(name, JSON, frame(message), False).write(a)
+            a.received()
+            self.assertEqual(list(a.deflater.groups), list(a.inflater.groups))
+
+    def test_small_frames_skip_groups(self):
+        a = Recipient(self.groups)
+        self.send("*", b"tiny", (a,))
+        self.assertEqual(flags(b"".join(a.sent)), [FLAG_PLAIN])
+        self.assertEqual(a.received(), [b"tiny"])
+        self.assertEqual(self.groups.frames, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+from app.history import INDEX_ENTRY, HistoryLog
+from common.packets import BasePacket, MessagePacket, PacketBuffer
+
+
+def message(i: int) -> MessagePacket:
+    """Returns a message as received from a client."""
+    packet = MessagePacket({"content": f"message {i}", "sender": "tester"})
+    return BasePacket.decode(packet.prep())
+
+
+class HistoryRecoveryTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = Path(self.directory.name)
+        self.logs = []
+
+    def tearDown(self):
+        for log in self.logs:
+            log.close()
+        self.directory.cleanup()
+
+    def open(self, **kwargs) -> HistoryLog:
+        log = HistoryLog(self.path, **kwargs)
+        self.logs.append(log)
+        return log
+
+    def write(self, count: int, **kwargs) -> HistoryLog:
+        log = self.open(**kwargs)
+        for i in range(count):
+            self.assertEqual(log.append(message(i)), i)
+        log.close()
+        return log
+
+    def contents(self, log: HistoryLog, start: int = 0) -> list:
+        return [
+            BasePacket.decode(bytes(payload)).data["content"]
+            for payload in PacketBuffer().feed(log.read_from(start))
+        ]
+
+    def last_segment(self, suffix: str) -> Path:
+        return sorted(self.path.glob(f"*{suffix}"))[-1]
+
+    def test_reopen(self):
+        self.write(5)
+        log = self.open()
+        self.assertEqual(log.next_seq, 5)
+        self.assertEqual(self.contents(log), [f"message {i}" for i in range(5)])
+
+    def test_partly_written_record(self):
+        self.write(5)
+        log_path = self.last_segment(".log")
+        size = log_path.stat().st_size
+        os.truncate(log_path, size - 3)
+
+        log = self.open()
+        self.assertEqual(log.next_seq, 4)
+        self.assertEqual(self.contents(log), [f"message {i}" for i in range(4)])
+        self.assertLess(log_path.stat().st_size, size - 3)
+        self.assertEqual(log.append(message(9)), 4)
+        record = BasePacket.decode(bytes(log.record(4)))
+        self.assertEqual(record.data["content"], "message 9")
+        log.close()
+
+        log = self.open()
+        self.assertEqual(log.next_seq, 5)
+        self.assertEqual(self.contents(log, 3), ["message 3", "message 9"])
+
+    def test_partly_written_header(self):
+        self.write(3)
+        log_path = self.last_segment(".log")
+        with open(log_path, "ab") as f:
+            f.write(b"\x00\x00")
+        log = self.open()
+        self.assertEqual(log.next_seq, 3)
+        self.assertEqual(log.append(message(3)), 3)
+        self.assertEqual(self.contents(log), [f"message {i}" for i in range(4)])
+
+    def test_missing_index_entries(self):
+        self.write(6)
+        index_path = self.last_segment(".index")
+        # Two whole entries and half of the third survived.
+        os.truncate(index_path, INDEX_ENTRY.size * 2 + INDEX_ENTRY.size // 2)
+        log = self.open()
+        self.assertEqual(log.next_seq, 6)
+        self.assertEqual(self.contents(log, 2), [f"message {i}" for i in range(2, 6)])
+        self.assertEqual(index_path.stat().st_size, INDEX_ENTRY.size * 6)
+
+    def test_index_past_the_log(self):
+        self.write(4)
+        log = self.open()
+        end = log.active.positions[2]
+        log.close()
+        os.truncate(self.last_segment(".log"), end)
+        log = self.open()
+        self.assertEqual(log.next_seq, 2)
+        self.assertEqual(self.contents(log), ["message 0", "message 1"])
+
+    def test_truncated_active_segment(self):
+        self.write(20, segment_bytes=256)
+        self.assertGreater(len(list(self.path.glob("*.log"))), 2)
+        log_path = self.last_segment(".log")
+        os.truncate(log_path, log_path.stat().st_size - 1)
+
+        log = self.open(segment_bytes=256)
+        self.assertEqual(log.next_seq, 19)
+        self.assertEqual(self.contents(log), [f"message {i}" for i in range(19)])
+        self.assertEqual(log.append(message(19)), 19)
+        self.assertEqual(self.contents(log, 17), [f"message {i}" for i in range(17, 20)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+import random
+import unittest
+
+from app.search import BLOCK_SIZE, Postings, _decode_deltas, _encode_deltas, tokenize
+
+
+class DeltaTest(unittest.TestCase):
+    def test_round_trip(self):
+        cases = [
+            [5],
+            [0, 1, 2, 3],
+            [10, 137, 138, 20000, 2**21, 2**35, 2**63],
+            [0, 127, 255, 16383, 16384 + 127, 2**32],
+        ]
+        rng = random.Random(13)
+        doc = 0
+        docs = []
+        for _ in range(BLOCK_SIZE):
+            doc += rng.choice((1, 2, 100, 5000, 2**20))
+            docs.append(doc)
+        cases.append(docs)
+        for docs in cases:
+            with self.subTest(docs=docs[:4]):
+                self.assertEqual(_decode_deltas(docs[0], _encode_deltas(docs)), docs)
+
+    def test_varint_sizes(self):
+        self.assertEqual(_encode_deltas([0, 127]), b"\x7f")
+        self.assertEqual(_encode_deltas([0, 128]), b"\x80\x01")
+        self.assertEqual(_encode_deltas([1, 1 + 300]), b"\xac\x02")
+
+
+class PostingsTest(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(42)
+        self.docs = sorted(rng.sample(range(100000), BLOCK_SIZE * 3 + 17))
+        self.postings = Postings()
+        for doc in self.docs:
+            self.postings.add(doc)
+
+    def test_blocks(self):
+        postings = self.postings
+        self.assertEqual(postings.count, len(self.docs))
+        self.assertEqual(len(postings.blocks), 3)
+        self.assertEqual(list(postings.tail), self.docs[BLOCK_SIZE * 3 :])
+        for i in range(3):
+            block = self.docs[BLOCK_SIZE * i : BLOCK_SIZE * (i + 1)]
+            self.assertEqual(postings.block(i), block)
+            self.assertEqual((postings.firsts[i], postings.lasts[i]), (block[0], block[-1]))
+
+    def test_contains(self):
+        present = set(self.docs)
+        for doc in range(0, 100001, 7):
+            self.assertEqual(doc in self.postings, doc in present, doc)
+        for doc in self.docs:
+            self.assertIn(doc, self.postings)
+
+    def test_descending(self):
+        self.assertEqual(list(self.postings.descending()), self.docs[::-1])
+        for before in (0, self.docs[0], self.docs[BLOCK_SIZE], self.docs[-1], 50000):
+            with self.subTest(before=before):
+                expected = [doc for doc in reversed(self.docs) if doc < before]
+                self.assertEqual(list(self.postings.descending(before)), expected)
+
+    def test_prune(self):
+        self.postings.prune(self.docs[BLOCK_SIZE + 1])
+        # Only the first block holds nothing at or past the new first message.
+        self.assertEqual(len(self.postings.blocks), 2)
+        self.assertEqual(self.postings.count, len(self.docs) - BLOCK_SIZE)
+        self.assertEqual(list(self.postings.descending()), self.docs[BLOCK_SIZE:][::-1])
+        self.assertNotIn(self.docs[0], self.postings)
+        self.assertIn(self.docs[BLOCK_SIZE], self.postings)
+
+
+class TokenizeTest(unittest.TestCase):
+    def test_tokenize(self):
+        self.assertEqual(
+            tokenize("Hello, hello WORLD! it's 42"), ["hello", "world", "it", "s", "42"]
+        )
+        self.assertEqual(tokenize("a" * 65 + " b"), ["b"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+import random
+import unittest
+from math import ceil
+
+from app.classes.TimingWheel import TimingWheel
+
+
+def run(wheel: TimingWheel, ticks: int) -> dict:
+    """Advances the wheel, returning the tick each key expired on."""
+    fired = {}
+    for _ in range(ticks):
+        for key in wheel.advance():
+            fired[key] = wheel.ticks
+    return fired
+
+
+class TimingWheelTest(unittest.TestCase):
+    def test_expires_on_the_right_tick(self):
+        wheel = TimingWheel(tick=1.0, size=8)
+        delays = {"one": 1, "slot": 5, "turn": 8, "past": 9, "two turns": 16, "many": 61}
+        for key, delay in delays.items():
+            wheel.schedule(key, delay)
+        self.assertEqual(len(wheel), len(delays))
+        self.assertEqual(run(wheel, 70), delays)
+        self.assertEqual(len(wheel), 0)
+
+    def test_rotations_from_a_moved_cursor(self):
+        wheel = TimingWheel(tick=0.5, size=4)
+        rng = random.Random(24)
+        expected = {}
+        for step in range(40):
+            for n in range(3):
+                key = (step, n)
+                delay = rng.uniform(0, 12)
+                wheel.schedule(key, delay)
+                expected[key] = wheel.ticks + max(1, ceil(delay / wheel.tick))
+            fired = run(wheel, 1)
+            for key, tick in fired.items():
+                self.assertEqual(tick, expected.pop(key), key)
+        fired = run(wheel, 30)
+        self.assertEqual(fired, expected)
+
+    def test_reschedule_and_cancel(self):
+        wheel = TimingWheel(tick=1.0, size=4)
+        wheel.schedule("a", 3)
+        wheel.schedule("b", 10)
+        wheel.schedule("c", 2)
+        run(wheel, 2)
+        wheel.schedule("a", 9)
+        self.assertTrue(wheel.cancel("b"))
+        self.assertFalse(wheel.cancel("b"))
+        self.assertFalse(wheel.cancel("missing"))
+        self.assertEqual(run(wheel, 20), {"a": 11})
+        self.assertEqual(sum(map(len, wheel.slots)), 0)
+
+    def test_short_delays_take_a_tick(self):
+        wheel = TimingWheel(tick=1.0, size=4)
+        wheel.schedule("zero", 0)
+        wheel.schedule("fraction", 0.2)
+        self.assertEqual(run(wheel, 1), {"zero": 1, "fraction": 1})
+
+
+if __name__ == "__main__":
+    unittest.main()